@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for Pycraft. Run with the name of a benchmark:
+
+    python benchmark.py startup [--servers 1,10,100,500] [--no-shared-scan]
+    python benchmark.py chatlog [--sizes 10,100] [--chat-density 0.05] [--extractors ...]
+
+startup
+    Measures the time from creating each server.Server instance until every server has
+    completed its first server check, for increasing numbers of servers. The servers use jar
+    names which match no running process and are configured to be offline, so the benchmark
+    never starts or stops anything, but every process scan is real.
+
+chatlog
+    Generates synthetic ForgeModLoader logs of each size in megabytes, with the given fraction
+    of lines being chat, and reports the throughput of each chat extractor in MB/s and lines/s.
+    The output of every extractor is compared with the reference extractor, which is the
+    original line by line implementation.
+"""
+
+# Library modules
+import argparse
+import codecs
+import logging
+import os
+import random
+import re
+import sched
+import shutil
+import tempfile
+import time
+
+# Project modules
+import server
+import serverConfig
+
+
+def _benchmarkConfig(index):
+    return serverConfig.ServerConfig(
+        {
+            'SERVER_NICK': 'benchmark-{INDEX}'.format(INDEX=index),
+            'SERVER_PATH': '/nonexistent',
+            'SERVER_JAR': 'pycraft-benchmark-{INDEX}.jar'.format(INDEX=index),
+            'START_SCRIPT': 'ServerStart.sh',
+            'START_SERVER': False
+        },
+        'benchmark'
+    )
+
+
+class _FirstChecksDone(Exception):
+    pass
+
+
+def startup(serverCounts, sharedScan):
+    """
+    Print the time taken to create servers and complete their first checks, for each number of
+    servers in serverCounts.
+    """
+
+    if not sharedScan:
+        # A scan is never reused, as if every server scanned the host's processes itself.
+        server.ProcessTable.MAX_AGE = -1
+
+    print('{:>8} {:>12} {:>12} {:>14}'.format('servers', 'init (s)', 'checks (s)', 'per server (ms)'))
+
+    for count in serverCounts:
+        configs = [_benchmarkConfig(index) for index in range(count)]
+        checked = []
+
+        class BenchmarkServer(server.Server):
+            def _check(self):
+                server.Server._check(self)
+                checked.append(self)
+
+        # The first checks are scheduled immediately, and every later event is at least a minute
+        # away. Stop the scheduler as soon as it would have to wait.
+        def delay(seconds):
+            if seconds > 0:
+                raise _FirstChecksDone()
+
+        server.Server.scheduler = sched.scheduler(time.time, delay)
+        server.ProcessTable.invalidate()
+
+        started = time.time()
+
+        if sharedScan:
+            with server.ProcessTable.shared():
+                servers = [BenchmarkServer(c) for c in configs]
+        else:
+            servers = [BenchmarkServer(c) for c in configs]
+
+        initialised = time.time()
+
+        try:
+            server.Server.scheduler.run()
+
+        except _FirstChecksDone:
+            pass
+
+        finished = time.time()
+
+        assert len(checked) == len(servers)
+
+        print('{:>8} {:>12.3f} {:>12.3f} {:>14.2f}'.format(
+            count,
+            initialised - started,
+            finished - initialised,
+            (finished - started) * 1000 / count
+        ))
+
+
+def _generateLog(path, megabytes, chatDensity, seed=0):
+    """
+    Write a synthetic ForgeModLoader log of roughly the given size, returning its number of
+    lines. A chatDensity fraction of the lines are chat entries or broadcasts, some of them
+    coloured, and the rest are the mod loading messages, warnings and stack traces which make
+    up most of a busy modded server's log.
+    """
+
+    r = random.Random(seed)
+    players = [u'Steve', u'Alex', u'J\xe9r\xf4me', u'\u0421\u0435\u0440\u0433\u0435\u0439', u'xX_Miner_Xx']
+    words = [u'hello', u'anyone', u'selling', u'diamonds', u'lag', u'base', u'\u2764', u'caf\xe9', u'tp']
+
+    noise = [
+        u'{date} [INFO] [ForgeModLoader] Loading dimension {n} (world) (net.minecraft.server.dedicated.DedicatedServer@{n:x})\n',
+        u'{date} [WARNING] [Minecraft-Server] Can\'t keep up! Did the system time change, or is the server overloaded?\n',
+        u'{date} [INFO] [Minecraft-Server] {player} lost connection: disconnect.quitting\n',
+        u'{date} [SEVERE] [ForgeModLoader] Exception in tile entity at {n}, 64, -{n}\n\tat net.minecraft.tileentity.TileEntity.func_{n}(TileEntity.java:{n})\n\tat net.minecraft.world.World.func_72939_s(World.java:2350)\n',
+        u'{date} [FINE] [ForgeModLoader] Chunk ({n}, -{n}) loaded for dimension 0\n'
+    ]
+
+    target = megabytes * 1024 * 1024
+    written = 0
+    lines = 0
+    second = 0
+
+    with open(path, 'wb') as f:
+        while written < target:
+            second += r.randint(0, 2)
+
+            date = u'2014-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}'.format(
+                month=1 + second // 2419200 % 12,
+                day=1 + second // 86400 % 28,
+                hour=second // 3600 % 24,
+                minute=second // 60 % 60,
+                second=second % 60
+            )
+
+            k = r.random()
+
+            if k < chatDensity * 0.7:
+                line = u'{date} [INFO] [MyTown] \x1b[0;33;22m[Mem]\x1b[m{player}: {message}\n'
+            elif k < chatDensity * 0.85:
+                line = u'{date} [INFO] [Dynmap] [WEB]{player}: {message}\n'
+            elif k < chatDensity:
+                line = u'{date} [INFO] [Minecraft-Server] [Server] {message}\n'
+            else:
+                line = r.choice(noise)
+
+            data = line.format(
+                date=date,
+                player=r.choice(players),
+                message=u' '.join(r.sample(words, r.randint(1, 5))),
+                n=r.randint(1, 99999)
+            ).encode('utf-8')
+
+            f.write(data)
+            written += len(data)
+            lines += data.count('\n')
+
+    return lines
+
+
+def _referenceExtract(fmlPath, chatPath):
+    """
+    The original chat extractor, which decodes the log one line at a time through codecs.open,
+    runs every regular expression against every line, and writes each entry separately.
+    """
+
+    colourRegEx = re.compile(u'\x1b.+?m')
+    chatRegEx = re.compile(
+        ur'(?P<date>\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d)'
+        + ur' \[INFO\] \[(?:MyTown|Dynmap)\] (?P<username>.+?\:)'
+        + ur' (?P<message>.+)'
+    )
+    broadcastRegEx = re.compile(
+        ur'(?P<date>\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d)'
+        + ur' \[INFO\] \[Minecraft\-Server\] \[Server\]'
+        + ur' (?P<message>.+)'
+    )
+
+    with codecs.open(chatPath, mode='a', encoding='utf-8') as chatLog:
+        with codecs.open(fmlPath, mode='r', encoding='utf-8') as fmlLog:
+            fmlLine = fmlLog.readline()
+            match = re.match(ur'(\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d)', fmlLine)
+
+            if not match:
+                return
+
+            chatLog.write(u'''\n{date} {message:*^60}\n'''.format(
+                date=match.group(0),
+                message=u'Starting Minecraft server'
+            ))
+
+            fmlLine = fmlLog.readline()
+
+            while fmlLine:
+                fmlLine = colourRegEx.sub(u'', fmlLine)
+                match = chatRegEx.match(fmlLine)
+
+                if match:
+                    chatLog.write(u'{date} {username:>30} {message}\n'.format(
+                        date=match.group('date'),
+                        username=match.group('username'),
+                        message=match.group('message')
+                    ))
+
+                else:
+                    match = broadcastRegEx.match(fmlLine)
+
+                    if match:
+                        chatLog.write(u'{date} {username:>30} {message}\n'.format(
+                            date=match.group('date'),
+                            username=u'[Server]',
+                            message=match.group('message')
+                        ))
+
+                fmlLine = fmlLog.readline()
+
+
+def _fastExtract(fmlPath, chatPath):
+    import chatlog
+
+    with open(chatPath, 'ab') as chatLog:
+        with open(fmlPath, 'rb') as fmlLog:
+            chatlog.ChatExtractor().extractFile(fmlLog, chatLog)
+
+
+def _mappedExtract(fmlPath, chatPath):
+    import chatlog
+
+    with open(chatPath, 'ab') as chatLog:
+        with open(fmlPath, 'rb') as fmlLog:
+            chatlog.ChatExtractor().extractMapped(fmlLog, chatLog)
+
+
+# Maps the name of each chat extractor onto a function which appends the chat entries of the
+# log at fmlPath to the chatlog at chatPath.
+CHAT_EXTRACTORS = {
+    'reference': _referenceExtract,
+    'fast': _fastExtract,
+    'mmap': _mappedExtract
+}
+
+
+def chatExtraction(sizes, chatDensity, extractors):
+    """
+    Print the throughput of each chat extractor for synthetic logs of each size in megabytes.
+    """
+
+    directory = tempfile.mkdtemp(prefix='pycraft-benchmark-')
+
+    print('{:>8} {:>10} {:>10} {:>8} {:>12} {:>10}'.format(
+        'size MB', 'extractor', 'time (s)', 'MB/s', 'lines/s', 'identical'
+    ))
+
+    try:
+        for size in sizes:
+            fmlPath = os.path.join(directory, 'ForgeModLoader-server-1.log')
+            lines = _generateLog(fmlPath, size, chatDensity)
+            megabytes = os.path.getsize(fmlPath) / (1024.0 * 1024.0)
+
+            # The expected output of every extractor.
+            referencePath = os.path.join(directory, 'chatlog-expected.txt')
+            _referenceExtract(fmlPath, referencePath)
+
+            for name in extractors:
+                chatPath = os.path.join(directory, 'chatlog-{NAME}.txt'.format(NAME=name))
+
+                if os.path.exists(chatPath):
+                    os.remove(chatPath)
+
+                started = time.time()
+                CHAT_EXTRACTORS[name](fmlPath, chatPath)
+                duration = time.time() - started
+
+                with open(chatPath, 'rb') as a:
+                    with open(referencePath, 'rb') as b:
+                        identical = a.read() == b.read()
+
+                print('{:>8.1f} {:>10} {:>10.2f} {:>8.1f} {:>12.0f} {:>10}'.format(
+                    megabytes,
+                    name,
+                    duration,
+                    megabytes / duration,
+                    lines / duration,
+                    str(identical)
+                ))
+
+            os.remove(referencePath)
+
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pycraft benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    startupParser = subparsers.add_parser(
+        'startup',
+        help='Time to first server check against server count.'
+    )
+
+    startupParser.add_argument(
+        '--servers',
+        default='1,10,100,500',
+        help='Comma separated list of server counts to measure.'
+    )
+
+    startupParser.add_argument(
+        '--no-shared-scan',
+        action='store_true',
+        help='Scan the host\'s processes separately for every lookup, for comparison.'
+    )
+
+    chatlogParser = subparsers.add_parser(
+        'chatlog',
+        help='Chat extraction throughput against log size.'
+    )
+
+    chatlogParser.add_argument(
+        '--sizes',
+        default='10,100',
+        help='Comma separated list of log sizes in megabytes.'
+    )
+
+    chatlogParser.add_argument(
+        '--chat-density',
+        type=float,
+        default=0.05,
+        help='Fraction of log lines which are chat entries.'
+    )
+
+    chatlogParser.add_argument(
+        '--extractors',
+        default=','.join(sorted(CHAT_EXTRACTORS, reverse=True)),
+        help='Comma separated list of extractors to measure, from: '
+            + ', '.join(sorted(CHAT_EXTRACTORS))
+    )
+
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if arguments.benchmark == 'startup':
+        startup(
+            [int(count) for count in arguments.servers.split(',')],
+            not arguments.no_shared_scan
+        )
+
+    elif arguments.benchmark == 'chatlog':
+        chatExtraction(
+            [int(size) for size in arguments.sizes.split(',')],
+            arguments.chat_density,
+            arguments.extractors.split(',')
+        )
@@ -2,13 +2,428 @@
 # -*- coding: utf-8 -*-
 
 # Library modules
+import bisect
 import codecs
+import gzip
+import hashlib
+import heapq
+import json
 import logging
+import mmap
+import multiprocessing
+import os
+import Queue
 import re
+import select
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import zlib
 
 # Third-party modules
 import watchdog.events
 import watchdog.observers
+import watchdog.utils
+
+# Project modules
+import playerSessions
+
+try:
+    import watchdog.observers.inotify_c as inotify
+
+except (ImportError, OSError, watchdog.utils.UnsupportedLibc):
+    # Not Linux, FMLLogObserver falls back to a watchdog observer.
+    inotify = None
+
+
+# The chat rules used by servers which do not configure their own CHAT_RULES, in the form
+# stored by serverConfig: a tuple of (name, pattern, template, contains) for each rule.
+DEFAULT_CHAT_RULES = (
+    (
+        u'mytown',
+        ur'(?P<date>\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d) \[INFO\] \[MyTown\] (?P<username>.+?\:) (?P<message>.+)',
+        u'{date} {username:>30} {message}\n',
+        u' [INFO] [MyTown] '
+    ),
+    (
+        u'dynmap',
+        ur'(?P<date>\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d) \[INFO\] \[Dynmap\] (?P<username>.+?\:) (?P<message>.+)',
+        u'{date} {username:>30} {message}\n',
+        u' [INFO] [Dynmap] '
+    ),
+    (
+        u'broadcast',
+        ur'(?P<date>\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d) \[INFO\] \[Minecraft\-Server\] (?P<username>\[Server\]) (?P<message>.+)',
+        u'{date} {username:>30} {message}\n',
+        u' [INFO] [Minecraft-Server] [Server] '
+    )
+)
+
+# The chat rules used for the logs/latest.log of vanilla and Paper servers. Their lines are only
+# stamped with the time of day, so the templates use the day field, which is the day the line
+# was read on, or the day an archived log was started on.
+VANILLA_CHAT_RULES = (
+    (
+        u'chat',
+        ur'\[(?P<time>\d\d\:\d\d\:\d\d)(?:\] \[[^\]]+/| )INFO\]: <(?P<username>[^>]+)> (?P<message>.+)',
+        u'{day} {time} {username:>30} {message}\n',
+        u'INFO]: <'
+    ),
+    (
+        u'broadcast',
+        ur'\[(?P<time>\d\d\:\d\d\:\d\d)(?:\] \[[^\]]+/| )INFO\]: (?P<username>\[Server\]) (?P<message>.+)',
+        u'{day} {time} {username:>30} {message}\n',
+        u'INFO]: [Server] '
+    )
+)
+
+
+# Maps the path of each server onto the lock held while writing to its chatlog.txt.
+_chatlogLocks = {}
+_chatlogLocksLock = threading.Lock()
+
+
+def chatlogLock(SERVER_PATH):
+    """
+    Returns the lock which must be held while writing to the server's chatlog.txt, shared by
+    every object which writes to it.
+    """
+
+    SERVER_PATH = os.path.abspath(SERVER_PATH)
+
+    with _chatlogLocksLock:
+        if SERVER_PATH not in _chatlogLocks:
+            _chatlogLocks[SERVER_PATH] = threading.RLock()
+
+        return _chatlogLocks[SERVER_PATH]
+
+
+def adjustCheckpoint(SERVER_PATH, change):
+    """
+    A tailer's checkpoint records the size of chatlog.txt, which must be adjusted when anything
+    other than the tailer changes its size. Must be called with the chatlog lock held.
+    """
+
+    checkpointPath = SERVER_PATH + '/chatlog.checkpoint'
+
+    try:
+        with open(checkpointPath) as f:
+            checkpoint = json.load(f)
+
+    except (IOError, ValueError):
+        return
+
+    checkpoint['chatlogSize'] = max(0, checkpoint['chatlogSize'] + change)
+
+    with open(checkpointPath + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+
+    os.rename(checkpointPath + '.tmp', checkpointPath)
+
+
+class ChatExtractor:
+    """
+    Extracts chat entries from the lines of a ForgeModLoader server log, and formats them as
+    chatlog entries.
+
+    Each chat rule has a pattern, which is matched against a log line with its colour codes
+    removed, and a template, which formats the pattern's named groups as a chatlog entry. The
+    patterns of every rule are compiled into a single alternation, so each line is matched once
+    however many rules there are. The first rule to match a line is the one used.
+
+    Most lines of a log are not chat. If every rule gives a string which the lines it matches
+    must contain, any line without one of those strings is skipped before the regular
+    expression is run, unless it contains a colour code which might be hiding one.
+
+    Extractors hold no state between lines, so servers with identical rules share the
+    extractor returned by ChatExtractor.shared().
+    """
+
+    # Number of bytes of the log read at once by extractFile.
+    CHUNK_SIZE = 1024 * 1024
+
+    # Follows the date of the chatlog entry announcing that the server is starting.
+    # *^60 means 60 character wide column, with center aligned text, padded with asterisc
+    # characters
+    BANNER = u'{message:*^60}'.format(message=u'Starting Minecraft server')
+
+    # Number of chat entries written to the chatlog at once by extractFile and extractMapped.
+    BATCH_SIZE = 1000
+
+    # Maps each set of rules onto its shared extractor.
+    _shared = {}
+    _sharedLock = threading.Lock()
+
+
+    @staticmethod
+    def shared(rules=None):
+        """
+        Returns the extractor for rules, compiling it if no other server uses the same rules.
+        The default rules are used if rules is None.
+        """
+
+        if rules is None:
+            rules = DEFAULT_CHAT_RULES
+
+        with ChatExtractor._sharedLock:
+            if rules not in ChatExtractor._shared:
+                ChatExtractor._shared[rules] = ChatExtractor(rules)
+
+            return ChatExtractor._shared[rules]
+
+
+    def __init__(self, rules=DEFAULT_CHAT_RULES):
+        # Compile commonly used regular expressions
+        self.colourRegEx = re.compile(
+                u"""
+                \x1b        # UTF-8 character code point at start of colour code
+                .+?         # Match any characters apart from newline non-greedily
+                m           # Colour codes always terminate with m
+                """,
+            re.VERBOSE)
+
+        # Each rule's pattern becomes one branch of entryRegEx, wrapped in a group named after
+        # the rule's position, and its named groups are prefixed with the same name so that
+        # they are unique across the branches. A match's lastgroup is then the enclosing group
+        # of the rule which matched, as it is always the last group to close.
+        branches = []
+
+        # Maps each rule's group name onto a tuple of (template, fields), where fields is a
+        # list of (name in template, name in entryRegEx) for each of the rule's named groups.
+        self.rules = {}
+
+        for index, (name, pattern, template, contains) in enumerate(rules):
+            ruleGroup = u'_{INDEX}'.format(INDEX=index)
+
+            fields = [
+                (groupName, ruleGroup + u'_' + groupName)
+                for groupName in re.compile(pattern).groupindex
+            ]
+
+            # Rename (?P<name>...) groups and (?P=name) backreferences.
+            pattern = re.sub(
+                ur'(?<!\\)\(\?P([<=])(\w+)',
+                lambda match: u'(?P' + match.group(1) + ruleGroup + u'_' + match.group(2),
+                pattern
+            )
+
+            branches.append(u'(?P<{GROUP}>{PATTERN})'.format(GROUP=ruleGroup, PATTERN=pattern))
+            self.rules[ruleGroup] = (template, fields)
+
+        self.entryRegEx = re.compile(u'|'.join(branches))
+
+        # The strings which every chat entry contains one of, or None if any rule has no such
+        # string, in which case every line must be matched.
+        self.contains = None
+
+        if rules and all(contains for name, pattern, template, contains in rules):
+            self.contains = tuple(contains for name, pattern, template, contains in rules)
+
+        if self.contains is not None:
+            self.containsRegEx = re.compile(
+                u'|'.join(re.escape(contains) for contains in self.contains)
+            )
+
+            # Used by extractMapped to find the lines of an encoded log which might hold a chat
+            # entry. Each is a plain string search, which is much faster than matching every
+            # line.
+            self.encodedContainsRegEx = re.compile(
+                '|'.join(re.escape(contains.encode('utf-8')) for contains in self.contains)
+            )
+
+        self.escapeRegEx = re.compile('\x1b')
+
+
+    def header(self, fmlLine, date=None):
+        """
+        Returns the chatlog entry announcing that the server is starting, dated with the first
+        line of a log file, or None if the line has no date. Logs whose lines are only stamped
+        with the time of day, such as archived vanilla logs, can be given their date.
+        """
+
+        match = re.match(
+            ur'(\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d)',
+            fmlLine
+        )
+
+        if match:
+            fmlDate = match.group(0)
+
+        else:
+            match = re.match(ur'\[(\d\d\:\d\d\:\d\d)\]', fmlLine)
+
+            if match is None or date is None:
+                return None
+
+            fmlDate = date + u' ' + match.group(1)
+
+        # The first line appended to chatlog.txt should announce that the server is starting
+        return u'''\n{date} {banner}\n'''.format(
+            date=fmlDate,
+            banner=ChatExtractor.BANNER
+        )
+
+
+    def extract(self, fmlLine, day=None):
+        """
+        Returns the chatlog entry for one line of the log, or None if the line is not a chat
+        entry. day is given to the template as its day field, if the log has one.
+        """
+
+        if u'\x1b' in fmlLine:
+            # Remove colour codes from FMLLine
+            fmlLine = self.colourRegEx.sub(u'', fmlLine)
+
+        elif self.contains is not None and not self.containsRegEx.search(fmlLine):
+            return None
+
+        # Attempt to match every rule at once
+        match = self.entryRegEx.match(fmlLine)
+
+        if match:
+            template, fields = self.rules[match.lastgroup]
+
+            # Groups which did not take part in the match are left empty.
+            values = dict((name, match.group(group) or u'') for name, group in fields)
+            values.setdefault(u'day', day or u'')
+
+            return template.format(**values)
+
+        return None
+
+
+    def extractFile(self, fmlLog, chatLog, date=None):
+        """
+        Append the chat entries of a whole log file to the chatlog. Both files must be opened in
+        binary mode. The log is decoded in large chunks and split into lines just as
+        codecs.open would split them, and entries are written in batches. Nothing is appended if
+        the first line of the log has no date, and date is not given. date is also the day field
+        of every entry.
+        """
+
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        extract = self.extract
+
+        # The last line of each chunk may be incomplete, so it is carried over to the next.
+        carry = u''
+        first = True
+        batch = []
+
+        while True:
+            chunk = fmlLog.read(ChatExtractor.CHUNK_SIZE)
+            fmlLines = (carry + decoder.decode(chunk, not chunk)).splitlines(True)
+
+            if chunk and fmlLines:
+                carry = fmlLines.pop()
+
+            if first and fmlLines:
+                # Find the date and time from the first log entry
+                header = self.header(fmlLines[0], date)
+
+                if header is None:
+                    return
+
+                batch.append(header)
+                del fmlLines[0]
+                first = False
+
+            for fmlLine in fmlLines:
+                entry = extract(fmlLine, date)
+
+                if entry is not None:
+                    batch.append(entry)
+
+            if len(batch) >= ChatExtractor.BATCH_SIZE or not chunk:
+                chatLog.write(u''.join(batch).encode('utf-8'))
+                batch = []
+
+            if not chunk:
+                return
+
+
+    def _candidateLines(self, fmlMap, start):
+        """
+        Yields the offset of every line of the memory-mapped log after start which contains one
+        of the rules' strings or a colour code, in order and without repeats.
+        """
+
+        lastLine = None
+
+        # Both searches yield offsets in order, so merging them keeps the lines in order.
+        matches = heapq.merge(
+            (match.start() for match in self.encodedContainsRegEx.finditer(fmlMap, start)),
+            (match.start() for match in self.escapeRegEx.finditer(fmlMap, start))
+        )
+
+        for offset in matches:
+            line = fmlMap.rfind('\n', start - 1, offset) + 1
+
+            if line != lastLine:
+                lastLine = line
+                yield line
+
+
+    def extractMapped(self, fmlLog, chatLog):
+        """
+        Append the chat entries of a whole log file to the chatlog, like extractFile, but
+        without decoding the whole log. Both files must be opened in binary mode.
+
+        The log is memory-mapped and searched for the encoded strings of the rules and for
+        colour codes. Any line holding a chat entry must contain one or the other, so only those
+        lines are decoded, split and extracted exactly as extractFile would, and the output is
+        identical. If any rule has no string, the whole log is extracted by extractFile instead.
+        """
+
+        if self.contains is None:
+            return self.extractFile(fmlLog, chatLog)
+
+        try:
+            fmlMap = mmap.mmap(fmlLog.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except ValueError:
+            # The log is empty.
+            return
+
+        try:
+            end = fmlMap.find('\n') + 1 or len(fmlMap)
+            fmlLines = fmlMap[:end].decode('utf-8', 'replace').splitlines(True)
+
+            # Find the date and time from the first log entry
+            header = self.header(fmlLines[0])
+
+            if header is None:
+                return
+
+            batch = [header]
+            extract = self.extract
+
+            # The first line may have been split into several, if it contains a character which
+            # codecs.open treats as a line break.
+            for fmlLine in fmlLines[1:]:
+                entry = extract(fmlLine)
+
+                if entry is not None:
+                    batch.append(entry)
+
+            for line in self._candidateLines(fmlMap, end):
+                lineEnd = fmlMap.find('\n', line) + 1 or len(fmlMap)
+
+                for fmlLine in fmlMap[line:lineEnd].decode('utf-8', 'replace').splitlines(True):
+                    entry = extract(fmlLine)
+
+                    if entry is not None:
+                        batch.append(entry)
+
+                if len(batch) >= ChatExtractor.BATCH_SIZE:
+                    chatLog.write(u''.join(batch).encode('utf-8'))
+                    batch = []
+
+            chatLog.write(u''.join(batch).encode('utf-8'))
+
+        finally:
+            fmlMap.close()
 
 
 class FMLLogHandler(watchdog.events.PatternMatchingEventHandler):
@@ -18,9 +433,13 @@ class FMLLogHandler(watchdog.events.PatternMatchingEventHandler):
     ForgeModLoader-server-0.log file to ForgeModLoader-server-1.log during
     startup, this class will handle the event by extracting all chat logs from
     the file and saving them in chatlog.txt.
+
+    The rotated log is opened as soon as the event arrives, so that it is the right file even
+    if the server rotates its logs again, and the extraction itself is passed to submit to be
+    run by one of the FMLLogObserver's workers.
     """
 
-    def __init__(self, SERVER_NICK, SERVER_PATH):
+    def __init__(self, SERVER_NICK, SERVER_PATH, CHAT_RULES, submit, ENABLE_SESSIONS=False):
         logging.info(
             'Initialising FMLLogHandler for {SERVER_NICK} server.'.format(
                 SERVER_NICK=SERVER_NICK
@@ -37,36 +456,17 @@ class FMLLogHandler(watchdog.events.PatternMatchingEventHandler):
             patterns=[self.SERVER_PATH + '/ForgeModLoader-server-0.log']
         )
 
-        # Compile commonly used regular expressions
-        self.colourRegEx = re.compile(
-                u"""
-                \x1b        # UTF-8 character code point at start of colour code
-                .+?         # Match any characters apart from newline non-greedily
-                m           # Colour codes always terminate with m
-                """,
-            re.VERBOSE)
-
-        self.chatRegEx = re.compile(
-                ur"""
-                # Capture the date and time of message
-                (?P<date>\d\d\d\d-\d\d-\d\d\ \d\d\:\d\d\:\d\d)
+        # Extracts chat entries from each line of the log, shared with every server that has
+        # the same chat rules.
+        self.extractor = ChatExtractor.shared(CHAT_RULES)
 
-                # Capture the user name and prefix of the user
-                # (?:...) syntax for a non-capturing group, useful with the | operator
-                # A|B match either regex A or regex B
-                # .+? will match any characters apart from newline non-greedily
-                \ \[INFO\]\ \[(?:MyTown|Dynmap)\]\ (?P<username>.+?\:)
-
-                # Capture the chat message
-                \ (?P<message>.+)""",
-            re.VERBOSE
-        )
+        # Extracts players joining and leaving, if the server records their sessions.
+        if ENABLE_SESSIONS:
+            self.sessionExtractor = playerSessions.SessionExtractor(playerSessions.FML_SESSION_RULES)
+        else:
+            self.sessionExtractor = None
 
-        self.broadcastRegEx = re.compile(
-            ur'(?P<date>\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d)'
-            + ur' \[INFO\] \[Minecraft\-Server\] \[Server\]'
-            + ur' (?P<message>.+)'
-        )
+        self._submit = submit
 
 
     def on_moved(self, event):
@@ -82,118 +482,2641 @@ class FMLLogHandler(watchdog.events.PatternMatchingEventHandler):
         """
 
         if event.dest_path == self.SERVER_PATH + '/ForgeModLoader-server-1.log':
+            self.rotated()
+
+
+    def rotated(self):
+        """
+        Called when ForgeModLoader-server-0.log has been moved to ForgeModLoader-server-1.log.
+        """
+
+        try:
+            fmlLog = open(self.SERVER_PATH + '/ForgeModLoader-server-1.log', 'rb')
+
+        except IOError as e:
+            logging.error(
+                'Could not open rotated log of {SERVER_NICK} server: {ERROR}'.format(
+                    SERVER_NICK=self.SERVER_NICK,
+                    ERROR=e
+                )
+            )
+
+            return
+
+        self._submit(lambda: self._extract(fmlLog))
+
+
+    def _extract(self, fmlLog):
+        # Two rotations in quick succession are appended to the chatlog one after the other.
+        with chatlogLock(self.SERVER_PATH):
             logging.info(
                 'Appending to chatlog for {SERVER_NICK} server.'.format(
                     SERVER_NICK=self.SERVER_NICK
                 )
             )
 
-            with codecs.open(
-                self.SERVER_PATH + '/chatlog.txt',
-                mode='a',
-                encoding='utf-8'
-            ) as chatLog:
+            try:
+                with open(self.SERVER_PATH + '/chatlog.txt', 'ab') as chatLog:
+                    self.extractor.extractMapped(fmlLog, chatLog)
 
-                with codecs.open(
-                    self.SERVER_PATH + '/ForgeModLoader-server-1.log',
-                    mode='r',
-                    encoding='utf-8'
-                ) as fmlLog:
+                if self.sessionExtractor is not None:
+                    playerSessions.sessionStore(self.SERVER_PATH).append(
+                        self.sessionExtractor.extractMapped(fmlLog)
+                    )
 
-                    fmlLine = fmlLog.readline()
+            finally:
+                fmlLog.close()
 
-                    if fmlLine:
-                        # Find the date and time from the first log entry
+            chatIndex(self.SERVER_PATH).update()
 
-                        match = re.match(
-                            ur'(\d\d\d\d-\d\d-\d\d \d\d\:\d\d\:\d\d)',
-                            fmlLine
-                        )
+            logging.info(
+                'Completed extracting chat entries for {SERVER_NICK} server.'.format(
+                    SERVER_NICK=self.SERVER_NICK
+                )
+            )
 
-                        if match:
-                            # The first line appended to chatlog.txt should announce that the server is starting
-                            # *^60 means 60 character wide column, with center aligned text, padded with asterisc
-                            # characters
 
-                            chatLog.write(u'''\n{date} {message:*^60}\n'''.format(
-                                    date=match.group(0),
-                                    message=u'Starting Minecraft server'
-                                )
-                            )
+class FMLLogObserver(threading.Thread):
+    """
+    Watches the directories of every server which extracts its chatlog when the log is rotated,
+    and hands each rotated log to a bounded pool of workers to be extracted. Event handling
+    never waits for an extraction, so a slow extraction on one server cannot delay another
+    server's events.
 
-                            # Continue parsing fmlLog until we meet end of file
+    On Linux, every directory is watched by a single inotify instance read by this thread. On
+    other platforms a single watchdog observer is used instead, with every directory scheduled
+    on it.
 
-                            fmlLine = fmlLog.readline()
+    Public methods:
+        watch(SERVER_NICK, SERVER_PATH, CHAT_RULES)
+        start()
+        stop()
+    """
 
-                            while fmlLine:
-                                # Remove colour codes from FMLLine
-                                fmlLine = self.colourRegEx.sub(u'', fmlLine)
+    # Number of seconds between checks for stop() while no events arrive.
+    POLL_INTERVAL = 1
 
-                                # Attempt to match MyTown or Dynmap chat entry
-                                match = self.chatRegEx.match(fmlLine)
+    # Name of the file which a rotated ForgeModLoader-server-0.log is moved to.
+    ROTATED_LOG = 'ForgeModLoader-server-1.log'
 
-                                if match:
 
-                                    # Use string formatting to create a username and prefix column,
-                                    # 30 characters wide with right hand text alignment
-                                    chatLog.write(u'{date} {username:>30} {message}\n'.format(
-                                            date=match.group('date'),
-                                            username=match.group('username'),
-                                            message=match.group('message')
-                                        )
-                                    )
+    def __init__(self, workers):
+        super(FMLLogObserver, self).__init__(name='Thread-PycraftFMLLogObserver')
 
-                                    fmlLine = fmlLog.readline()
-                                    continue
+        logging.info(
+            'Initialising FMLLogObserver with {WORKERS} worker(s).'.format(
+                WORKERS=workers
+            )
+        )
 
-                                # Attempt to match console broadcast
-                                match = self.broadcastRegEx.match(fmlLine)
+        self.daemon = True
 
-                                if match:
-                                    chatLog.write(u'{date} {username:>30} {message}\n'.format(
-                                            date=match.group('date'),
-                                            username=u'[Server]',
-                                            message=match.group('message')
-                                        )
-                                    )
+        # Maps the absolute path of each watched directory onto its FMLLogHandler.
+        self._handlers = {}
 
-                                fmlLine = fmlLog.readline()
+        # Extractions waiting for a worker. None tells a worker to exit.
+        self._jobs = Queue.Queue()
 
-            logging.info(
-                'Completed extracting chat entries for {SERVER_NICK} server.'.format(
-                    SERVER_NICK=self.SERVER_NICK
-                )
+        self._workers = [
+            threading.Thread(
+                target=self._work,
+                name='Thread-PycraftFMLLogWorker-{INDEX}'.format(INDEX=index)
             )
+            for index in range(max(1, workers))
+        ]
 
+        for worker in self._workers:
+            worker.daemon = True
 
-class FMLLogObserver(watchdog.observers.Observer):
-    """
-    Observe the file system, and call the FmlLogHandler methods to handle the event when the Minecraft
-    logs are rolled.
-    """
+        self._stopping = threading.Event()
 
-    def __init__(self, SERVER_NICK, SERVER_PATH):
+
+    def watch(self, SERVER_NICK, SERVER_PATH, CHAT_RULES=None, ENABLE_SESSIONS=False):
+        """
+        Extract the chat entries, and the player sessions if ENABLE_SESSIONS is True, of the
+        server's logs when they are rotated. Must be called before start().
+        """
+
+        self._handlers[os.path.abspath(SERVER_PATH)] = FMLLogHandler(
+            SERVER_NICK,
+            SERVER_PATH,
+            CHAT_RULES,
+            self._jobs.put,
+            ENABLE_SESSIONS
+        )
+
+
+    def stop(self):
+        self._stopping.set()
+
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+
+            if job is None:
+                return
+
+            # Any error, including a bug in an extractor, is logged and the worker carries on, as
+            # the pool would otherwise shrink until rotated logs stopped being extracted.
+            try:
+                job()
+
+            except Exception:
+                logging.exception('Error while extracting chat entries.')
+
+
+    def _watchInotify(self):
+        """
+        Read events for every watched directory from one inotify instance, until stopped.
+        """
+
+        instance = None
+
+        for path, handler in sorted(self._handlers.iteritems()):
+            try:
+                if instance is None:
+                    instance = inotify.Inotify(
+                        path,
+                        event_mask=inotify.InotifyConstants.IN_MOVED_TO
+                    )
+
+                else:
+                    instance.add_watch(path)
+
+            except OSError as e:
+                logging.error(
+                    'Could not watch logs of {SERVER_NICK} server: {ERROR}'.format(
+                        SERVER_NICK=handler.SERVER_NICK,
+                        ERROR=e
+                    )
+                )
+
+        if instance is None:
+            self._stopping.wait()
+            return
+
+        try:
+            while not self._stopping.is_set():
+                readable = select.select([instance.fd], [], [], FMLLogObserver.POLL_INTERVAL)[0]
+
+                if not readable:
+                    continue
+
+                for event in instance.read_events():
+                    if event.is_moved_to and event.name == FMLLogObserver.ROTATED_LOG:
+                        handler = self._handlers.get(os.path.dirname(event.src_path))
+
+                        if handler is not None:
+                            handler.rotated()
+
+        finally:
+            instance.close()
+
+
+    def _watchObserver(self):
         """
-        Configure the observer so that all the main execution module needs to do is call this class's start()
-        method to launch the observer in a new thread.
+        Schedule every watched directory on one watchdog observer, until stopped.
         """
 
+        observer = watchdog.observers.Observer()
+
+        for path, handler in sorted(self._handlers.iteritems()):
+            if not os.path.isdir(path):
+                logging.error(
+                    'Could not watch logs of {SERVER_NICK} server: {PATH} is not a directory.'.format(
+                        SERVER_NICK=handler.SERVER_NICK,
+                        PATH=path
+                    )
+                )
+
+                continue
+
+            observer.schedule(handler, handler.SERVER_PATH)
+
+        observer.start()
+        self._stopping.wait()
+        observer.stop()
+        observer.join()
+
+
+    def run(self):
+        for worker in self._workers:
+            worker.start()
+
+        try:
+            if inotify is not None:
+                self._watchInotify()
+
+            else:
+                self._watchObserver()
+
+        finally:
+            # Let the workers finish the extractions which have already been submitted.
+            for worker in self._workers:
+                self._jobs.put(None)
+
+            for worker in self._workers:
+                worker.join()
+
+
+class FMLLogTailer(threading.Thread):
+    """
+    Follows the live ForgeModLoader-server-0.log file, extracting chat entries to chatlog.txt
+    within a second of them being logged, instead of waiting for the log to be rotated when the
+    server next starts.
+
+    The file being followed is identified by its inode, so reading continues from the right
+    place when the log is rotated to ForgeModLoader-server-1.log, and a truncated log is read
+    again from the start. Entries are appended to chatlog.txt by the tailer's ChatlogWriter.
+    After every batch of lines, the inode and offset which have been read up to are passed to
+    the writer, which saves them to chatlog.checkpoint along with the size of chatlog.txt once
+    the entries before them have been written. When Pycraft is restarted, chatlog.txt is
+    truncated back to the checkpointed size and reading resumes from the checkpointed offset,
+    so no entry is ever written twice or lost.
+    """
+
+    # Number of seconds between checks of the live log for new lines.
+    POLL_INTERVAL = 0.5
+
+    # Maximum number of bytes read from the log at once.
+    CHUNK_SIZE = 1024 * 1024
+
+    # The chat rules used if the server does not configure CHAT_RULES.
+    DEFAULT_CHAT_RULES = DEFAULT_CHAT_RULES
+
+    # The rules for players joining and leaving.
+    SESSION_RULES = playerSessions.FML_SESSION_RULES
+
+
+    def __init__(self, SERVER_NICK, SERVER_PATH, CHAT_RULES=None, CHATLOG_FSYNC='none',
+            ENABLE_SESSIONS=False):
+        super(FMLLogTailer, self).__init__(
+            name='Thread-Pycraft{CLASS}-{SERVER_NICK}'.format(
+                CLASS=self.__class__.__name__,
+                SERVER_NICK=SERVER_NICK
+            )
+        )
+
         logging.info(
-            'Initialising FMLLogObserver for {SERVER_NICK} server.'.format(
+            'Initialising {CLASS} for {SERVER_NICK} server.'.format(
+                CLASS=self.__class__.__name__,
                 SERVER_NICK=SERVER_NICK
             )
         )
 
-        # Used for logging purposes
+        self.daemon = True
+
         self.SERVER_NICK = SERVER_NICK
+        self.SERVER_PATH = SERVER_PATH
+
+        self.chatLogPath = SERVER_PATH + '/chatlog.txt'
+        self.checkpointPath = SERVER_PATH + '/chatlog.checkpoint'
+
+        self.extractor = ChatExtractor.shared(
+            self.DEFAULT_CHAT_RULES if CHAT_RULES is None else CHAT_RULES
+        )
+
+        self.writer = ChatlogWriter(SERVER_NICK, SERVER_PATH, CHATLOG_FSYNC)
+
+        if ENABLE_SESSIONS:
+            self.sessionExtractor = playerSessions.SessionExtractor(self.SESSION_RULES)
+        else:
+            self.sessionExtractor = None
+
+        self._stopping = threading.Event()
+
+        # The log file currently being followed, its inode, and the offset of the first byte
+        # which has not yet been read.
+        self._fmlLog = None
+        self._inode = None
+        self._offset = 0
+
+        # The day field of entries from logs whose lines have no date, or None.
+        self._day = None
+
+
+    def stop(self):
+        self._stopping.set()
+
+
+    def metrics(self):
+        return self.writer.metrics()
+
+
+    def _logPath(self, index):
+        return '{SERVER_PATH}/ForgeModLoader-server-{INDEX}.log'.format(
+            SERVER_PATH=self.SERVER_PATH,
+            INDEX=index
+        )
+
+
+    def _findLog(self, inode):
+        """
+        Returns the index of the rotated log file which has the inode, or None if no log file
+        has it.
+        """
+
+        index = 0
+
+        while os.path.exists(self._logPath(index)):
+            try:
+                if os.stat(self._logPath(index)).st_ino == inode:
+                    return index
+
+            except OSError:
+                pass
+
+            index += 1
+
+        return None
+
+
+    def _open(self, index, offset):
+        """
+        Begin following the log file with the index, from offset.
+        """
+
+        if self._fmlLog is not None:
+            self._fmlLog.close()
+            self._fmlLog = None
+
+        try:
+            # Unbuffered, as a buffered file may serve a seek back to the start of a truncated
+            # log from bytes it read before the truncation. Reads are large anyway.
+            self._fmlLog = open(self._logPath(index), 'rb', 0)
+
+        except IOError:
+            # The live log has not been created yet.
+            self._inode = None
+            return
+
+        self._inode = os.fstat(self._fmlLog.fileno()).st_ino
+        self._offset = offset
+        self._fmlLog.seek(offset)
+
+
+    def _readCheckpoint(self):
+        try:
+            with open(self.checkpointPath) as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return None
+
+
+    def _checkpoint(self):
+        """
+        Returns the checkpoint of the position reached in the log, to which the writer adds the
+        size of chatlog.txt.
+        """
+
+        return {
+            'inode': self._inode,
+            'offset': self._offset
+        }
+
+
+    def _restore(self, chatLog):
+        """
+        Resume from the checkpoint if there is one, or else begin following the live log from
+        its start.
+        """
+
+        checkpoint = self._readCheckpoint()
+        index = None
+
+        if checkpoint is not None:
+            # Discard entries written after the checkpoint, they will be extracted again.
+            if os.fstat(chatLog.fileno()).st_size > checkpoint['chatlogSize']:
+                chatLog.truncate(checkpoint['chatlogSize'])
+
+            index = self._findLog(checkpoint['inode'])
+
+        if index is None:
+            self._open(0, 0)
+
+        else:
+            logging.info(
+                'Resuming chatlog for {SERVER_NICK} server from {PATH}, offset {OFFSET}.'.format(
+                    SERVER_NICK=self.SERVER_NICK,
+                    PATH=self._logPath(index),
+                    OFFSET=checkpoint['offset']
+                )
+            )
+
+            self._open(index, checkpoint['offset'])
+
+
+    def _readLines(self, chatLog):
+        """
+        Extract the chat entries from every complete line which has been appended to the log
+        being followed. Returns True if any lines were read.
+        """
+
+        read = False
+
+        while True:
+            chunk = self._fmlLog.read(FMLLogTailer.CHUNK_SIZE)
+            end = chunk.rfind('\n') + 1
+
+            if end == 0:
+                if len(chunk) < FMLLogTailer.CHUNK_SIZE:
+                    # Only part of a line has been written so far, read it again next time.
+                    self._fmlLog.seek(self._offset)
+                    return read
+
+                # An extremely long line, treat the chunk as one line.
+                end = len(chunk)
+
+            self._extractLines(chatLog, chunk[:end])
+
+            read = True
+
+            if end < len(chunk):
+                self._fmlLog.seek(self._offset)
+
+
+    def _extractLines(self, chatLog, lines):
+        """
+        Extract the chat entries and session events from lines, which begin at self._offset in
+        the log, and advance self._offset past them.
+        """
+
+        events = []
+
+        for fmlLine in lines.splitlines(True):
+            if self._offset == 0:
+                # The first line of every log file announces that the server is starting.
+                entry = self.extractor.header(fmlLine.decode('utf-8', 'replace'), self._day)
+
+                if self.sessionExtractor is not None:
+                    events.append(self.sessionExtractor.header(fmlLine, self._day))
+
+            else:
+                entry = self.extractor.extract(fmlLine.decode('utf-8', 'replace'), self._day)
+
+                if self.sessionExtractor is not None:
+                    events.append(self.sessionExtractor.extract(fmlLine, self._day))
+
+            if entry is not None:
+                chatLog.write(entry.encode('utf-8'))
+
+            self._offset += len(fmlLine)
+
+        events = [event for event in events if event is not None]
+
+        if events:
+            playerSessions.sessionStore(self.SERVER_PATH).append(events)
+
+
+    def _poll(self, chatLog):
+        """
+        Read any new lines from the log being followed, moving on to the next log file if it
+        has been rotated, then save a checkpoint if anything was read.
+        """
+
+        read = False
+
+        while True:
+            if self._fmlLog is None:
+                self._open(0, 0)
+
+                if self._fmlLog is None:
+                    return
+
+            read = self._readLines(chatLog) or read
+
+            try:
+                live = os.stat(self._logPath(0))
+
+            except OSError:
+                live = None
+
+            if live is not None and live.st_ino == self._inode:
+                if live.st_size < self._offset:
+                    logging.info(
+                        'Live log of {SERVER_NICK} server was truncated.'.format(
+                            SERVER_NICK=self.SERVER_NICK
+                        )
+                    )
+
+                    self._offset = 0
+                    self._fmlLog.seek(0)
+                    continue
+
+                break
+
+            if live is None:
+                # The log is in the middle of being rotated, wait for the new live log.
+                break
+
+            # The file being followed has been rotated, and has now been read to its end. Move on
+            # to the next newer log file, or to the live log if it was the newest.
+            index = self._findLog(self._inode)
+
+            logging.info(
+                'Log of {SERVER_NICK} server was rotated, following the next log file.'.format(
+                    SERVER_NICK=self.SERVER_NICK
+                )
+            )
+
+            self._open(index - 1 if index else 0, 0)
+
+        if read:
+            chatLog.checkpoint(self._checkpoint())
+
+
+    def run(self):
+        self.writer.start()
+
+        try:
+            # Entries caught up on while restoring are written directly, before any are queued.
+            with chatlogLock(self.SERVER_PATH):
+                with open(self.chatLogPath, 'ab') as chatLog:
+                    self._restore(chatLog)
+
+            while not self._stopping.is_set():
+                try:
+                    self._poll(self.writer)
+
+                except (IOError, OSError):
+                    logging.exception(
+                        'Error while following the log of {SERVER_NICK} server.'.format(
+                            SERVER_NICK=self.SERVER_NICK
+                        )
+                    )
+
+                self._stopping.wait(FMLLogTailer.POLL_INTERVAL)
+
+        finally:
+            # The writer writes out every entry which is still queued before it stops.
+            self.writer.stop()
+            self.writer.join()
+
+            if self._fmlLog is not None:
+                self._fmlLog.close()
+
+
+class ChatlogWriter(threading.Thread):
+    """
+    Appends a tailer's chat entries to chatlog.txt in the background, so that each entry is
+    not a separate small write to a disk shared with the servers' worlds.
+
+    Entries are queued in memory, and written out in one batch once FLUSH_SIZE bytes are queued
+    or FLUSH_INTERVAL seconds have passed. Each batch is written with the chatlog lock held,
+    reopening chatlog.txt first if it has been rolled or backfilled. A checkpoint passed to the
+    writer is saved once every entry queued before it has been written, with the size which
+    chatlog.txt had at that point.
+
+    The fsync policy decides how durable written entries are:
+        none        Entries are left to the operating system to write to disk.
+        interval    chatlog.txt is synced at most once every FSYNC_INTERVAL seconds.
+        batch       chatlog.txt is synced after every batch, before its checkpoint is saved,
+                    so a checkpoint never refers to entries lost in a power failure.
+
+    Public methods:
+        write(data)
+        checkpoint(checkpoint)
+        metrics()
+        start()
+        stop()
+    """
+
+    # Number of queued bytes which are written out at once.
+    FLUSH_SIZE = 64 * 1024
+
+    # Maximum number of seconds an entry is queued for.
+    FLUSH_INTERVAL = 0.5
+
+    # Minimum number of seconds between syncs with the interval policy.
+    FSYNC_INTERVAL = 5
+
+
+    def __init__(self, SERVER_NICK, SERVER_PATH, CHATLOG_FSYNC='none'):
+        super(ChatlogWriter, self).__init__(
+            name='Thread-PycraftChatlogWriter-{SERVER_NICK}'.format(SERVER_NICK=SERVER_NICK)
+        )
+
+        self.daemon = True
+
+        self.SERVER_NICK = SERVER_NICK
+        self.SERVER_PATH = SERVER_PATH
+        self.CHATLOG_FSYNC = CHATLOG_FSYNC
+
+        self.chatLogPath = SERVER_PATH + '/chatlog.txt'
+        self.checkpointPath = SERVER_PATH + '/chatlog.checkpoint'
+
+        # Held while queueing, and notified when FLUSH_SIZE bytes are queued or when stopping.
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        # The queued entries and their total size, and the latest checkpoint passed to the
+        # writer along with the number of queued bytes which precede it, or None.
+        self._queue = []
+        self._queueSize = 0
+        self._pendingCheckpoint = None
+
+        self._chatLog = None
+        self._synced = time.time()
+        self._unsynced = False
+
+        self._flushes = 0
+        self._fsyncs = 0
+        self._bytesWritten = 0
+        self._lastFlushLatency = 0.0
+        self._maxFlushLatency = 0.0
+        self._totalFlushLatency = 0.0
+
+
+    def write(self, data):
+        """
+        Queue encoded chat entries to be appended to chatlog.txt.
+        """
+
+        with self._condition:
+            self._queue.append(data)
+            self._queueSize += len(data)
+
+            if self._queueSize >= ChatlogWriter.FLUSH_SIZE:
+                self._condition.notify()
+
+
+    def checkpoint(self, checkpoint):
+        """
+        Save the checkpoint dictionary once every entry queued so far has been written, adding
+        the size of chatlog.txt to it. Only the latest checkpoint is saved.
+        """
+
+        with self._condition:
+            self._pendingCheckpoint = (checkpoint, self._queueSize)
+
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+
+    def metrics(self):
+        """
+        Returns a dictionary of the number of entries and bytes queued, and of the batches
+        written so far. Latencies are the milliseconds taken to write and sync a batch.
+        """
+
+        with self._condition:
+            return {
+                'queuedEntries': len(self._queue),
+                'queuedBytes': self._queueSize,
+                'flushes': self._flushes,
+                'fsyncs': self._fsyncs,
+                'bytesWritten': self._bytesWritten,
+                'lastFlushLatency': self._lastFlushLatency * 1000,
+                'maxFlushLatency': self._maxFlushLatency * 1000,
+                'meanFlushLatency': self._totalFlushLatency * 1000 / (self._flushes or 1)
+            }
+
+
+    def _reopen(self):
+        """
+        Open chatlog.txt, unless it is already open and has not been replaced since, for
+        example by a roll or a backfill.
+        """
+
+        if self._chatLog is not None:
+            try:
+                if os.stat(self.chatLogPath).st_ino == os.fstat(self._chatLog.fileno()).st_ino:
+                    return
+
+            except OSError:
+                pass
+
+            # Entries written to the replaced file are synced as if it were still open.
+            if self.CHATLOG_FSYNC != 'none':
+                self._sync(True)
+
+            self._chatLog.close()
+
+        self._chatLog = open(self.chatLogPath, 'ab')
+
+
+    def _sync(self, force):
+        if self._unsynced and (force or time.time() - self._synced >= ChatlogWriter.FSYNC_INTERVAL):
+            os.fsync(self._chatLog.fileno())
+
+            self._synced = time.time()
+            self._unsynced = False
+            self._fsyncs += 1
+
+
+    def _flush(self, data, pending):
+        """
+        Append data to chatlog.txt, then save the pending checkpoint if there is one.
+        """
+
+        with chatlogLock(self.SERVER_PATH):
+            self._reopen()
+
+            size = os.fstat(self._chatLog.fileno()).st_size
+
+            if data:
+                self._chatLog.write(data)
+                self._chatLog.flush()
+                self._unsynced = True
+
+            if self.CHATLOG_FSYNC != 'none':
+                self._sync(self.CHATLOG_FSYNC == 'batch')
+
+            if pending is not None:
+                checkpoint, before = pending
+                checkpoint['chatlogSize'] = size + before
+
+                # Replace the checkpoint atomically, so that it is never left half written.
+                with open(self.checkpointPath + '.tmp', 'w') as f:
+                    json.dump(checkpoint, f)
+
+                os.rename(self.checkpointPath + '.tmp', self.checkpointPath)
+
+            if data:
+                chatIndex(self.SERVER_PATH).update()
+
+
+    def run(self):
+        try:
+            while True:
+                with self._condition:
+                    if not self._stopping and self._queueSize < ChatlogWriter.FLUSH_SIZE:
+                        self._condition.wait(ChatlogWriter.FLUSH_INTERVAL)
+
+                    stopping = self._stopping
+
+                    data = ''.join(self._queue)
+                    pending = self._pendingCheckpoint
+
+                    self._queue = []
+                    self._queueSize = 0
+                    self._pendingCheckpoint = None
+
+                if data or pending is not None or (self._unsynced and self.CHATLOG_FSYNC == 'interval'):
+                    started = time.time()
+
+                    try:
+                        self._flush(data, pending)
+
+                    except (IOError, OSError):
+                        logging.exception(
+                            'Error while writing chatlog of {SERVER_NICK} server.'.format(
+                                SERVER_NICK=self.SERVER_NICK
+                            )
+                        )
+
+                        # Queue the batch again in front of anything queued since, and retry.
+                        with self._condition:
+                            self._queue.insert(0, data)
+                            self._queueSize += len(data)
+
+                            if self._pendingCheckpoint is not None:
+                                checkpoint, before = self._pendingCheckpoint
+                                self._pendingCheckpoint = (checkpoint, before + len(data))
+                            else:
+                                self._pendingCheckpoint = pending
+
+                        if stopping:
+                            return
+
+                        time.sleep(ChatlogWriter.FLUSH_INTERVAL)
+                        continue
+
+                    if data:
+                        latency = time.time() - started
+
+                        with self._condition:
+                            self._flushes += 1
+                            self._bytesWritten += len(data)
+                            self._lastFlushLatency = latency
+                            self._maxFlushLatency = max(self._maxFlushLatency, latency)
+                            self._totalFlushLatency += latency
+
+                if stopping:
+                    return
+
+        finally:
+            if self._chatLog is not None:
+                self._chatLog.close()
+
+
+class LatestLogTailer(FMLLogTailer):
+    """
+    Follows logs/latest.log of a vanilla or Paper server, in the same way as FMLLogTailer.
+
+    These servers rotate latest.log by compressing it into logs/YYYY-MM-DD-N.log.gz and starting
+    a new latest.log. While Pycraft is running, the old latest.log is still open when it is
+    replaced, so its last lines are read from it before following the new log. If lines may
+    have been missed, because the log was rotated while Pycraft was not running or was
+    truncated in place, they are read from the archive instead. The archive is found by the
+    checkpointed fingerprint of the log's first bytes, and is decompressed as it is read, from
+    the checkpointed offset onwards.
+    """
+
+    DEFAULT_CHAT_RULES = VANILLA_CHAT_RULES
+
+    SESSION_RULES = playerSessions.VANILLA_SESSION_RULES
+
+    # Number of bytes from the start of a log which identify it once it has been archived.
+    FINGERPRINT_SIZE = 1024
+
+
+    def __init__(self, SERVER_NICK, SERVER_PATH, CHAT_RULES=None, CHATLOG_FSYNC='none',
+            ENABLE_SESSIONS=False):
+        super(LatestLogTailer, self).__init__(
+            SERVER_NICK,
+            SERVER_PATH,
+            CHAT_RULES,
+            CHATLOG_FSYNC,
+            ENABLE_SESSIONS
+        )
+
+        self.latestPath = SERVER_PATH + '/logs/latest.log'
+
+        # A tuple of (size, digest) identifying the log being followed by its first bytes, or
+        # None if nothing has been read from it yet.
+        self._fingerprint = None
+
+
+    def _openLatest(self, offset):
+        """
+        Begin following latest.log from offset. Returns False if it does not exist.
+        """
+
+        if self._fmlLog is not None:
+            self._fmlLog.close()
+            self._fmlLog = None
+
+        self._fingerprint = None
+
+        try:
+            # Unbuffered, for the same reason as in FMLLogTailer._open.
+            self._fmlLog = open(self.latestPath, 'rb', 0)
+
+        except IOError:
+            self._inode = None
+            return False
+
+        self._inode = os.fstat(self._fmlLog.fileno()).st_ino
+        self._offset = offset
+        self._fmlLog.seek(offset)
+
+        return True
+
+
+    def _readFingerprint(self, fmlLog, size):
+        fmlLog.seek(0)
+        return hashlib.sha1(fmlLog.read(size)).hexdigest()
+
+
+    def _updateFingerprint(self):
+        size = min(LatestLogTailer.FINGERPRINT_SIZE, self._offset)
+
+        if size and (self._fingerprint is None or self._fingerprint[0] < size):
+            self._fingerprint = (size, self._readFingerprint(self._fmlLog, size))
+            self._fmlLog.seek(self._offset)
+
+
+    def _unchanged(self):
+        """
+        Returns False if the first bytes of the log being followed no longer match its
+        fingerprint, because it has been truncated and written to again since the last poll.
+        """
+
+        if self._fingerprint is None:
+            return True
+
+        size, digest = self._fingerprint
+        unchanged = self._readFingerprint(self._fmlLog, size) == digest
+        self._fmlLog.seek(self._offset)
+
+        return unchanged
+
+
+    def _checkpoint(self):
+        self._updateFingerprint()
+
+        checkpoint = super(LatestLogTailer, self)._checkpoint()
+        checkpoint['fingerprint'] = self._fingerprint
+
+        return checkpoint
+
+
+    def _findArchive(self, fingerprint):
+        """
+        Returns a tuple of (path, date) for the archived log with the fingerprint, or None.
+        """
+
+        try:
+            names = [
+                name for name in os.listdir(self.SERVER_PATH + '/logs')
+                if ChatlogBackfill.ARCHIVE_REGEX.match(name)
+            ]
+
+        except OSError:
+            return None
+
+        # The log being looked for was most likely archived recently.
+        paths = sorted(
+            (self.SERVER_PATH + '/logs/' + name for name in names),
+            key=os.path.getmtime,
+            reverse=True
+        )
+
+        size, digest = fingerprint
+
+        for path in paths:
+            try:
+                with gzip.open(path, 'rb') as archive:
+                    if self._readFingerprint(archive, size) == digest:
+                        return path, ChatlogBackfill.ARCHIVE_REGEX.match(os.path.basename(path)).group(1)
+
+            except (IOError, EOFError):
+                continue
+
+        return None
+
+
+    def _catchUp(self, chatLog, fingerprint, offset):
+        """
+        Extract the chat entries after offset from the archive of the log with the fingerprint.
+        Returns True if the archive was found.
+        """
+
+        archive = self._findArchive(fingerprint)
+
+        if archive is None:
+            logging.warning(
+                'Archive of the log of {SERVER_NICK} server was not found, chat entries after offset {OFFSET} may be missing.'.format(
+                    SERVER_NICK=self.SERVER_NICK,
+                    OFFSET=offset
+                )
+            )
+
+            return False
+
+        path, date = archive
+
+        logging.info(
+            'Catching up on chatlog for {SERVER_NICK} server from {PATH}, offset {OFFSET}.'.format(
+                SERVER_NICK=self.SERVER_NICK,
+                PATH=path,
+                OFFSET=offset
+            )
+        )
+
+        # Extract from the archive as if it were the log being followed, then go back to that
+        # log. The archive is only read forwards, as seeking backwards in a GzipFile decompresses
+        # it again from the start.
+        following = self._offset, self._day
+
+        try:
+            with gzip.open(path, 'rb') as archive:
+                skip = offset
+
+                while skip > 0:
+                    skipped = len(archive.read(min(skip, FMLLogTailer.CHUNK_SIZE)))
+
+                    if skipped == 0:
+                        break
+
+                    skip -= skipped
+
+                self._offset = offset
+                self._day = date
+
+                # The part of a line at the end of the last chunk, completed by the next one.
+                rest = ''
+
+                while True:
+                    chunk = archive.read(FMLLogTailer.CHUNK_SIZE)
+
+                    if not chunk:
+                        break
+
+                    chunk = rest + chunk
+                    end = chunk.rfind('\n') + 1
+
+                    if end == 0 and len(chunk) >= FMLLogTailer.CHUNK_SIZE:
+                        # An extremely long line, treat the chunk as one line.
+                        end = len(chunk)
+
+                    self._extractLines(chatLog, chunk[:end])
+                    rest = chunk[end:]
+
+                # An archive is complete, so a last line without a newline is not going to be
+                # finished.
+                if rest:
+                    self._extractLines(chatLog, rest)
+
+        finally:
+            self._offset, self._day = following
+
+        return True
+
+
+    def _restore(self, chatLog):
+        checkpoint = self._readCheckpoint()
+
+        if checkpoint is None or not checkpoint.get('fingerprint'):
+            self._openLatest(0)
+            return
+
+        # Discard entries written after the checkpoint, they will be extracted again.
+        if os.fstat(chatLog.fileno()).st_size > checkpoint['chatlogSize']:
+            chatLog.truncate(checkpoint['chatlogSize'])
+
+        size, digest = checkpoint['fingerprint']
+
+        if self._openLatest(0) and self._inode == checkpoint['inode'] \
+                and self._readFingerprint(self._fmlLog, size) == digest:
+            logging.info(
+                'Resuming chatlog for {SERVER_NICK} server from {PATH}, offset {OFFSET}.'.format(
+                    SERVER_NICK=self.SERVER_NICK,
+                    PATH=self.latestPath,
+                    OFFSET=checkpoint['offset']
+                )
+            )
+
+            self._offset = checkpoint['offset']
+            self._fmlLog.seek(self._offset)
+
+            return
+
+        # The log was rotated while Pycraft was not running.
+        self._catchUp(chatLog, (size, digest), checkpoint['offset'])
+        self._openLatest(0)
+
+
+    def _poll(self, chatLog):
+        """
+        Read any new lines from latest.log, moving on to the new latest.log if it has been
+        replaced, then save a checkpoint if anything was read.
+        """
+
+        if self._fmlLog is None and not self._openLatest(0):
+            return
+
+        # Lines are read within a second of being logged, so they are from today.
+        self._day = time.strftime('%Y-%m-%d')
+
+        read = False
+
+        try:
+            live = os.stat(self.latestPath)
+
+        except OSError:
+            # The log is in the middle of being rotated, wait for the new latest.log.
+            live = None
+
+        # Check for truncation before reading, so that nothing is read from the new lines at the
+        # old offset.
+        if live is not None and live.st_ino == self._inode \
+                and (live.st_size < self._offset or not self._unchanged()):
+            logging.info(
+                'Live log of {SERVER_NICK} server was truncated.'.format(
+                    SERVER_NICK=self.SERVER_NICK
+                )
+            )
+
+            # Any lines logged between the last read and the truncation are in the archive,
+            # which is found by the fingerprint saved with the last checkpoint.
+            if self._fingerprint is not None:
+                read = self._catchUp(chatLog, self._fingerprint, self._offset)
+
+            self._fingerprint = None
+            self._offset = 0
+            self._fmlLog.seek(0)
+
+        read = self._readLines(chatLog) or read
+
+        if live is not None and live.st_ino != self._inode:
+            logging.info(
+                'Log of {SERVER_NICK} server was rotated, following the new latest.log.'.format(
+                    SERVER_NICK=self.SERVER_NICK
+                )
+            )
+
+            # The replaced log is still open, so its last lines have just been read from it.
+            self._openLatest(0)
+            read = self._readLines(chatLog) or read
+
+        if read:
+            chatLog.checkpoint(self._checkpoint())
+
+
+def _resetSignals():
+    """
+    Run in each backfill worker process, which would otherwise inherit Pycraft's handlers and
+    stop Pycraft, or even every server, when the pool is terminated.
+    """
+
+    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1]:
+        signal.signal(sig, signal.SIG_DFL)
+
+
+def _backfillLog(task):
+    """
+    Extract the chat entries of one historical log to outputPath, in a backfill worker process.
+    Returns the date of the log's header entry, or None if the log had no date.
+    """
+
+    logPath, outputPath, rules, date = task
+
+    with ChatlogBackfill.openLog(logPath) as fmlLog:
+        with open(outputPath, 'wb') as chatLog:
+            ChatExtractor.shared(rules).extractFile(fmlLog, chatLog, date)
+
+    with open(outputPath, 'rb') as chatLog:
+        # The header entry is a blank line followed by the date.
+        chatLog.readline()
+        return chatLog.readline()[:ChatlogBackfill.DATE_LENGTH] or None
+
+
+class ChatlogBackfill:
+    """
+    Extracts the chat entries of a server's historical logs, which were rotated past
+    ForgeModLoader-server-1.log or archived by a vanilla server, and merges them into its
+    chatlog.txt in chronological order.
+
+    The logs are parsed in parallel by a pool of worker processes, each writing the entries of
+    one log to a temporary file, and gzipped archives are decompressed as they are read. The
+    merge then copies chatlog.txt and the temporary files into a new chatlog in a single pass,
+    placing each log's entries before the first entry of chatlog.txt which started later. A
+    log whose server start is already in chatlog.txt is not added again.
+
+    Every log which has been backfilled is recorded in chatlog.fingerprints by a hash of its
+    first FINGERPRINT_SIZE bytes, so it is not parsed again by later backfills even though its
+    name changes each time the logs are rotated.
+
+    Public methods:
+        run()
+    """
+
+    # Number of decompressed bytes from the start of each log which identify it.
+    FINGERPRINT_SIZE = 64 * 1024
+
+    # Every chatlog entry begins with a date of this many characters.
+    DATE_LENGTH = 19
+
+    # Archived vanilla logs are named after the date they were started on.
+    ARCHIVE_REGEX = re.compile(r'^(\d\d\d\d-\d\d-\d\d)-\d+\.log\.gz$')
+
+
+    def __init__(self, SERVER_NICK, SERVER_PATH, CHAT_RULES=None, processes=None):
+        self.SERVER_NICK = SERVER_NICK
+        self.SERVER_PATH = SERVER_PATH
+        self.CHAT_RULES = CHAT_RULES
+
+        # Number of worker processes, or None for one per core.
+        self.processes = processes
+
+        self.chatLogPath = SERVER_PATH + '/chatlog.txt'
+        self.indexPath = SERVER_PATH + '/chatlog.fingerprints'
+
+
+    @staticmethod
+    def openLog(path):
+        """
+        Returns a binary file object for the log at path, decompressing it if it is gzipped.
+        """
+
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+
+        return open(path, 'rb')
+
+
+    def findLogs(self):
+        """
+        Returns a list of (path, date) for every historical log of the server, where date is
+        the day the log was started on if the log's lines do not include it, or None. The live
+        log and ForgeModLoader-server-1.log, which has already been extracted on rotation, are
+        not included.
+        """
+
+        logs = []
+        index = 2
+
+        while os.path.exists('{SERVER_PATH}/ForgeModLoader-server-{INDEX}.log'.format(
+            SERVER_PATH=self.SERVER_PATH,
+            INDEX=index
+        )):
+            logs.append((
+                '{SERVER_PATH}/ForgeModLoader-server-{INDEX}.log'.format(
+                    SERVER_PATH=self.SERVER_PATH,
+                    INDEX=index
+                ),
+                None
+            ))
+
+            index += 1
+
+        try:
+            archives = sorted(os.listdir(self.SERVER_PATH + '/logs'))
+
+        except OSError:
+            archives = []
+
+        for name in archives:
+            match = ChatlogBackfill.ARCHIVE_REGEX.match(name)
+
+            if match:
+                logs.append((self.SERVER_PATH + '/logs/' + name, match.group(1)))
+
+        return logs
+
+
+    def fingerprint(self, path):
+        with ChatlogBackfill.openLog(path) as fmlLog:
+            return hashlib.sha1(fmlLog.read(ChatlogBackfill.FINGERPRINT_SIZE)).hexdigest()
+
+
+    def _readIndex(self):
+        try:
+            with open(self.indexPath) as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return {}
+
+
+    def _writeIndex(self, index):
+        with open(self.indexPath + '.tmp', 'w') as f:
+            json.dump(index, f, indent=0, sort_keys=True)
+
+        os.rename(self.indexPath + '.tmp', self.indexPath)
+
+
+    def _isHeader(self, line):
+        return line[ChatlogBackfill.DATE_LENGTH:] == ' ' + ChatExtractor.BANNER.encode('utf-8') + '\n'
+
+
+    def _merge(self, pending):
+        """
+        Merge the extracted logs in pending, a list of (date, path) sorted by date, into
+        chatlog.txt. Returns the number of bytes added. Must be called with the chatlog lock
+        held.
+        """
+
+        added = 0
+
+        def copy(path, merged):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, merged)
+                return f.tell()
+
+        with open(self.chatLogPath + '.backfill', 'wb') as merged:
+            try:
+                existing = open(self.chatLogPath, 'rb')
+
+            except IOError:
+                existing = None
+
+            if existing is not None:
+                with existing:
+                    # Each header entry is preceded by a blank line, which is held back until
+                    # it is known whether older entries must be placed in front of it.
+                    blank = None
+
+                    for line in existing:
+                        if line == '\n':
+                            if blank is not None:
+                                merged.write(blank)
+
+                            blank = line
+                            continue
+
+                        if blank is not None and self._isHeader(line):
+                            date = line[:ChatlogBackfill.DATE_LENGTH]
+
+                            while pending and pending[0][0] <= date:
+                                pendingDate, path = pending.pop(0)
+
+                                # A log with the same start is already in the chatlog.
+                                if pendingDate != date:
+                                    added += copy(path, merged)
+
+                        if blank is not None:
+                            merged.write(blank)
+                            blank = None
+
+                        merged.write(line)
+
+                    if blank is not None:
+                        merged.write(blank)
+
+            for pendingDate, path in pending:
+                added += copy(path, merged)
+
+        os.rename(self.chatLogPath + '.backfill', self.chatLogPath)
+
+        return added
+
+
+    def run(self):
+        """
+        Backfill the chatlog, returning a dictionary with the number of logs found, the number
+        skipped because they had already been backfilled, and the number of bytes of entries
+        added to the chatlog.
+        """
+
+        index = self._readIndex()
+        logs = self.findLogs()
+        tasks = []
+
+        directory = tempfile.mkdtemp(prefix='chatlog-backfill-', dir=self.SERVER_PATH)
+
+        try:
+            for path, date in logs:
+                fingerprint = self.fingerprint(path)
+
+                if fingerprint not in index and fingerprint not in [f for f, task in tasks]:
+                    # Archived vanilla logs have their own default rules.
+                    if self.CHAT_RULES is not None:
+                        rules = self.CHAT_RULES
+                    elif date is not None:
+                        rules = VANILLA_CHAT_RULES
+                    else:
+                        rules = DEFAULT_CHAT_RULES
+
+                    tasks.append((
+                        fingerprint,
+                        (path, os.path.join(directory, fingerprint), rules, date)
+                    ))
+
+            logging.info(
+                'Backfilling chatlog of {SERVER_NICK} server from {COUNT} log(s).'.format(
+                    SERVER_NICK=self.SERVER_NICK,
+                    COUNT=len(tasks)
+                )
+            )
+
+            pending = []
+
+            if tasks:
+                pool = multiprocessing.Pool(self.processes, _resetSignals)
+
+                try:
+                    dates = pool.map(_backfillLog, [task for fingerprint, task in tasks])
+
+                finally:
+                    pool.close()
+                    pool.join()
+
+                for (fingerprint, task), date in zip(tasks, dates):
+                    if date is not None:
+                        pending.append((date, task[1]))
+
+                pending.sort()
+
+            added = 0
+
+            with chatlogLock(self.SERVER_PATH):
+                if pending:
+                    added = self._merge(pending)
+                    adjustCheckpoint(self.SERVER_PATH, added)
+
+                    # Entries were inserted before those already indexed.
+                    chatIndex(self.SERVER_PATH).rebuild()
+
+                for fingerprint, task in tasks:
+                    index[fingerprint] = os.path.relpath(task[0], self.SERVER_PATH)
+
+                self._writeIndex(index)
+
+        finally:
+            shutil.rmtree(directory)
+
+        logging.info(
+            'Backfilled {BYTES} bytes of chat entries into chatlog of {SERVER_NICK} server.'.format(
+                BYTES=added,
+                SERVER_NICK=self.SERVER_NICK
+            )
+        )
+
+        return {
+            'logs': len(logs),
+            'skipped': len(logs) - len(tasks),
+            'added': added
+        }
+
+
+class ChatlogStore:
+    """
+    Stores a server's chatlog as a series of segments, so that a range of time can be read
+    without scanning the whole chatlog.
+
+    chatlog.txt is always the active segment, which every extractor appends to. When it is due
+    to be rolled, daily or once it reaches a size, it is moved into the chatlog.d directory and
+    named after its first entry. Closed segments are then compressed into gzip files made of
+    many independently compressed members, each holding about MEMBER_SIZE bytes of whole
+    lines. A sidecar .idx file records the time of the first entry of every member, and the
+    member's offsets in the compressed and uncompressed segment, so a query decompresses only
+    from the member where its range begins, and a line can be read by its offset alone.
+
+    Public methods:
+        roll(policy, size)
+        compressClosed()
+        query(start, end)
+        readLines(path, offsets)
+    """
+
+    # Number of uncompressed bytes in each independently compressed member of a segment.
+    MEMBER_SIZE = 256 * 1024
+
+    # Matches the date and time at the start of a chatlog entry.
+    TIMESTAMP_REGEX = re.compile(r'^(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)')
+
+    # Segment file names are the timestamp of their first entry in this format.
+    SEGMENT_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+
+    def __init__(self, SERVER_NICK, SERVER_PATH):
+        self.SERVER_NICK = SERVER_NICK
+        self.SERVER_PATH = SERVER_PATH
+
+        self.chatLogPath = SERVER_PATH + '/chatlog.txt'
+        self.segmentDir = SERVER_PATH + '/chatlog.d'
+
+
+    @staticmethod
+    def timestamp(line):
+        """
+        Returns the timestamp at the start of a chatlog line, or None if it has none.
+        """
+
+        match = ChatlogStore.TIMESTAMP_REGEX.match(line)
+
+        return match.group(1) if match else None
+
+
+    def _firstTimestamp(self, chatLog):
+        for line in chatLog:
+            timestamp = ChatlogStore.timestamp(line)
+
+            if timestamp is not None:
+                return timestamp
+
+        return None
+
+
+    def roll(self, policy, size):
+        """
+        Move chatlog.txt into chatlog.d if it is due to be rolled under policy, which is either
+        'daily' or 'size', when it is size bytes or larger. Returns the path of the new closed
+        segment, or None.
+        """
+
+        with chatlogLock(self.SERVER_PATH):
+            try:
+                chatLogSize = os.path.getsize(self.chatLogPath)
+
+                with open(self.chatLogPath, 'rb') as chatLog:
+                    first = self._firstTimestamp(chatLog)
+
+            except (IOError, OSError):
+                return None
+
+            if first is None:
+                return None
+
+            if policy == 'daily':
+                due = first[:10] < time.strftime('%Y-%m-%d')
+            else:
+                due = chatLogSize >= size
+
+            if not due:
+                return None
+
+            if not os.path.isdir(self.segmentDir):
+                os.mkdir(self.segmentDir)
+
+            name = time.strftime(
+                ChatlogStore.SEGMENT_FORMAT,
+                time.strptime(first, '%Y-%m-%d %H:%M:%S')
+            )
+
+            # A backfill may have put older entries into an earlier segment with the same name.
+            path = os.path.join(self.segmentDir, name + '.txt')
+            suffix = 1
+
+            while os.path.exists(path) or os.path.exists(path + '.gz'):
+                path = os.path.join(self.segmentDir, '{NAME}-{SUFFIX}.txt'.format(
+                    NAME=name,
+                    SUFFIX=suffix
+                ))
+
+                suffix += 1
+
+            # The postings of chatlog.txt become the closed segment's index.
+            index = chatIndex(self.SERVER_PATH)
+            index.update()
+            index.writeSegment(os.path.basename(path))
+
+            os.rename(self.chatLogPath, path)
+            adjustCheckpoint(self.SERVER_PATH, -chatLogSize)
+            index.reset()
+
+        logging.info(
+            'Rolled chatlog of {SERVER_NICK} server into {PATH}.'.format(
+                SERVER_NICK=self.SERVER_NICK,
+                PATH=path
+            )
+        )
+
+        return path
+
+
+    def _compress(self, path):
+        """
+        Compress the closed segment at path into path.gz, writing its sidecar index, then remove
+        the uncompressed segment.
+        """
+
+        members = []
+        timestamp = None
+        first = None
+        uncompressed = 0
+
+        with open(path, 'rb') as segment:
+            with open(path + '.gz.tmp', 'wb') as compressed:
+                while True:
+                    # Whole lines only, so that every member begins with a line.
+                    lines = segment.readlines(ChatlogStore.MEMBER_SIZE)
+
+                    if not lines:
+                        break
+
+                    memberTimestamp = None
+
+                    for line in lines:
+                        lineTimestamp = ChatlogStore.timestamp(line)
+
+                        if lineTimestamp is not None:
+                            memberTimestamp = memberTimestamp or lineTimestamp
+                            timestamp = lineTimestamp
+
+                    first = first or memberTimestamp
+
+                    # A member without any timestamps continues the previous member's time.
+                    members.append([memberTimestamp or timestamp, compressed.tell(), uncompressed])
+
+                    data = ''.join(lines)
+                    uncompressed += len(data)
+
+                    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    compressed.write(compressor.compress(data) + compressor.flush())
+
+        with open(path + '.idx.tmp', 'w') as f:
+            json.dump({'first': first, 'last': timestamp, 'members': members}, f)
+
+        os.rename(path + '.idx.tmp', path + '.idx')
+        os.rename(path + '.gz.tmp', path + '.gz')
+        os.remove(path)
+
+
+    def closedSegments(self):
+        """
+        Returns the sorted paths of the closed segments, compressed or not.
+        """
+
+        try:
+            names = os.listdir(self.segmentDir)
+
+        except OSError:
+            return []
+
+        return sorted(
+            os.path.join(self.segmentDir, name) for name in names
+            if name.endswith('.txt') or name.endswith('.txt.gz')
+        )
+
+
+    def compressClosed(self):
+        """
+        Compress every closed segment which has not yet been compressed.
+        """
+
+        for path in self.closedSegments():
+            if path.endswith('.txt'):
+                self._compress(path)
+
+                logging.info(
+                    'Compressed chatlog segment {PATH} of {SERVER_NICK} server.'.format(
+                        PATH=path,
+                        SERVER_NICK=self.SERVER_NICK
+                    )
+                )
+
+
+    def _readMembers(self, path, offset):
+        """
+        Yields the lines of a compressed segment from the member at offset onwards.
+        """
+
+        with open(path, 'rb') as compressed:
+            compressed.seek(offset)
+
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            rest = ''
+
+            while True:
+                data = decompressor.unconsumed_tail or compressed.read(ChatlogStore.MEMBER_SIZE)
+
+                if not data:
+                    break
+
+                text = decompressor.decompress(data)
+
+                # The next member needs a new decompressor.
+                while decompressor.unused_data:
+                    unused = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    text += decompressor.decompress(unused)
+
+                lines = (rest + text).split('\n')
+                rest = lines.pop()
+
+                for line in lines:
+                    yield line + '\n'
+
+            if rest:
+                yield rest
+
+
+    def _segmentLines(self, path, start):
+        """
+        Yields the lines of the segment at path, beginning at or before the first entry at
+        start or later.
+        """
+
+        if not path.endswith('.gz'):
+            with open(path, 'rb') as segment:
+                for line in segment:
+                    yield line
+
+            return
+
+        with open(path[:-len('.gz')] + '.idx') as f:
+            members = json.load(f)['members']
+
+        # Entries at start may also be at the end of the member before the first one which
+        # begins at start, so begin with the last member which began before it.
+        offset = 0
+
+        for member in members:
+            if member[0] is not None and member[0] >= start:
+                break
+
+            offset = member[1]
+
+        for line in self._readMembers(path, offset):
+            yield line
+
+
+    def readLines(self, path, offsets):
+        """
+        Yields the line at each of the sorted offsets in the uncompressed segment at path.
+        """
+
+        if not path.endswith('.gz'):
+            with open(path, 'rb') as segment:
+                for offset in offsets:
+                    segment.seek(offset)
+                    yield segment.readline()
+
+            return
+
+        with open(path[:-len('.gz')] + '.idx') as f:
+            members = json.load(f)['members']
+
+        starts = [member[2] for member in members]
+        current = None
+        data = None
+
+        with open(path, 'rb') as compressed:
+            for offset in offsets:
+                # Lines never span members, so each line is read from one member alone.
+                member = bisect.bisect_right(starts, offset) - 1
+
+                if member != current:
+                    compressed.seek(members[member][1])
+
+                    if member + 1 < len(members):
+                        data = compressed.read(members[member + 1][1] - members[member][1])
+                    else:
+                        data = compressed.read()
+
+                    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                    current = member
+
+                start = offset - starts[member]
+                end = data.find('\n', start)
+
+                yield data[start:] if end == -1 else data[start:end + 1]
+
+
+    def _range(self, path):
+        """
+        Returns a tuple of the first and last timestamps of a segment.
+        """
+
+        if path.endswith('.gz'):
+            with open(path[:-len('.gz')] + '.idx') as f:
+                index = json.load(f)
+
+            return index['first'], index['last']
+
+        first = last = None
+
+        with open(path, 'rb') as segment:
+            for line in segment:
+                timestamp = ChatlogStore.timestamp(line)
+
+                if timestamp is not None:
+                    first = first or timestamp
+                    last = timestamp
+
+        return first, last
+
+
+    def query(self, start, end):
+        """
+        Yields every chatlog line timestamped from start to end inclusive, where both are in
+        the form YYYY-MM-DD HH:MM:SS. Lines without a timestamp belong with the line before.
+        """
+
+        segments = []
+
+        for path in self.closedSegments() + [self.chatLogPath]:
+            try:
+                first, last = self._range(path)
+
+            except (IOError, ValueError):
+                continue
+
+            if first is not None and first <= end and last >= start:
+                segments.append((first, path))
+
+        for first, path in sorted(segments):
+            timestamp = None
+
+            for line in self._segmentLines(path, start):
+                timestamp = ChatlogStore.timestamp(line) or timestamp
+
+                if timestamp is None or timestamp < start:
+                    continue
+
+                # Segments are in chronological order, so nothing later can be in range.
+                if timestamp > end:
+                    break
+
+                yield line
+
+
+class ChatlogSegmenter(threading.Thread):
+    """
+    Rolls the chatlogs of every server with CHATLOG_SEGMENTS enabled into segments, and
+    compresses the closed segments, in one background thread.
+
+    Public methods:
+        add(SERVER_NICK, SERVER_PATH, CHATLOG_SEGMENTS, CHATLOG_SEGMENT_SIZE)
+        start()
+        stop()
+    """
+
+    # Number of seconds between checks of every chatlog.
+    INTERVAL = 60
+
+
+    def __init__(self):
+        super(ChatlogSegmenter, self).__init__(name='Thread-PycraftChatlogSegmenter')
+
+        self.daemon = True
+
+        # A list of (ChatlogStore, policy, size) for each server.
+        self._stores = []
+
+        self._stopping = threading.Event()
+
+
+    def add(self, SERVER_NICK, SERVER_PATH, CHATLOG_SEGMENTS, CHATLOG_SEGMENT_SIZE):
+        self._stores.append((
+            ChatlogStore(SERVER_NICK, SERVER_PATH),
+            CHATLOG_SEGMENTS,
+            CHATLOG_SEGMENT_SIZE
+        ))
+
+
+    def stop(self):
+        self._stopping.set()
+
+
+    def run(self):
+        while not self._stopping.is_set():
+            for store, policy, size in self._stores:
+                try:
+                    store.roll(policy, size)
+                    store.compressClosed()
+                    chatIndex(store.SERVER_PATH).indexClosed()
+
+                except (IOError, OSError, zlib.error):
+                    logging.exception(
+                        'Error while segmenting chatlog of {SERVER_NICK} server.'.format(
+                            SERVER_NICK=store.SERVER_NICK
+                        )
+                    )
+
+            self._stopping.wait(ChatlogSegmenter.INTERVAL)
+
+
+def _appendVarint(data, value):
+    """
+    Append value to the bytearray data as a varint, seven bits per byte with the high bit set on
+    every byte but the last.
+    """
+
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    data.append(value)
+
+
+def _readVarint(data, position):
+    """
+    Returns a tuple of the varint at position in the bytearray data, and the position after it.
+    """
+
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+
+        if byte < 0x80:
+            return value, position
+
+        shift += 7
+
+
+def _decodePostings(data):
+    """
+    Returns the offsets of a postings list, which is encoded as varints of the differences
+    between each offset and the one before it.
+    """
+
+    offsets = []
+    offset = 0
+    position = 0
+
+    while position < len(data):
+        delta, position = _readVarint(data, position)
+        offset += delta
+        offsets.append(offset)
+
+    return offsets
+
+
+# Maps the path of each server onto its ChatIndex, shared by every writer and search.
+_chatIndexes = {}
+
+
+def chatIndex(SERVER_PATH):
+    """
+    Returns the ChatIndex of the server's chatlog, shared by every object which uses it.
+    """
+
+    SERVER_PATH = os.path.abspath(SERVER_PATH)
+
+    with _chatlogLocksLock:
+        if SERVER_PATH not in _chatIndexes:
+            _chatIndexes[SERVER_PATH] = ChatIndex(SERVER_PATH)
+
+        return _chatIndexes[SERVER_PATH]
+
+
+class ChatIndex:
+    """
+    An inverted index of a server's chatlog, which maps the username and every word of each
+    entry onto a postings list of the offsets of the entries within their segment.
+
+    Postings are written to chatlog.index as varint encoded differences between offsets, in
+    <name>.postings, with a JSON dictionary of every term's position in that file, and the last
+    offset in its list, in <name>.terms. Closed segments are never changed again, so their
+    dictionaries are cached until they are rewritten.
+
+    The active segment, chatlog.txt, is indexed in parts. The postings of the newest lines are
+    held in memory, and made durable by appending each newly indexed line's offset and terms to
+    chatlog.index/chatlog.txt.log. Once they cover CHECKPOINT_SIZE bytes, they are written out
+    as the part chatlog.txt.<start>-<end>, for the bytes from start to end, and the log is
+    emptied. Adjacent parts are merged while the newer is at least as large as the older, up
+    to MAX_PART_SIZE, so that there are few parts to search. When chatlog.txt is rolled into a
+    closed segment, its parts and the postings in memory are merged into the segment's index.
+
+    update() must be called after writing to chatlog.txt, with the chatlog lock held, to index
+    the new entries. A chatlog with more than BUILD_STEP bytes to index, such as one which
+    existed before the index, is indexed by a background thread instead, which holds the
+    chatlog lock for BUILD_STEP bytes at a time.
+
+    Public methods:
+        update()
+        rebuild()
+        reset()
+        writeSegment(name)
+        indexClosed()
+        search(username, words, limit)
+    """
+
+    # Matches each word of an entry.
+    WORD_REGEX = re.compile(ur'\w+', re.UNICODE)
+
+    # Matches the rank and channel prefixes of a username, such as [Mem] or [WEB].
+    PREFIX_REGEX = re.compile(ur'^(?:\[[^\]]*\])+')
+
+    # Matches the dictionary of a part of the active segment's index.
+    PART_REGEX = re.compile(r'^chatlog\.txt\.(\d+)-(\d+)\.terms$')
+
+    # Longer words are truncated, so that pasted junk does not swell the index.
+    MAX_TERM_LENGTH = 32
+
+    # Length of the timestamp at the start of a chatlog entry, followed by a space.
+    TIMESTAMP_LENGTH = 20
+
+    # Bytes of chatlog.txt whose postings are held in memory before they are written as a part,
+    # and the largest part which is made by merging smaller ones.
+    CHECKPOINT_SIZE = 16 * 1024 * 1024
+    MAX_PART_SIZE = 256 * 1024 * 1024
+
+    # Bytes of chatlog.txt indexed at a time, above which update() leaves them to the background.
+    BUILD_STEP = 1024 * 1024
+
+
+    def __init__(self, SERVER_PATH):
+        self.SERVER_PATH = SERVER_PATH
+
+        self.chatLogPath = SERVER_PATH + '/chatlog.txt'
+        self.indexDir = SERVER_PATH + '/chatlog.index'
+        self.logPath = self.indexDir + '/chatlog.txt.log'
+
+        self.store = ChatlogStore(os.path.basename(SERVER_PATH), SERVER_PATH)
+
+        # The sorted (start, end) byte ranges of chatlog.txt covered by each part of its index.
+        # None until the index is first loaded.
+        self._parts = None
+
+        # Maps each term of the lines of chatlog.txt after the last part onto a list of its
+        # bytearray of varint encoded postings and the last offset in them.
+        self._postings = None
+
+        # Number of bytes of chatlog.txt which have been indexed.
+        self._size = 0
+
+        # Maps the name of each closed segment or part onto a tuple of the modification time of
+        # its .terms file, and its dictionary of terms.
+        self._terms = {}
+
+        # The thread indexing chatlog.txt in the background, or None.
+        self._builder = None
+
+
+    @staticmethod
+    def username(field):
+        """
+        Returns the term for a username, without its rank prefix or trailing colon.
+        """
+
+        field = field.rstrip(u':')
+        name = ChatIndex.PREFIX_REGEX.sub(u'', field) or field.strip(u'[]')
+
+        return u'user:' + name.lower()
+
+
+    @staticmethod
+    def words(text):
+        return set(
+            word.lower()[:ChatIndex.MAX_TERM_LENGTH]
+            for word in ChatIndex.WORD_REGEX.findall(text)
+        )
+
+
+    @staticmethod
+    def terms(line):
+        """
+        Returns the set of terms of a chatlog line. An entry's username is the field after its
+        timestamp, and lines without a timestamp are the continuation of an entry.
+        """
+
+        text = line.decode('utf-8', 'replace')
+
+        if ChatExtractor.BANNER in text:
+            return set()
+
+        if ChatlogStore.timestamp(line) is None:
+            return ChatIndex.words(text)
+
+        fields = text[ChatIndex.TIMESTAMP_LENGTH:].split(None, 1)
+
+        if not fields:
+            return set()
+
+        terms = ChatIndex.words(fields[1] if len(fields) > 1 else u'')
+        terms.add(ChatIndex.username(fields[0]))
+
+        return terms
+
+
+    def _add(self, postings, offset, terms):
+        for term in terms:
+            entry = postings.get(term)
+
+            if entry is None:
+                entry = postings[term] = [bytearray(), 0]
+
+            _appendVarint(entry[0], offset - entry[1])
+            entry[1] = offset
+
+
+    @staticmethod
+    def _partName(part):
+        return 'chatlog.txt.{START}-{END}'.format(START=part[0], END=part[1])
+
+
+    def _readParts(self):
+        """
+        Returns the parts of the index of chatlog.txt, removing any which a merge left behind
+        when Pycraft stopped before it could remove them.
+        """
+
+        try:
+            names = os.listdir(self.indexDir)
+
+        except OSError:
+            return []
+
+        found = []
+
+        for name in names:
+            match = ChatIndex.PART_REGEX.match(name)
+
+            if match is not None:
+                found.append((int(match.group(1)), int(match.group(2))))
+
+        # Parts covering the same start are sorted largest first, so that merged parts win.
+        found.sort(key=lambda part: (part[0], -part[1]))
+
+        parts = []
+
+        for part in found:
+            path = os.path.join(self.indexDir, ChatIndex._partName(part))
+
+            if (parts and part[0] < parts[-1][1]) or not os.path.exists(path + '.postings'):
+                self._removePart(part)
+            else:
+                parts.append(part)
+
+        return parts
+
+
+    def _removePart(self, part):
+        name = ChatIndex._partName(part)
+
+        # The dictionary is removed first, as a part is only searched while it exists.
+        for extension in ('.terms', '.postings'):
+            try:
+                os.remove(os.path.join(self.indexDir, name + extension))
+
+            except OSError:
+                pass
+
+        self._terms.pop(name, None)
+
+
+    def _load(self):
+        """
+        Find the parts of the index of chatlog.txt, and read the postings of the lines after
+        them from the index log. A record which was only partly written when Pycraft stopped is
+        discarded, as are records of lines which a part already covers.
+        """
+
+        self._parts = self._readParts()
+        self._postings = {}
+        self._size = self._parts[-1][1] if self._parts else 0
+
+        try:
+            with open(self.logPath, 'rb') as f:
+                data = bytearray(f.read())
+
+        except IOError:
+            return
+
+        position = 0
+
+        while position < len(data):
+            try:
+                offset, end = _readVarint(data, position)
+                length, end = _readVarint(data, end)
+                count, end = _readVarint(data, end)
+                terms = []
+
+                for i in range(count):
+                    termLength, end = _readVarint(data, end)
+
+                    if end + termLength > len(data):
+                        raise IndexError()
+
+                    terms.append(data[end:end + termLength].decode('utf-8'))
+                    end += termLength
+
+            except IndexError:
+                with open(self.logPath, 'r+b') as f:
+                    f.truncate(position)
+
+                break
+
+            # Written before the last part, when Pycraft stopped before the log was emptied.
+            if offset >= self._size:
+                self._add(self._postings, offset, terms)
+                self._size = offset + length
+
+            position = end
+
+
+    def reset(self):
+        """
+        Forget the index of chatlog.txt, such as when it has been rolled. Must be called with
+        the chatlog lock held.
+        """
+
+        for part in self._readParts():
+            self._removePart(part)
+
+        self._parts = []
+        self._postings = {}
+        self._size = 0
+
+        if os.path.exists(self.logPath):
+            os.remove(self.logPath)
+
+
+    def update(self):
+        """
+        Index the lines appended to chatlog.txt since the last update, or begin indexing them in
+        the background if there are more than BUILD_STEP bytes of them. Must be called with the
+        chatlog lock held.
+        """
+
+        if self._postings is None:
+            self._load()
+
+        try:
+            size = os.path.getsize(self.chatLogPath)
+
+        except OSError:
+            size = 0
+
+        # chatlog.txt was replaced by something other than a roll.
+        if size < self._size:
+            self.reset()
+
+        if size - self._size > ChatIndex.BUILD_STEP:
+            self._startBuilder()
+
+        elif self._builder is None:
+            self._index(size)
+
+
+    def _index(self, size):
+        """
+        Index the complete lines of chatlog.txt from the end of those already indexed, up to
+        and including the line which reaches size, and write them out as a part once the lines
+        in memory cover CHECKPOINT_SIZE bytes. Must be called with the chatlog lock held.
+        """
+
+        if size <= self._size:
+            return
+
+        records = bytearray()
+        offset = self._size
+
+        with open(self.chatLogPath, 'rb') as chatLog:
+            chatLog.seek(offset)
+
+            for line in chatLog:
+                # A line which is still being written is indexed once it is complete.
+                if not line.endswith('\n'):
+                    break
+
+                terms = ChatIndex.terms(line)
+
+                if terms:
+                    self._add(self._postings, offset, terms)
+
+                    _appendVarint(records, offset)
+                    _appendVarint(records, len(line))
+                    _appendVarint(records, len(terms))
+
+                    for term in terms:
+                        term = term.encode('utf-8')
+                        _appendVarint(records, len(term))
+                        records.extend(term)
+
+                offset += len(line)
+
+                if offset >= size:
+                    break
+
+        if not os.path.isdir(self.indexDir):
+            os.mkdir(self.indexDir)
+
+        with open(self.logPath, 'ab') as f:
+            f.write(records)
+
+        self._size = offset
+
+        start = self._parts[-1][1] if self._parts else 0
+
+        if self._size - start >= ChatIndex.CHECKPOINT_SIZE:
+            self._checkpoint(start)
+
+
+    def _checkpoint(self, start):
+        """
+        Write the postings in memory out as the part from start to the end of the lines indexed,
+        empty the index log, then merge the newest parts. Must be called with the chatlog lock
+        held.
+        """
+
+        part = (start, self._size)
+
+        self._writePostings(ChatIndex._partName(part), ChatIndex._entries(self._postings))
+        self._parts.append(part)
+
+        self._postings = {}
+
+        with open(self.logPath, 'wb'):
+            pass
+
+        while len(self._parts) > 1:
+            older, newer = self._parts[-2:]
+
+            # Sizes are compared in whole checkpoints, as each part ends on a line boundary.
+            if (newer[1] - newer[0]) // ChatIndex.CHECKPOINT_SIZE \
+                    < (older[1] - older[0]) // ChatIndex.CHECKPOINT_SIZE \
+                    or newer[1] - older[0] > ChatIndex.MAX_PART_SIZE:
+                break
+
+            merged = (older[0], newer[1])
+
+            self._combine(ChatIndex._partName(merged), [older, newer], {})
+            self._parts[-2:] = [merged]
+
+            self._removePart(older)
+            self._removePart(newer)
+
+
+    def _startBuilder(self):
+        """
+        Begin indexing chatlog.txt in a background thread, unless it already is being indexed.
+        Must be called with the chatlog lock held.
+        """
+
+        if self._builder is not None:
+            return
+
+        logging.info(
+            'Indexing chatlog {PATH} in the background, from offset {OFFSET}.'.format(
+                PATH=self.chatLogPath,
+                OFFSET=self._size
+            )
+        )
+
+        self._builder = threading.Thread(
+            target=self._build,
+            name='Thread-PycraftChatIndex-{NAME}'.format(NAME=os.path.basename(self.SERVER_PATH))
+        )
+
+        self._builder.daemon = True
+        self._builder.start()
+
+
+    def _build(self):
+        """
+        Index chatlog.txt BUILD_STEP bytes at a time, releasing the chatlog lock between steps
+        so that entries can still be written to it, until it has been indexed to the end.
+        """
+
+        try:
+            while True:
+                with chatlogLock(self.SERVER_PATH):
+                    try:
+                        size = os.path.getsize(self.chatLogPath)
+
+                    except OSError:
+                        size = 0
+
+                    if size < self._size:
+                        self.reset()
+
+                    before = self._size
+                    self._index(min(size, self._size + ChatIndex.BUILD_STEP))
+
+                    # Indexed to the end, or to a line which is still being written.
+                    if self._size == before:
+                        self._builder = None
+
+                        logging.info(
+                            'Indexed chatlog {PATH}.'.format(PATH=self.chatLogPath)
+                        )
+
+                        return
+
+        except Exception:
+            logging.exception(
+                'Error while indexing chatlog {PATH}.'.format(PATH=self.chatLogPath)
+            )
+
+            with chatlogLock(self.SERVER_PATH):
+                self._builder = None
+
+
+    def rebuild(self):
+        """
+        Index chatlog.txt from the start, such as after entries have been inserted into it. Must
+        be called with the chatlog lock held.
+        """
+
+        self.reset()
+        self.update()
+
+
+    @staticmethod
+    def _entries(postings):
+        return ((term, data, last) for term, (data, last) in postings.iteritems())
+
+
+    def _writePostings(self, name, entries):
+        """
+        Write the index name from entries, an iterable of a term, its postings, and the last
+        offset in them.
+        """
+
+        if not os.path.isdir(self.indexDir):
+            os.mkdir(self.indexDir)
+
+        path = os.path.join(self.indexDir, name)
+        terms = {}
+
+        with open(path + '.postings.tmp', 'wb') as f:
+            for term, data, last in entries:
+                terms[term] = [f.tell(), len(data), last]
+                f.write(data)
+
+        with open(path + '.terms.tmp', 'w') as f:
+            json.dump(terms, f, separators=(',', ':'))
+
+        # The dictionary is written last, as a segment is only searched once it exists.
+        os.rename(path + '.postings.tmp', path + '.postings')
+        os.rename(path + '.terms.tmp', path + '.terms')
+
+
+    def _combine(self, name, parts, postings):
+        """
+        Write the index name from the postings of the parts, in order, followed by the postings
+        in memory. The first offset of each list is encoded as the difference from the last
+        offset of the list before it.
+        """
+
+        dictionaries = [self._segmentTerms(ChatIndex._partName(part)) for part in parts]
+        files = [
+            open(os.path.join(self.indexDir, ChatIndex._partName(part) + '.postings'), 'rb')
+            for part in parts
+        ]
+
+        def entries():
+            terms = set(postings)
+
+            for dictionary in dictionaries:
+                terms.update(dictionary)
+
+            for term in terms:
+                data = bytearray()
+                last = 0
+
+                for dictionary, f in zip(dictionaries, files):
+                    if term in dictionary:
+                        start, length, partLast = dictionary[term]
+                        f.seek(start)
+
+                        ChatIndex._rebase(data, bytearray(f.read(length)), last)
+                        last = partLast
+
+                if term in postings:
+                    ChatIndex._rebase(data, postings[term][0], last)
+                    last = postings[term][1]
+
+                yield term, data, last
+
+        try:
+            self._writePostings(name, entries())
+
+        finally:
+            for f in files:
+                f.close()
+
+
+    @staticmethod
+    def _rebase(data, postings, last):
+        """
+        Append postings, whose first offset is encoded in full, to data, whose last offset is
+        last.
+        """
+
+        first, position = _readVarint(postings, 0)
+
+        _appendVarint(data, first - last)
+        data.extend(postings[position:])
+
+
+    def writeSegment(self, name):
+        """
+        Write the index of chatlog.txt out as the index of the closed segment it is about to
+        become, indexing any lines which have not been yet. Must be called with the chatlog lock
+        held.
+        """
+
+        if self._postings is None:
+            self._load()
+
+        try:
+            self._index(os.path.getsize(self.chatLogPath))
+
+        except OSError:
+            pass
+
+        self._combine(name, self._parts, self._postings)
+
+
+    def indexClosed(self):
+        """
+        Index every closed segment which has no index, such as those rolled before the index
+        existed.
+        """
+
+        for path in self.store.closedSegments():
+            name = os.path.basename(path)
+
+            if name.endswith('.gz'):
+                name = name[:-len('.gz')]
+
+            if os.path.exists(os.path.join(self.indexDir, name + '.terms')):
+                continue
+
+            postings = {}
+            offset = 0
+
+            if path.endswith('.gz'):
+                lines = self.store._readMembers(path, 0)
+            else:
+                lines = self.store._segmentLines(path, None)
+
+            for line in lines:
+                self._add(postings, offset, ChatIndex.terms(line))
+                offset += len(line)
+
+            self._writePostings(name, ChatIndex._entries(postings))
+
+            logging.info('Indexed chatlog segment {PATH}.'.format(PATH=path))
+
+
+    def _segmentTerms(self, name):
+        path = os.path.join(self.indexDir, name + '.terms')
+
+        try:
+            modified = os.path.getmtime(path)
+
+        except OSError:
+            return None
+
+        if name not in self._terms or self._terms[name][0] != modified:
+            with open(path) as f:
+                self._terms[name] = (modified, json.load(f))
+
+        return self._terms[name][1]
+
+
+    def _match(self, lists):
+        """
+        Returns the sorted offsets which are in every one of the postings lists.
+        """
+
+        lists.sort(key=len)
+        offsets = set(_decodePostings(lists[0]))
+
+        for data in lists[1:]:
+            if not offsets:
+                break
+
+            offsets.intersection_update(_decodePostings(data))
+
+        return sorted(offsets)
+
+
+    def _matchSegment(self, name, terms):
+        """
+        Returns the sorted offsets of the entries of a closed segment or part with every term,
+        or None if it has no index.
+        """
+
+        dictionary = self._segmentTerms(name)
+
+        if dictionary is None:
+            return None
+
+        positions = []
+
+        for term in terms:
+            if term not in dictionary:
+                return []
+
+            positions.append(dictionary[term][:2])
+
+        lists = []
+
+        with open(os.path.join(self.indexDir, name + '.postings'), 'rb') as f:
+            for start, length in positions:
+                f.seek(start)
+                lists.append(bytearray(f.read(length)))
+
+        return self._match(lists)
+
+
+    def search(self, username, words, limit):
+        """
+        Returns a dictionary of the total number of entries by username, if it is not None,
+        which contain every one of words, the newest limit of those entries in chronological
+        order, the number of closed segments which could not be searched as they have not been
+        indexed yet, and whether chatlog.txt is still being indexed, in which case only the
+        entries indexed so far were searched.
+        """
+
+        terms = set()
+
+        if username is not None:
+            terms.add(ChatIndex.username(username.decode('utf-8', 'replace')))
+
+        for word in words:
+            terms.update(ChatIndex.words(word.decode('utf-8', 'replace')))
+
+        result = {'total': 0, 'lines': [], 'unindexed': 0, 'indexing': False}
+
+        if not terms:
+            return result
+
+        # The active segment is the newest, and is read before it can be rolled. Each of its
+        # entries is in exactly one part, or in the postings in memory.
+        with chatlogLock(self.SERVER_PATH):
+            self.update()
+
+            offsets = []
+
+            for part in self._parts:
+                offsets.extend(self._matchSegment(ChatIndex._partName(part), terms) or [])
+
+            if all(term in self._postings for term in terms):
+                offsets.extend(self._match([self._postings[term][0] for term in terms]))
+
+            result['total'] = len(offsets)
+            result['indexing'] = self._builder is not None
+
+            if offsets:
+                result['lines'] = list(self.store.readLines(self.chatLogPath, offsets[-limit:]))
+
+        # Closed segments from newest to oldest, until limit entries have been read.
+        for path in reversed(self.store.closedSegments()):
+            name = os.path.basename(path)
+
+            if name.endswith('.gz'):
+                name = name[:-len('.gz')]
+
+            offsets = self._matchSegment(name, terms)
+
+            if offsets is None:
+                result['unindexed'] += 1
+                continue
 
-        # We are overriding the constructor of an inherited class, so it's probably a good idea to call the
-        # parent's constructor method first!
-        super(FMLLogObserver, self).__init__()
+            result['total'] += len(offsets)
+            wanted = limit - len(result['lines'])
 
-        # Instantiate the FmlLogHandler class
-        fmlLogHandler = FMLLogHandler(SERVER_NICK, SERVER_PATH)
+            if wanted > 0 and offsets:
+                result['lines'][:0] = self.store.readLines(path, offsets[-wanted:])
 
-        # Pass the fmlLogHandler instance to this observer, and restrict the observer to just watch
-        # the server path.
-        self.schedule(fmlLogHandler, SERVER_PATH)
+        return result
@@ -4,6 +4,49 @@
 # This server wrapper can monitor multiple servers. Each server must have a unique nick and a unique jar name.
 # The config variable is a list of all the servers to be monitored. The list contains dictionaries.
 # Each dictionary contains a complete set of configuration options for one particular server.
+#
+# Alternatively, each server may be configured with its own JSON file inside the CONF_DIR
+# directory, see conf.d.example for the layout. If CONF_DIR exists, the config list is ignored.
+
+CONF_DIR = 'conf.d'                                                  # Directory containing one configuration file per server.
+CONTROL_SOCKET = 'pycraft.sock'                                      # UNIX domain socket serving the control API, or None to disable it.
+CONTROL_CONCURRENCY = 4                                              # Default number of servers a control API job operates on at once.
+CHATLOG_WORKERS = 2                                                  # Number of rotated logs which may have their chat entries extracted at once.
+
+# Pycraft's own log, written by a background thread.
+LOG_FILE = 'pycraft.log'                                             # Rotated into LOG_FILE.1.gz to LOG_FILE.<LOG_BACKUPS>.gz.
+LOG_LEVEL = 'INFO'                                                   # 'DEBUG', 'INFO', 'WARNING' or 'ERROR'.
+LOG_FORMAT = 'text'                                                  # 'text', or 'json' for one JSON object per line.
+LOG_MAX_BYTES = 10*1024*1024                                         # Size in bytes at which the log is rotated.
+LOG_BACKUPS = 5                                                      # Number of compressed rotated logs kept.
+LOG_QUEUE_SIZE = 10000                                               # Records waiting to be written, beyond which new records below WARNING are dropped rather than waited for.
+
+# Front proxy. Set PROXY_ADDRESS to reach every server through one port, routed by the hostname
+# players connect to, which is matched against each server's PROXY_HOSTNAMES.
+PROXY_ADDRESS = None                                                 # (host, port) tuple to accept players on, e.g. ('0.0.0.0', 25565).
+PROXY_DEFAULT_SERVER = None                                          # Nick of the server which receives players whose hostname no server claims, or None to refuse them.
+
+# Stopping every server at once, with the shutdown-all console command or SIGUSR1.
+SHUTDOWN_ALL_ON_SIGTERM = False                                      # If True, SIGTERM also stops every server before Pycraft exits, e.g. at host shutdown.
+SHUTDOWN_WARNING_TIME = 10                                           # Seconds between warning the players and stopping the servers.
+SHUTDOWN_DEADLINE = 60                                               # Seconds all servers have to stop gracefully before being killed.
+
+# Multi-node coordination. Set AGENT_ADDRESS to let a controller on another host manage this
+# host's servers. The controller is run with "python controller.py" on any host, and manages the
+# agents listed in CONTROLLER_AGENTS.
+AGENT_ADDRESS = None                                                 # (host, port) tuple to serve the control API on over TCP, e.g. ('0.0.0.0', 25580).
+AGENT_TOKEN = 'change-me'                                            # Shared secret which the controller must send with every request. The agent will not start until it is changed.
+
+CONTROLLER_AGENTS = {                                                # Maps a name for each agent onto its (host, port) address.
+    # 'host1': ('10.0.0.1', 25580),
+}
+CONTROLLER_SOCKET = 'controller.sock'                                # UNIX domain socket serving the controller's fleet-wide control API.
+CONTROLLER_CONCURRENCY = 2                                           # Maximum number of servers across the fleet operated on at once.
+CONTROLLER_AGENT_CONCURRENCY = 1                                     # Maximum number of servers on each agent operated on at once.
+CONTROLLER_SCHEDULE = [                                              # Fleet-wide operations, each repeated every interval seconds.
+    # {'operation': 'backup', 'servers': '*', 'interval': 6*60*60},
+    # {'operation': 'restart', 'servers': '*/lobby-*', 'interval': 12*60*60},
+]
 
 config = [
     {
@@ -12,14 +55,23 @@ config = [
         'SERVER_PATH': '/home/minecraft/test',                       # Where the server files are located
         'SERVER_JAR': 'test-server.jar',                             # Name of the server jar file, must be unique to the server being monitored. Used to identify server process.
         'START_SCRIPT': 'ServerStart.sh',                            # This script will be run inside a screen session to start the server. Should include the necessary Java command line arguments.
+        'BACKUP_SCRIPT': 'Backup.sh',                                # Optional script run from SERVER_PATH by the backup command, while saving is suspended.
         
         # Modules
         'ENABLE_CHATLOG': True,                                      # Extract chat entries from ForgeModLoader-server-0.log and record into a chatlog file (Forge servers only)
+        'CHATLOG_MODE': 'tail',                                      # 'rotation' extracts chat when the log is rotated at server startup, 'tail' follows the live log, 'latest' follows logs/latest.log of a vanilla or Paper server.
+        'CHAT_RULES': None,                                          # List of chat rules, or None for MyTown, Dynmap and console broadcasts. See README.md.
+        'CHATLOG_SEGMENTS': 'off',                                   # 'daily' or 'size' rolls chatlog.txt into compressed segments in chatlog.d, which the chatlog console command can search by time.
+        'CHATLOG_SEGMENT_SIZE': 64*1024*1024,                        # Size in bytes at which chatlog.txt is rolled when CHATLOG_SEGMENTS is 'size'.
+        'CHATLOG_FSYNC': 'none',                                     # When the 'tail' and 'latest' modes sync chatlog.txt to disk: 'none', 'interval' (every few seconds) or 'batch' (every write).
+        'ENABLE_SESSIONS': False,                                    # Also record players joining and leaving in the sessions directory, for the sessions console command.
         'ENABLE_RESPONSIVENESS_CHECK': True,                         # Request the server MOTD at 60 second intervals, restart if server unresponsive.
+        'ENABLE_STALL_FORENSICS': True,                              # Save thread dumps and per-thread CPU of an unresponsive server to its stalls directory before restarting or killing it.
         'ENABLE_AUTOMATED_RESTARTS': True,
         
         # Wrapper
         'START_SERVER': True,                                        # If set to True, starting pycraft will launch the server automatically.
+        'ENABLE_STATE_JOURNAL': True,                                # Record start, stop, hibernation and scheduled restarts in pycraft.journal in SERVER_PATH, and resume them when Pycraft restarts, in place of START_SERVER.
         'MULTIUSER_ENABLED': True,                                   # Should screen session be configured to use multiuser mode.
         'AUTHORISED_ACCOUNTS': [
             'anedaar',
@@ -31,8 +83,36 @@ config = [
         'PORT': 25595,                                               # The port of the server to be monitored. By default 25565.
         'STARTUP_TIME': 30,                                          # Number of seconds to wait before checking server responsiveness.
 
+        # GC log module
+        'GCLOG_PATH': None,                                          # GC log written by START_SCRIPT's -Xlog:gc:file=logs/gc.log option, relative to SERVER_PATH. Its pause percentiles are shown by the status command.
+        'GC_RESTART_PAUSE': None,                                    # Begin the restart sequence if the median GC pause over GC_RESTART_WINDOW exceeds this many milliseconds. None disables.
+        'GC_RESTART_HEAP': None,                                     # Begin the restart sequence if the heap stays over this fraction full, e.g. 0.9, after every GC over GC_RESTART_WINDOW. None disables.
+        'GC_RESTART_WINDOW': 10*60,                                  # Seconds of GC pauses which GC_RESTART_PAUSE and GC_RESTART_HEAP look at.
+
         # Restart module
-        'RESTART_TIME': 2*60                                         # Number of seconds to wait before restarting Minecraft server
+        'RESTART_TIME': 2*60,                                        # Number of seconds to wait before restarting Minecraft server
+        'RESTART_WINDOW': None,                                      # Seconds either side of RESTART_TIME, e.g. 2*60*60, within which the restart waits for the fewest players. None restarts on time.
+
+        # Hibernation module
+        'HIBERNATE_TIME': None,                                      # Seconds without players, e.g. 30*60, after which the server is stopped until a player tries to join. None keeps it running.
+        'HIBERNATE_MOTD': 'Sleeping, join to wake the server up',    # Message of the day shown in the server list while the server is hibernating.
+
+        # Blue/green restart module
+        'STANDBY_PATH': None,                                        # Second copy of the server, e.g. '/home/minecraft/test-standby', to boot each restart's replacement in. Requires PROXY_ADDRESS. None restarts in place.
+        'STANDBY_PORT': 25596,                                       # The port set in STANDBY_PATH's server.properties.
+        'STANDBY_SYNC': [
+            'world'
+        ],                                                           # Files and directories copied to the replacement before it boots, and again once the old instance has stopped.
+
+        # tmpfs world module
+        'WORLD_TMPFS': None,                                         # Directory on a tmpfs, e.g. '/dev/shm/pycraft/test', to run the world from. None runs it from SERVER_PATH.
+        'WORLD_TMPFS_INTERVAL': 15*60,                               # Seconds between writing the tmpfs world back to disk, which is also done whenever the server stops.
+        'WORLD_TMPFS_BWLIMIT': None,                                 # Kilobytes per second a periodic write-back may write to disk, or None for no limit.
+
+        # Front proxy module
+        'PROXY_HOSTNAMES': [
+            'test.example.com'
+        ]                                                            # Hostnames, or globs such as '*.test.example.com', which the front proxy routes to this server.
     },
 
     {
@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A control API for Pycraft, served on a UNIX domain socket, and optionally on a TCP port so that
+a controller can manage this host as one of its agents (see controller.py).
+
+Clients send one JSON object per line, and receive one JSON object per line in reply. Every
+request must contain a "command" key, and may contain an "id" key which will be copied into each
+reply to that request. Many clients may be connected at once, each is served by its own thread.
+
+Commands:
+    {"command": "list"}
+    {"command": "status", "servers": "<glob>"}
+    {"command": "metrics"}
+    {"command": "history", "servers": "<glob>", "count": <int>}
+    {"command": "start" | "stop" | "restart", "servers": "<glob>",
+        "concurrency": <int>, "follow": <bool>}
+    {"command": "backup", "servers": "<glob>", "concurrency": <int>, "follow": <bool>}
+    {"command": "send", "servers": "<glob>", "text": "<console command>",
+        "concurrency": <int>, "follow": <bool>}
+    {"command": "jobs"}
+    {"command": "job", "job": <jobID>}
+    {"command": "watch", "job": <jobID>}
+
+The start, stop, restart, backup and send commands run as jobs in the background, and reply at once
+with the job ID. Each job performs its operation on every server whose nick matches the glob,
+with at most "concurrency" servers being operated on at the same time. If "follow" is true, or
+if a client later sends the watch command, the job's progress events are streamed to the client
+until the job has finished.
+
+Requests sent to the TCP port must also contain a "token" key matching AGENT_TOKEN.
+
+Running this module directly sends each argument as a request to the control socket, and prints
+the replies.
+"""
+
+# Library modules
+import collections
+import fnmatch
+import hmac
+import itertools
+import json
+import logging
+import os
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+
+# The AGENT_TOKEN given in the example configuration, which an agent refuses to serve with.
+DEFAULT_AGENT_TOKEN = 'change-me'
+
+# Operations which may be performed on servers by a job, mapped onto a function which performs
+# the operation on one server.
+OPERATIONS = {
+    'start':    lambda s, request: s.start(),
+    'stop':     lambda s, request: s.stop(),
+    'restart':  lambda s, request: s.restart(),
+    'backup':   lambda s, request: _backup(s),
+    'send':     lambda s, request: s.sendCommand(request['text'].encode('utf-8'))
+}
+
+
+class ControlError(Exception):
+    """
+    Raised when a control request is invalid. The message is returned to the client.
+    """
+
+    pass
+
+
+def _backup(s):
+    if not s.backup():
+        raise ControlError(
+            'Backup of {SERVER_NICK} server failed.'.format(
+                SERVER_NICK=s.getConfig('SERVER_NICK')
+            )
+        )
+
+
+class Job:
+    """
+    A long-running operation performed on a set of servers, with at most concurrency servers
+    being operated on at the same time.
+
+    Progress is recorded as a list of event dictionaries, which subscribers can follow with
+    iterEvents() whether they subscribed before or after the events occurred.
+    """
+
+    def __init__(self, jobID, operation, servers, request, concurrency):
+        self.jobID = jobID
+        self.operation = operation
+        self.servers = servers
+        self.request = request
+        self.concurrency = max(1, min(concurrency, len(servers) or 1))
+
+        self.created = time.time()
+        self.finished = None
+
+        # Maps each server nick onto pending | running | done | failed
+        self.states = collections.OrderedDict(
+            (s.getConfig('SERVER_NICK'), 'pending') for s in servers
+        )
+
+        self._events = []
+        self._condition = threading.Condition()
+
+
+    def _addEvent(self, event):
+        with self._condition:
+            event['job'] = self.jobID
+            event['time'] = time.time()
+            self._events.append(event)
+            self._condition.notify_all()
+
+
+    def run(self):
+        """
+        Perform the operation on every server, using a pool of worker threads. Returns once
+        every server has been operated on.
+        """
+
+        pending = Queue.Queue()
+
+        for s in self.servers:
+            pending.put(s)
+
+        self._addEvent({
+            'event': 'started',
+            'operation': self.operation,
+            'servers': self.states.keys()
+        })
+
+        workers = [
+            threading.Thread(
+                target=self._work,
+                args=(pending,),
+                name='Thread-PycraftJob{JOB}-{INDEX}'.format(JOB=self.jobID, INDEX=index)
+            )
+            for index in range(self.concurrency)
+        ]
+
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        for w in workers:
+            w.join()
+
+        with self._condition:
+            self.finished = time.time()
+
+        self._addEvent({
+            'event': 'finished',
+            'states': dict(self.states)
+        })
+
+
+    def _work(self, pending):
+        while True:
+            try:
+                s = pending.get_nowait()
+
+            except Queue.Empty:
+                return
+
+            serverNick = s.getConfig('SERVER_NICK')
+            self.states[serverNick] = 'running'
+            self._addEvent({'event': 'progress', 'server': serverNick, 'state': 'running'})
+
+            started = time.time()
+
+            try:
+                OPERATIONS[self.operation](s, self.request)
+
+            except Exception as e:
+                logging.exception(
+                    'Job {JOB} failed to {OPERATION} {SERVER_NICK} server.'.format(
+                        JOB=self.jobID,
+                        OPERATION=self.operation,
+                        SERVER_NICK=serverNick
+                    )
+                )
+
+                self.states[serverNick] = 'failed'
+                self._addEvent({
+                    'event': 'progress',
+                    'server': serverNick,
+                    'state': 'failed',
+                    'error': str(e),
+                    'duration': time.time() - started
+                })
+
+            else:
+                self.states[serverNick] = 'done'
+                self._addEvent({
+                    'event': 'progress',
+                    'server': serverNick,
+                    'state': 'done',
+                    'duration': time.time() - started
+                })
+
+
+    def iterEvents(self):
+        """
+        Yields every event of this job, blocking while waiting for new events, until the job
+        has finished.
+        """
+
+        index = 0
+
+        while True:
+            with self._condition:
+                while index >= len(self._events):
+                    self._condition.wait(1)
+
+                events = self._events[index:]
+                index = len(self._events)
+
+            for event in events:
+                yield event
+
+                if event['event'] == 'finished':
+                    return
+
+
+    def summary(self):
+        return {
+            'job': self.jobID,
+            'operation': self.operation,
+            'created': self.created,
+            'finished': self.finished,
+            'states': dict(self.states)
+        }
+
+
+class JobManager:
+    """
+    Creates jobs, runs each job in its own thread, and remembers recent jobs so that their
+    progress can be queried.
+    """
+
+    # Number of finished jobs to remember.
+    HISTORY = 100
+
+
+    def __init__(self):
+        self._jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+
+    def submit(self, operation, servers, request, concurrency):
+        with self._lock:
+            job = Job(next(self._ids), operation, servers, request, concurrency)
+            self._jobs[job.jobID] = job
+
+            finished = [j for j in self._jobs.itervalues() if j.finished is not None]
+
+            for j in finished[:max(0, len(finished) - JobManager.HISTORY)]:
+                del self._jobs[j.jobID]
+
+        logging.info(
+            'Starting job {JOB}: {OPERATION} {SERVERS}.'.format(
+                JOB=job.jobID,
+                OPERATION=operation,
+                SERVERS=', '.join(job.states)
+            )
+        )
+
+        t = threading.Thread(target=job.run, name='Thread-PycraftJob{JOB}'.format(JOB=job.jobID))
+        t.daemon = True
+        t.start()
+
+        return job
+
+
+    def get(self, jobID):
+        with self._lock:
+            job = self._jobs.get(jobID)
+
+        if job is None:
+            raise ControlError('Job {JOB} was not found.'.format(JOB=jobID))
+
+        return job
+
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.itervalues())
+
+
+class ControlAPI:
+    """
+    Interprets control requests, independently of the transport which carried them.
+    """
+
+    def __init__(self, serverInstances, defaultConcurrency, metrics=None):
+        self.serverInstances = serverInstances
+        self.defaultConcurrency = defaultConcurrency
+        self.jobManager = JobManager()
+
+        # Callable which returns a dictionary of Pycraft's internal metrics, such as the queue
+        # depth and flush latency of each chatlog writer.
+        self.metrics = metrics
+
+
+    def matchServers(self, pattern):
+        """
+        Returns the list of servers whose nicks match the glob pattern, raising ControlError if
+        there are none.
+        """
+
+        if not isinstance(pattern, basestring):
+            raise ControlError('"servers" must be a glob pattern matching server nicks.')
+
+        servers = [
+            s for s in self.serverInstances
+            if fnmatch.fnmatchcase(s.getConfig('SERVER_NICK'), pattern)
+        ]
+
+        if not servers:
+            raise ControlError('No servers match {PATTERN}.'.format(PATTERN=pattern))
+
+        return servers
+
+
+    @staticmethod
+    def serverStatus(s):
+        uptime = s.getUptime()
+
+        return {
+            'server': s.getConfig('SERVER_NICK'),
+            'target': 'online' if s.getTargetState() else 'offline',
+            'online': uptime is not None,
+            'hibernating': s.isHibernating(),
+            'port': s.getAddress()[1],
+            'gc': s.getGCStats(),
+            'uptime': uptime
+        }
+
+
+    def handle(self, request, send):
+        """
+        Carry out one request, calling send with each reply dictionary.
+        """
+
+        if not isinstance(request, dict) or 'command' not in request:
+            raise ControlError('Requests must be JSON objects with a "command" key.')
+
+        command = request['command']
+
+        if command == 'list':
+            send({'servers': [s.getConfig('SERVER_NICK') for s in self.serverInstances]})
+
+        elif command == 'status':
+            send({
+                'status': [
+                    ControlAPI.serverStatus(s)
+                    for s in self.matchServers(request.get('servers', '*'))
+                ]
+            })
+
+        elif command == 'metrics':
+            send({'metrics': self.metrics() if self.metrics is not None else {}})
+
+        elif command == 'history':
+            count = request.get('count')
+
+            if count is not None and (not isinstance(count, int) or count < 1):
+                raise ControlError('"count" must be a positive integer.')
+
+            send({
+                'history': dict(
+                    (s.getConfig('SERVER_NICK'), s.getHistory(count))
+                    for s in self.matchServers(request.get('servers', '*'))
+                )
+            })
+
+        elif command in OPERATIONS:
+            servers = self.matchServers(request.get('servers'))
+            concurrency = request.get('concurrency', self.defaultConcurrency)
+
+            if not isinstance(concurrency, int) or concurrency < 1:
+                raise ControlError('"concurrency" must be a positive integer.')
+
+            if command == 'send' and not isinstance(request.get('text'), basestring):
+                raise ControlError('The send command requires a "text" string.')
+
+            job = self.jobManager.submit(command, servers, request, concurrency)
+
+            send({
+                'event': 'accepted',
+                'job': job.jobID,
+                'servers': job.states.keys()
+            })
+
+            if request.get('follow'):
+                for event in job.iterEvents():
+                    send(event)
+
+        elif command == 'jobs':
+            send({'jobs': [j.summary() for j in self.jobManager.list()]})
+
+        elif command == 'job':
+            send(self.jobManager.get(request.get('job')).summary())
+
+        elif command == 'watch':
+            for event in self.jobManager.get(request.get('job')).iterEvents():
+                send(event)
+
+        else:
+            raise ControlError('Unknown command {COMMAND}.'.format(COMMAND=command))
+
+
+def _validToken(given, token):
+    """
+    Returns True if the token given in a request matches token, comparing them in constant time
+    so that the token cannot be found from how long requests take to be refused.
+    """
+
+    if not isinstance(given, basestring):
+        return False
+
+    if isinstance(given, unicode):
+        given = given.encode('utf-8')
+
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+
+    return hmac.compare_digest(given, token)
+
+
+class ControlRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads line-delimited JSON requests from one client, and writes line-delimited JSON replies.
+    """
+
+    def send(self, reply, requestID=None):
+        if requestID is not None:
+            reply['id'] = requestID
+
+        self.wfile.write(json.dumps(reply) + '\n')
+        self.wfile.flush()
+
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            if not line.strip():
+                continue
+
+            requestID = None
+
+            try:
+                request = json.loads(line)
+
+                if isinstance(request, dict):
+                    requestID = request.get('id')
+
+                    if self.server.token is not None and not _validToken(request.get('token'), self.server.token):
+                        raise ControlError('Invalid token.')
+
+                self.server.api.handle(
+                    request,
+                    lambda reply: self.send(reply, requestID)
+                )
+
+            except (ValueError, ControlError) as e:
+                self.send({'error': str(e)}, requestID)
+
+            except socket.error:
+                # Client disconnected while replies were being streamed.
+                return
+
+            except Exception as e:
+                # A bug in a command must not drop the client without a reply.
+                logging.exception('Error while handling control request.')
+
+                self.send(
+                    {'error': 'Internal error: {ERROR}'.format(ERROR=e)},
+                    requestID
+                )
+
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serves the control API on a UNIX domain socket. Call start() to begin serving in a new
+    thread, and stop() to stop serving and remove the socket file.
+    """
+
+    daemon_threads = True
+
+    # Clients of the UNIX domain socket are authorised by the socket's file permissions.
+    token = None
+
+
+    def __init__(self, path, api):
+        self.path = path
+        self.api = api
+
+        # Remove a stale socket left behind by a previous Pycraft process.
+        if os.path.exists(path):
+            os.remove(path)
+
+        # Only the user running Pycraft may connect. The socket is created without permissions
+        # for anyone else, as other users could connect before a chmod() after bind().
+        umask = os.umask(0o077)
+
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, ControlRequestHandler)
+
+        finally:
+            os.umask(umask)
+
+        os.chmod(path, 0o600)
+
+        self._thread = None
+
+
+    def start(self):
+        logging.info(
+            'Serving control API on {PATH}.'.format(
+                PATH=self.path
+            )
+        )
+
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            name='Thread-PycraftControlSocket'
+        )
+
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+
+        self.server_close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Serves the control API on a TCP address, so that a controller on another host can manage
+    this host's servers. Every request must carry the shared token.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+    def __init__(self, address, token, api):
+        # Anyone who can reach the port could otherwise control every server.
+        if not token or token == DEFAULT_AGENT_TOKEN:
+            raise ControlError('AGENT_TOKEN must be set to a secret before serving the agent API.')
+
+        self.api = api
+        self.token = token
+
+        SocketServer.TCPServer.__init__(self, address, ControlRequestHandler)
+
+        self._thread = None
+
+
+    def start(self):
+        logging.info(
+            'Serving agent API on {HOST}:{PORT}.'.format(
+                HOST=self.server_address[0],
+                PORT=self.server_address[1]
+            )
+        )
+
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            name='Thread-PycraftAgent'
+        )
+
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+
+        self.server_close()
+
+
+def request(address, requests, timeout=None):
+    """
+    Send each request dictionary to the control API at address, yielding every reply. address
+    is either the path of a UNIX domain socket, or a (host, port) tuple for an agent. Replies are
+    read until no more replies are expected for each request.
+    """
+
+    if isinstance(address, basestring):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        client.connect(address)
+
+    else:
+        client = socket.create_connection(address, timeout)
+
+    try:
+        stream = client.makefile('r+')
+
+        for r in requests:
+            stream.write(json.dumps(r) + '\n')
+            stream.flush()
+
+            while True:
+                reply = json.loads(stream.readline())
+                yield reply
+
+                # Followed jobs stream events until the finished event. Replies without an
+                # event are either errors or the result of a command which is not a job.
+                if (r.get('follow') or r.get('command') == 'watch') \
+                        and reply.get('event') not in (None, 'finished'):
+                    continue
+
+                break
+
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    import config
+
+    for reply in request(config.CONTROL_SOCKET, [json.loads(arg) for arg in sys.argv[1:]]):
+        print(json.dumps(reply))
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Coordinates the servers of many Pycraft agents, one agent per host.
+
+Each agent is an ordinary Pycraft process with AGENT_ADDRESS set in its config.py, serving the
+control API over TCP. The controller polls every agent in config.CONTROLLER_AGENTS, and presents
+the whole fleet through its own control API on config.CONTROLLER_SOCKET. Fleet servers are named
+<agent>/<serverNick>, so a glob such as */lobby-* selects the lobby servers of every host.
+
+Operations on fleet servers are limited globally by CONTROLLER_CONCURRENCY, and on each agent by
+CONTROLLER_AGENT_CONCURRENCY, whichever job they belong to. Bulk jobs interleave the servers of
+different agents, so that restarts and backups are spread across hosts rather than taking
+every server on one host down together. Operations listed in CONTROLLER_SCHEDULE are repeated at
+their configured intervals.
+"""
+
+# Library modules
+import logging
+import re
+import sched
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Project modules
+import config
+import controlSocket
+
+
+def escapeGlob(text):
+    """
+    Returns a glob pattern which matches text literally.
+    """
+
+    return re.sub(r'([*?[])', r'[\1]', text)
+
+
+class AgentClient:
+    """
+    Sends control API requests to one agent.
+    """
+
+    # Seconds to wait for a reply to a status request before giving up on the agent.
+    STATUS_TIMEOUT = 15
+
+
+    def __init__(self, name, address, token):
+        self.name = name
+        self.address = tuple(address)
+        self.token = token
+
+
+    def request(self, request, timeout=None):
+        """
+        Send one request to the agent, yielding every reply. Raises controlSocket.ControlError if
+        the agent replies with an error.
+        """
+
+        request = dict(request, token=self.token)
+
+        for reply in controlSocket.request(self.address, [request], timeout):
+            if 'error' in reply and 'event' not in reply:
+                raise controlSocket.ControlError(
+                    'Agent {AGENT}: {ERROR}'.format(
+                        AGENT=self.name,
+                        ERROR=reply['error']
+                    )
+                )
+
+            yield reply
+
+
+    def status(self):
+        """
+        Returns the list of status dictionaries of every server on the agent.
+        """
+
+        for reply in self.request({'command': 'status'}, AgentClient.STATUS_TIMEOUT):
+            return reply['status']
+
+
+    def history(self, serverNick, count=None):
+        """
+        Returns the newest count entries of the journal of one of the agent's servers, or None
+        if it has no journal.
+        """
+
+        request = {'command': 'history', 'servers': escapeGlob(serverNick)}
+
+        if count is not None:
+            request['count'] = count
+
+        for reply in self.request(request, AgentClient.STATUS_TIMEOUT):
+            return reply['history'].get(serverNick)
+
+
+    def operate(self, operation, serverNick, **arguments):
+        """
+        Perform operation on one of the agent's servers, returning once it has completed.
+        Raises controlSocket.ControlError if the operation failed.
+        """
+
+        request = dict(
+            arguments,
+            command=operation,
+            servers=escapeGlob(serverNick),
+            follow=True
+        )
+
+        for reply in self.request(request):
+            if reply.get('event') == 'progress' and reply.get('state') == 'failed':
+                raise controlSocket.ControlError(
+                    'Agent {AGENT}: {ERROR}'.format(
+                        AGENT=self.name,
+                        ERROR=reply.get('error')
+                    )
+                )
+
+
+class RemoteServer:
+    """
+    Stands in for a server.Server on an agent, so that the controller's control API and jobs can
+    treat fleet servers just like local ones. Status is taken from the controller's most recent
+    poll of the agent.
+    """
+
+    def __init__(self, controller, agent, status):
+        self._controller = controller
+        self._agent = agent
+        self._status = status
+        self._nick = agent.name + '/' + status['server']
+
+
+    def getConfig(self, key):
+        if key == 'SERVER_NICK':
+            return self._nick
+
+        return None
+
+
+    def getTargetState(self):
+        return self._status['target'] == 'online'
+
+
+    def getUptime(self):
+        return self._status['uptime']
+
+
+    # Agents older than these fields leave them out of their status.
+    def isHibernating(self):
+        return self._status.get('hibernating', False)
+
+
+    def getAddress(self):
+        return self._agent.address[0], self._status.get('port')
+
+
+    def getGCStats(self):
+        return self._status.get('gc')
+
+
+    def getHistory(self, count=None):
+        return self._agent.history(self._status['server'], count)
+
+
+    def _operate(self, operation, **arguments):
+        # Hold a global and a per-agent slot for the whole operation.
+        with self._controller.semaphore:
+            with self._controller.agentSemaphores[self._agent.name]:
+                logging.info(
+                    'Controller performing {OPERATION} on {SERVER_NICK}.'.format(
+                        OPERATION=operation,
+                        SERVER_NICK=self._nick
+                    )
+                )
+
+                self._agent.operate(operation, self._status['server'], **arguments)
+
+        return True
+
+
+    def start(self):
+        return self._operate('start')
+
+
+    def stop(self):
+        return self._operate('stop')
+
+
+    def restart(self):
+        return self._operate('restart')
+
+
+    def backup(self):
+        return self._operate('backup')
+
+
+    def sendCommand(self, command):
+        return self._operate('send', text=command)
+
+
+class Controller:
+    """
+    Polls a set of agents, serves the fleet through the control API, and runs scheduled fleet
+    operations.
+    """
+
+    # Number of seconds between polls of every agent.
+    POLL_INTERVAL = 60
+
+
+    def __init__(self, agents, concurrency, agentConcurrency, schedule):
+        self.agents = [
+            AgentClient(name, address, config.AGENT_TOKEN)
+            for name, address in sorted(agents.iteritems())
+        ]
+
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+
+        self.agentSemaphores = dict(
+            (agent.name, threading.BoundedSemaphore(agentConcurrency)) for agent in self.agents
+        )
+
+        # The fleet's servers, replaced in place after each poll so that the control API always
+        # sees the latest list.
+        self.serverInstances = []
+
+        self.api = controlSocket.ControlAPI(self.serverInstances, concurrency)
+
+        self.schedule = schedule
+        self.scheduler = sched.scheduler(time.time, time.sleep)
+
+
+    def poll(self):
+        """
+        Request the status of every agent in parallel, and rebuild the list of fleet servers.
+        Servers are interleaved across agents, so that bulk jobs spread their work across hosts.
+        Agents which cannot be reached keep the servers from their previous poll.
+        """
+
+        previous = {}
+
+        for s in self.serverInstances:
+            previous.setdefault(s._agent.name, []).append(s)
+
+        results = {}
+
+        def pollAgent(agent):
+            try:
+                results[agent.name] = [RemoteServer(self, agent, st) for st in agent.status()]
+
+            except (socket.error, ValueError, controlSocket.ControlError) as e:
+                logging.warning(
+                    'Could not poll agent {AGENT}: {ERROR}'.format(
+                        AGENT=agent.name,
+                        ERROR=e
+                    )
+                )
+
+                results[agent.name] = previous.get(agent.name, [])
+
+        threads = [threading.Thread(target=pollAgent, args=(agent,)) for agent in self.agents]
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        perAgent = [results[agent.name] for agent in self.agents]
+        interleaved = []
+
+        for index in range(max([len(servers) for servers in perAgent] or [0])):
+            for servers in perAgent:
+                if index < len(servers):
+                    interleaved.append(servers[index])
+
+        self.serverInstances[:] = interleaved
+
+
+    def _scheduledPoll(self):
+        self.poll()
+        self.scheduler.enter(Controller.POLL_INTERVAL, 1, self._scheduledPoll, ())
+
+
+    def _scheduledOperation(self, entry):
+        self.scheduler.enter(entry['interval'], 1, self._scheduledOperation, (entry,))
+
+        try:
+            servers = self.api.matchServers(entry['servers'])
+
+        except controlSocket.ControlError as e:
+            logging.warning(
+                'Scheduled fleet {OPERATION} skipped: {ERROR}'.format(
+                    OPERATION=entry['operation'],
+                    ERROR=e
+                )
+            )
+
+            return
+
+        self.api.jobManager.submit(
+            entry['operation'],
+            servers,
+            {},
+            entry.get('concurrency', len(servers))
+        )
+
+
+    def run(self):
+        """
+        Poll the agents, then hand execution over to the scheduler.
+        """
+
+        self._scheduledPoll()
+
+        for entry in self.schedule:
+            self.scheduler.enter(entry['interval'], 1, self._scheduledOperation, (entry,))
+
+        logging.info('Running controller scheduler.')
+
+        self.scheduler.run()
+
+
+# Only execute if this is the main module.
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s %(message)s',
+        filename='controller.log',
+        level=logging.INFO
+    )
+
+    c = Controller(
+        config.CONTROLLER_AGENTS,
+        config.CONTROLLER_CONCURRENCY,
+        config.CONTROLLER_AGENT_CONCURRENCY,
+        config.CONTROLLER_SCHEDULE
+    )
+
+    controlServer = controlSocket.ControlServer(config.CONTROLLER_SOCKET, c.api)
+
+    def stop(signum=None, frame=None):
+        logging.info('Controller is stopping.')
+        controlServer.stop()
+        sys.exit(0)
+
+    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, stop)
+
+    controlServer.start()
+    c.run()
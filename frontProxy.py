@@ -0,0 +1,687 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A TCP front proxy which lets every server be reached on one public port.
+
+The proxy reads the handshake which every Minecraft client sends first, and routes the
+connection to the server whose PROXY_HOSTNAMES match the hostname the player connected to, or to
+PROXY_DEFAULT_SERVER if none do. The handshake is then passed on to the server unchanged, and
+from then on the proxy only relays bytes in both directions.
+
+All connections are served by one thread, with an epoll loop over non-blocking sockets. Each
+direction of a connection has one buffer, allocated when the connection is accepted, which is
+received into and sent from without copying. A direction is only read from once its buffer has
+been sent, so a slow player or server holds back the other end rather than filling memory.
+"""
+
+# Library modules
+import errno
+import fnmatch
+import logging
+import select
+import socket
+import threading
+import time
+
+# Project modules
+import mcprotocol
+
+
+# Errors of a non-blocking socket which mean it should be tried again later.
+_RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Errors of a non-blocking connect which mean it is still in progress.
+_CONNECTING_ERRORS = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK)
+
+# select.epoll is Linux only, other UNIX-like systems use select.poll with the same flags.
+if hasattr(select, 'epoll'):
+    _READ = select.EPOLLIN
+    _WRITE = select.EPOLLOUT
+    _ERROR = select.EPOLLERR | select.EPOLLHUP
+
+else:
+    _READ = select.POLLIN
+    _WRITE = select.POLLOUT
+    _ERROR = select.POLLERR | select.POLLHUP
+
+
+class _Incomplete(Exception):
+    """
+    Raised when the client has not yet sent all of its handshake.
+    """
+
+    pass
+
+
+class _HandshakeBuffer(mcprotocol.Buffer):
+    """
+    Reads the fields of a handshake which may not have been received in full.
+    """
+
+    def read(self, length):
+        if self.position + length > len(self.data):
+            raise _Incomplete()
+
+        return mcprotocol.Buffer.read(self, length)
+
+
+def _legacyString(data):
+    """
+    Reads a UTF-16 string of the protocol of 1.6 and older.
+    """
+
+    length = ord(data.read(1)) << 8 | ord(data.read(1))
+
+    return data.read(length * 2).decode('utf-16be')
+
+
+def handshakeHostname(data):
+    """
+    Returns the lower case hostname which a client connected to, read from the start of what it
+    has sent so far, or None if more data is needed. Returns an empty string for a legacy ping
+    which does not name a host. Raises mcprotocol.ProtocolError if the data is not a Minecraft
+    handshake.
+    """
+
+    if not data:
+        return None
+
+    try:
+        if data[0] == '\xfe':
+            # Legacy server list ping. Only the ping of 1.6 names the host, in an MC|PingHost
+            # plugin message, and older clients send nothing after the first two bytes.
+            if len(data) < 3:
+                return None
+
+            if data[2] != '\xfa':
+                return ''
+
+            ping = _HandshakeBuffer(data)
+            ping.read(3)
+
+            if _legacyString(ping) != u'MC|PingHost':
+                return ''
+
+            ping.read(3)
+            hostname = _legacyString(ping)
+
+        elif data[0] == '\x02':
+            # Legacy handshake of 1.6, which begins a login.
+            login = _HandshakeBuffer(data)
+            login.read(2)
+            _legacyString(login)
+            hostname = _legacyString(login)
+
+        else:
+            packet = _HandshakeBuffer(data)
+            length = packet.varint()
+
+            if len(data) < packet.position + length:
+                return None
+
+            # Errors after the whole packet has been received are not for want of data.
+            packet = mcprotocol.Buffer(data[packet.position:packet.position + length])
+            packetID = packet.varint()
+
+            if packetID != 0:
+                raise mcprotocol.ProtocolError('Expected a handshake, not packet {ID}.'.format(ID=packetID))
+
+            packet.varint()
+            hostname = packet.string()
+
+    except _Incomplete:
+        return None
+
+    except UnicodeDecodeError:
+        raise mcprotocol.ProtocolError('Hostname is not valid text.')
+
+    # Forge clients append a marker after a null character, and DNS names may end in a dot.
+    return hostname.split(u'\x00')[0].rstrip(u'.').lower().encode('utf-8')
+
+
+class _Direction:
+    """
+    One direction of a relayed connection: bytes received from source are sent to destination
+    through a buffer of its own.
+    """
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+        # The part of the buffer which is still to be sent.
+        self.start = 0
+        self.end = 0
+
+        # The time the data still to be sent was received.
+        self.received = 0
+
+        # Set once the source has closed its end.
+        self.eof = False
+
+
+    def pending(self):
+        return self.end > self.start
+
+
+class _ProxiedConnection:
+    """
+    A client connection, from when it is accepted until both ends have been closed.
+    """
+
+    HANDSHAKE = 0
+    CONNECTING = 1
+    RELAY = 2
+
+    def __init__(self, client, address, bufferSize):
+        self.client = client
+        self.address = address
+        self.backend = None
+        self.backendNick = None
+
+        self.state = _ProxiedConnection.HANDSHAKE
+        self.accepted = time.time()
+
+        # From the client to the server, and from the server to the client. The handshake is
+        # received into the first buffer, and is sent to the server from it once connected.
+        self.upstream = _Direction(bufferSize)
+        self.downstream = _Direction(bufferSize)
+
+        # The event masks each socket is currently registered with.
+        self.clientMask = None
+        self.backendMask = None
+
+        self.closed = False
+
+
+    def finished(self):
+        """
+        Returns True once both ends have closed, and everything they sent has been passed on.
+        """
+
+        return (
+            self.upstream.eof and self.downstream.eof
+            and not self.upstream.pending() and not self.downstream.pending()
+        )
+
+
+class FrontProxy(threading.Thread):
+    """
+    Listens on PROXY_ADDRESS, and relays each connection to the server it asks for.
+
+    Servers are looked up in serverInstances for every new connection, so servers added or
+    reconfigured by a reload, or switched to another instance by a blue/green restart, are
+    routed to at once.
+
+    Public methods:
+        start()
+        stop()
+        metrics()
+    """
+
+    # Bytes buffered in each direction of a connection.
+    BUFFER_SIZE = 64 * 1024
+
+    # Seconds a client has to send its handshake, and a server has to accept the connection.
+    HANDSHAKE_TIMEOUT = 5
+    CONNECT_TIMEOUT = 5
+
+    # Seconds between checks for timeouts and stop().
+    POLL_INTERVAL = 1
+
+
+    def __init__(self, address, serverInstances, defaultServer=None):
+        super(FrontProxy, self).__init__(name='Thread-PycraftFrontProxy')
+
+        self.daemon = True
+
+        self.address = tuple(address)
+        self.serverInstances = serverInstances
+
+        # Nick of the server which receives connections to hostnames no server claims.
+        self.defaultServer = defaultServer
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(self.address)
+        self._socket.listen(128)
+        self._socket.setblocking(0)
+
+        self._poller = select.epoll() if hasattr(select, 'epoll') else select.poll()
+        self._stopping = threading.Event()
+
+        # Maps the file descriptor of every client and server socket onto its connection.
+        self._connections = {}
+
+        # Maps each server's nick onto its counters, which are only written by the proxy thread.
+        self._metricsLock = threading.Lock()
+        self._backendMetrics = {}
+        self._unrouted = 0
+
+
+    def stop(self):
+        self._stopping.set()
+
+
+    def metrics(self):
+        """
+        Returns a dictionary mapping each server's nick onto the number of connections active
+        and made so far, the bytes relayed to and from it, and the milliseconds the proxy added:
+        setup latency from accepting a connection until the server has been sent its handshake,
+        and relay latency from receiving data until it has been sent on.
+        """
+
+        with self._metricsLock:
+            metrics = {}
+
+            for nick, counters in self._backendMetrics.iteritems():
+                metrics[nick] = {
+                    'activeConnections': counters['active'],
+                    'connections': counters['connections'],
+                    'bytesToServer': counters['bytesToServer'],
+                    'bytesToClients': counters['bytesToClients'],
+                    'meanSetupLatency': counters['setupLatency'] * 1000 / (counters['setups'] or 1),
+                    'maxSetupLatency': counters['maxSetupLatency'] * 1000,
+                    'meanRelayLatency': counters['relayLatency'] * 1000 / (counters['relays'] or 1),
+                    'maxRelayLatency': counters['maxRelayLatency'] * 1000
+                }
+
+            return {'servers': metrics, 'unroutedConnections': self._unrouted}
+
+
+    def _counters(self, nick):
+        if nick not in self._backendMetrics:
+            self._backendMetrics[nick] = {
+                'active': 0,
+                'connections': 0,
+                'bytesToServer': 0,
+                'bytesToClients': 0,
+                'setups': 0,
+                'setupLatency': 0.0,
+                'maxSetupLatency': 0.0,
+                'relays': 0,
+                'relayLatency': 0.0,
+                'maxRelayLatency': 0.0
+            }
+
+        return self._backendMetrics[nick]
+
+
+    def _route(self, hostname):
+        """
+        Returns the server which should receive a connection to hostname, or None.
+        """
+
+        default = None
+
+        for s in list(self.serverInstances):
+            for pattern in s.getConfig('PROXY_HOSTNAMES'):
+                if fnmatch.fnmatchcase(hostname, pattern.lower()):
+                    return s
+
+            if s.getConfig('SERVER_NICK') == self.defaultServer:
+                default = s
+
+        return default
+
+
+    def _register(self, connection):
+        """
+        Register each socket of the connection with the events it is waiting for.
+        """
+
+        clientMask = 0
+        backendMask = 0
+
+        if connection.state == _ProxiedConnection.HANDSHAKE:
+            clientMask = _READ
+
+        elif connection.state == _ProxiedConnection.CONNECTING:
+            backendMask = _WRITE
+
+        else:
+            # Each end is only read from once what it sent last has been passed on.
+            if not connection.upstream.pending() and not connection.upstream.eof:
+                clientMask |= _READ
+            if not connection.downstream.pending() and not connection.downstream.eof:
+                backendMask |= _READ
+
+            if connection.downstream.pending():
+                clientMask |= _WRITE
+            if connection.upstream.pending():
+                backendMask |= _WRITE
+
+        if clientMask != connection.clientMask:
+            if connection.clientMask is None:
+                self._poller.register(connection.client.fileno(), clientMask)
+            else:
+                self._poller.modify(connection.client.fileno(), clientMask)
+
+            connection.clientMask = clientMask
+
+        if connection.backend is not None and backendMask != connection.backendMask:
+            if connection.backendMask is None:
+                self._poller.register(connection.backend.fileno(), backendMask)
+            else:
+                self._poller.modify(connection.backend.fileno(), backendMask)
+
+            connection.backendMask = backendMask
+
+
+    def _close(self, connection, reason=None):
+        if connection.closed:
+            return
+
+        connection.closed = True
+
+        if reason is not None:
+            logging.debug(
+                'Closing proxied connection from {ADDRESS}: {REASON}'.format(
+                    ADDRESS=connection.address[0],
+                    REASON=reason
+                )
+            )
+
+        for s in (connection.client, connection.backend):
+            if s is None:
+                continue
+
+            self._connections.pop(s.fileno(), None)
+
+            try:
+                self._poller.unregister(s.fileno())
+            except (IOError, KeyError, ValueError):
+                pass
+
+            s.close()
+
+        if connection.backendNick is not None:
+            with self._metricsLock:
+                self._counters(connection.backendNick)['active'] -= 1
+
+            connection.backendNick = None
+
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self._socket.accept()
+
+            except socket.error as e:
+                if e.errno in _RETRY_ERRORS or e.errno == errno.ECONNABORTED:
+                    return
+
+                raise
+
+            client.setblocking(0)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            connection = _ProxiedConnection(client, address, FrontProxy.BUFFER_SIZE)
+            self._connections[client.fileno()] = connection
+            self._register(connection)
+
+
+    def _readHandshake(self, connection):
+        upstream = connection.upstream
+
+        received = connection.client.recv_into(upstream.view[upstream.end:])
+
+        if not received:
+            self._close(connection)
+            return
+
+        upstream.end += received
+
+        try:
+            hostname = handshakeHostname(str(upstream.buffer[:upstream.end]))
+
+        except mcprotocol.ProtocolError as e:
+            self._close(connection, e)
+            return
+
+        if hostname is None:
+            if upstream.end == len(upstream.buffer):
+                self._close(connection, 'Handshake is too long.')
+
+            return
+
+        s = self._route(hostname)
+
+        if s is None:
+            with self._metricsLock:
+                self._unrouted += 1
+
+            self._close(connection, 'No server for hostname {HOSTNAME}.'.format(HOSTNAME=hostname))
+            return
+
+        connection.backendNick = s.getConfig('SERVER_NICK')
+
+        with self._metricsLock:
+            counters = self._counters(connection.backendNick)
+            counters['active'] += 1
+            counters['connections'] += 1
+
+        backend = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        backend.setblocking(0)
+        backend.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.backend = backend
+        self._connections[backend.fileno()] = connection
+
+        try:
+            error = backend.connect_ex(s.getAddress())
+
+        except socket.error as e:
+            error = e.errno
+
+        if error not in _CONNECTING_ERRORS and error != 0:
+            self._close(connection, 'Could not connect to {SERVER_NICK} server: {ERROR}'.format(
+                SERVER_NICK=connection.backendNick,
+                ERROR=errno.errorcode.get(error, error)
+            ))
+            return
+
+        # The handshake is sent once the connection to the server has been made.
+        upstream.received = time.time()
+        connection.state = _ProxiedConnection.CONNECTING
+
+
+    def _connected(self, connection):
+        error = connection.backend.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error:
+            self._close(connection, 'Could not connect to {SERVER_NICK} server: {ERROR}'.format(
+                SERVER_NICK=connection.backendNick,
+                ERROR=errno.errorcode.get(error, error)
+            ))
+            return
+
+        connection.state = _ProxiedConnection.RELAY
+
+
+    def _send(self, connection, direction, destination):
+        """
+        Send as much of the direction's buffer as the destination accepts.
+        """
+
+        sent = destination.send(direction.view[direction.start:direction.end])
+        direction.start += sent
+
+        toServer = direction is connection.upstream
+
+        with self._metricsLock:
+            counters = self._counters(connection.backendNick)
+            counters['bytesToServer' if toServer else 'bytesToClients'] += sent
+
+            if direction.pending():
+                return
+
+            latency = time.time() - direction.received
+
+            if toServer and connection.accepted is not None:
+                # The first data sent to the server is the handshake, which ends the setup.
+                latency = time.time() - connection.accepted
+                connection.accepted = None
+
+                counters['setups'] += 1
+                counters['setupLatency'] += latency
+                counters['maxSetupLatency'] = max(counters['maxSetupLatency'], latency)
+
+            else:
+                counters['relays'] += 1
+                counters['relayLatency'] += latency
+                counters['maxRelayLatency'] = max(counters['maxRelayLatency'], latency)
+
+        direction.start = direction.end = 0
+
+        # Once the source has closed and everything it sent has been passed on, close the
+        # destination's sending side too.
+        if connection.finished():
+            self._close(connection)
+        elif direction.eof:
+            destination.shutdown(socket.SHUT_WR)
+
+
+    def _receive(self, connection, direction, source, destination):
+        received = source.recv_into(direction.buffer)
+
+        if not received:
+            direction.eof = True
+
+            if connection.finished():
+                self._close(connection)
+            else:
+                destination.shutdown(socket.SHUT_WR)
+
+            return
+
+        direction.received = time.time()
+        direction.start = 0
+        direction.end = received
+
+        # Most data can be sent on at once, without waiting for another event.
+        self._send(connection, direction, destination)
+
+
+    def _handle(self, fd, event):
+        connection = self._connections.get(fd)
+
+        if connection is None:
+            return
+
+        isClient = fd == connection.client.fileno()
+
+        try:
+            if event & _ERROR:
+                # Errors are reported whether or not they were asked for.
+                error = (connection.client if isClient else connection.backend).getsockopt(
+                    socket.SOL_SOCKET, socket.SO_ERROR
+                )
+
+                if error:
+                    raise socket.error(error, errno.errorcode.get(error, str(error)))
+
+
+            if connection.state == _ProxiedConnection.HANDSHAKE:
+                self._readHandshake(connection)
+
+            elif connection.state == _ProxiedConnection.CONNECTING:
+                self._connected(connection)
+
+                if connection.state == _ProxiedConnection.RELAY:
+                    self._send(connection, connection.upstream, connection.backend)
+
+            elif isClient:
+                if event & _WRITE and connection.downstream.pending():
+                    self._send(connection, connection.downstream, connection.client)
+
+                if event & (_READ | _ERROR) and not connection.upstream.pending():
+                    self._receive(connection, connection.upstream, connection.client, connection.backend)
+
+            else:
+                if event & _WRITE and connection.upstream.pending():
+                    self._send(connection, connection.upstream, connection.backend)
+
+                if event & (_READ | _ERROR) and not connection.downstream.pending():
+                    self._receive(connection, connection.downstream, connection.backend, connection.client)
+
+        except socket.error as e:
+            if e.errno in _RETRY_ERRORS:
+                return
+
+            self._close(connection, e)
+            return
+
+        if not connection.closed:
+            self._register(connection)
+
+
+    def _expire(self):
+        """
+        Close connections which have taken too long to send their handshake or to connect.
+        """
+
+        now = time.time()
+
+        for connection in set(self._connections.itervalues()):
+            if connection.state == _ProxiedConnection.HANDSHAKE and (
+                now - connection.accepted > FrontProxy.HANDSHAKE_TIMEOUT
+            ):
+                self._close(connection, 'Timed out waiting for the handshake.')
+
+            elif connection.state == _ProxiedConnection.CONNECTING and (
+                now - connection.upstream.received > FrontProxy.CONNECT_TIMEOUT
+            ):
+                self._close(connection, 'Timed out connecting to {SERVER_NICK} server.'.format(
+                    SERVER_NICK=connection.backendNick
+                ))
+
+
+    def run(self):
+        logging.info(
+            'Proxying connections on {HOST}:{PORT}.'.format(
+                HOST=self.address[0] or '*',
+                PORT=self.address[1]
+            )
+        )
+
+        listener = self._socket.fileno()
+        self._poller.register(listener, _READ)
+
+        # select.poll takes milliseconds where select.epoll takes seconds.
+        if hasattr(select, 'epoll'):
+            timeout = FrontProxy.POLL_INTERVAL
+        else:
+            timeout = FrontProxy.POLL_INTERVAL * 1000
+
+        lastExpiry = time.time()
+
+        try:
+            while not self._stopping.is_set():
+                try:
+                    events = self._poller.poll(timeout)
+
+                except (IOError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+
+                    raise
+
+                for fd, event in events:
+                    if fd == listener:
+                        self._accept()
+                    else:
+                        self._handle(fd, event)
+
+                if time.time() - lastExpiry >= FrontProxy.POLL_INTERVAL:
+                    self._expire()
+                    lastExpiry = time.time()
+
+        except Exception:
+            logging.exception('Front proxy failed.')
+
+        finally:
+            for connection in set(self._connections.itervalues()):
+                self._close(connection)
+
+            self._socket.close()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Follows the garbage collection log of a server's JVM, written by the unified logging of Java 9
+and later when START_SCRIPT passes an option such as:
+
+    -Xlog:gc:file=logs/gc.log:uptime,level,tags:filecount=5,filesize=10M
+
+Each pause is kept in a fixed size series with its duration, the heap before and after it, and
+the rate at which the heap had been allocated since the previous collection, from which
+percentiles of the pause times are reported and sustained trouble is detected.
+"""
+
+# Library modules
+import calendar
+import collections
+import logging
+import os
+import re
+import threading
+import time
+
+
+# Number of pauses kept for each server.
+SERIES_LENGTH = 1000
+
+# Matches a pause line, such as:
+# [12.345s][info][gc] GC(7) Pause Young (Normal) (G1 Evacuation Pause) 512M->128M(2048M) 12.345ms
+# Collectors which pause without reporting the heap, such as ZGC, omit the heap sizes.
+PAUSE_REGEX = re.compile(
+    r'(?P<decorations>(?:\[[^\]]*\])*)\s*GC\((?P<gc>\d+)\) (?P<kind>Pause .*?)'
+    r'(?: (?P<before>\d+)(?P<beforeUnit>[BKMG])->(?P<after>\d+)(?P<afterUnit>[BKMG])'
+    r'\((?P<total>\d+)(?P<totalUnit>[BKMG])\))? (?P<pause>\d+(?:\.\d+)?)ms\s*$'
+)
+
+# Matches the decorations which give the time of a line: the JVM's uptime in seconds or
+# milliseconds, or the date and time.
+UPTIME_REGEX = re.compile(r'\[(\d+(?:\.\d+)?)(s|ms)\]')
+DATE_REGEX = re.compile(r'\[(\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?([+-]\d\d\d\d)?\]')
+
+UNITS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+
+def _eventTime(decorations):
+    """
+    Returns the time of a line in seconds, either since the JVM started or since the epoch,
+    or None if its decorations do not include the time.
+    """
+
+    match = UPTIME_REGEX.search(decorations)
+
+    if match is not None:
+        return float(match.group(1)) / (1000 if match.group(2) == 'ms' else 1)
+
+    match = DATE_REGEX.search(decorations)
+
+    if match is not None:
+        seconds = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+
+        if match.group(2):
+            seconds += float('0.' + match.group(2))
+
+        # The offset of the local time zone from UTC, as +HHMM.
+        if match.group(3):
+            offset = int(match.group(3)[1:3]) * 3600 + int(match.group(3)[3:5]) * 60
+            seconds -= offset if match.group(3)[0] == '+' else -offset
+
+        return seconds
+
+    return None
+
+
+# Maps the path of each GC log onto its GCSeries, shared by its tailer and its server.
+_gcSeries = {}
+_gcSeriesLock = threading.Lock()
+
+
+def gcSeries(path):
+    """
+    Returns the GCSeries of the GC log, shared by every object which uses it.
+    """
+
+    path = os.path.abspath(path)
+
+    with _gcSeriesLock:
+        if path not in _gcSeries:
+            _gcSeries[path] = GCSeries()
+
+        return _gcSeries[path]
+
+
+class GCSeries:
+    """
+    The most recent pauses of one JVM, as a ring buffer of
+    (time, pause milliseconds, heap before, heap after, heap size, allocation rate) tuples, with
+    the heap in bytes and the allocation rate in bytes per second. The heap and the allocation
+    rate are None for pauses which did not report the heap.
+
+    Public methods:
+        add(time, pause, before, after, total)
+        reset()
+        summary()
+        sustained(window, pause, heap)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pauses = collections.deque(maxlen=SERIES_LENGTH)
+
+        # The time and heap after the last collection which reported the heap, from which the
+        # allocation rate until the next one is found.
+        self._lastTime = None
+        self._lastAfter = None
+
+
+    def reset(self):
+        """
+        Forget every pause, when the JVM has been restarted.
+        """
+
+        with self._lock:
+            self._pauses.clear()
+            self._lastTime = None
+            self._lastAfter = None
+
+
+    def add(self, eventTime, pause, before=None, after=None, total=None):
+        with self._lock:
+            rate = None
+
+            if before is not None:
+                if self._lastTime is not None and eventTime > self._lastTime \
+                        and before >= self._lastAfter:
+                    rate = (before - self._lastAfter) / (eventTime - self._lastTime)
+
+                self._lastTime = eventTime
+                self._lastAfter = after
+
+            self._pauses.append((eventTime, pause, before, after, total, rate))
+
+
+    def summary(self):
+        """
+        Returns a dictionary of the number of pauses kept, their median, 99th percentile and
+        longest durations in milliseconds, the heap after the last collection and the heap's
+        size in megabytes, and the mean allocation rate in megabytes per second. Returns None if
+        no pauses have been seen.
+        """
+
+        with self._lock:
+            if not self._pauses:
+                return None
+
+            pauses = [p[1] for p in self._pauses]
+            heaps = [p for p in self._pauses if p[3] is not None]
+            rates = [p[5] for p in self._pauses if p[5] is not None]
+
+            return {
+                'pauses': len(pauses),
+                'p50': _percentile(pauses, 50),
+                'p99': _percentile(pauses, 99),
+                'max': max(pauses),
+                'heapAfter': heaps[-1][3] / float(UNITS['M']) if heaps else None,
+                'heapSize': heaps[-1][4] / float(UNITS['M']) if heaps else None,
+                'allocationRate': sum(rates) / len(rates) / UNITS['M'] if rates else None
+            }
+
+
+    def sustained(self, window, pause=None, heap=None):
+        """
+        Returns a description of sustained GC trouble over the last window seconds of pauses,
+        or None if there is none. Trouble is a median pause longer than pause milliseconds, or
+        the heap after every collection being more than the fraction heap of the heap's size,
+        which no collection could bring it back below.
+        """
+
+        with self._lock:
+            if not self._pauses:
+                return None
+
+            latest = self._pauses[-1][0]
+            recent = [p for p in self._pauses if p[0] >= latest - window]
+
+        # A handful of pauses are not enough to call anything sustained.
+        if len(recent) < 10:
+            return None
+
+        if pause is not None:
+            median = _percentile([p[1] for p in recent], 50)
+
+            if median > pause:
+                return 'the median GC pause has been {MEDIAN:.1f} ms for {COUNT} pauses'.format(
+                    MEDIAN=median,
+                    COUNT=len(recent)
+                )
+
+        heaps = [p for p in recent if p[3] is not None]
+
+        if heap is not None and len(heaps) >= 10:
+            lowest = min(float(p[3]) / p[4] for p in heaps)
+
+            if lowest > heap:
+                return 'the heap has stayed over {PERCENT:.0f}% full after {COUNT} collections'.format(
+                    PERCENT=lowest * 100,
+                    COUNT=len(heaps)
+                )
+
+        return None
+
+
+class GCLogTailer(threading.Thread):
+    """
+    Follows a server's GC log, adding each pause to the log's GCSeries.
+
+    The log is identified by its inode. When the JVM rotates it, or a restarted JVM begins a
+    new one, the new log is read from its start, and the series is reset if the new log belongs
+    to a new JVM, whose uptime starts again from zero.
+    """
+
+    # Number of seconds between checks of the log for new lines.
+    POLL_INTERVAL = 1
+
+    # Maximum number of bytes read from the log at once.
+    CHUNK_SIZE = 1024 * 1024
+
+
+    def __init__(self, SERVER_NICK, path):
+        super(GCLogTailer, self).__init__(
+            name='Thread-PycraftGCLogTailer-{SERVER_NICK}'.format(SERVER_NICK=SERVER_NICK)
+        )
+
+        self.daemon = True
+
+        self.SERVER_NICK = SERVER_NICK
+        self.path = path
+        self.series = gcSeries(path)
+
+        self._stopping = threading.Event()
+
+        self._gcLog = None
+        self._inode = None
+
+        # The start of a line which has not been completely written yet.
+        self._partial = ''
+
+        # The time of the last pause, to notice a new JVM.
+        self._lastTime = None
+
+
+    def stop(self):
+        self._stopping.set()
+
+
+    def _line(self, line):
+        match = PAUSE_REGEX.match(line)
+
+        if match is None:
+            return
+
+        eventTime = _eventTime(match.group('decorations'))
+
+        if eventTime is None:
+            eventTime = time.time()
+
+        # The uptime of a new JVM begins again from zero.
+        if self._lastTime is not None and eventTime < self._lastTime:
+            self.series.reset()
+
+        self._lastTime = eventTime
+
+        if match.group('before') is not None:
+            self.series.add(
+                eventTime,
+                float(match.group('pause')),
+                int(match.group('before')) * UNITS[match.group('beforeUnit')],
+                int(match.group('after')) * UNITS[match.group('afterUnit')],
+                int(match.group('total')) * UNITS[match.group('totalUnit')]
+            )
+
+        else:
+            self.series.add(eventTime, float(match.group('pause')))
+
+
+    def _poll(self):
+        try:
+            inode = os.stat(self.path).st_ino
+
+        except OSError:
+            # The JVM has not created the log yet.
+            return
+
+        if inode != self._inode:
+            if self._gcLog is not None:
+                self._gcLog.close()
+
+            self._gcLog = open(self.path, 'rb')
+            self._inode = inode
+            self._partial = ''
+
+        elif os.fstat(self._gcLog.fileno()).st_size < self._gcLog.tell():
+            # The log was truncated.
+            self._gcLog.seek(0)
+            self._partial = ''
+
+        while True:
+            data = self._gcLog.read(GCLogTailer.CHUNK_SIZE)
+
+            if not data:
+                break
+
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+
+            for line in lines:
+                self._line(line)
+
+
+    def run(self):
+        logging.info(
+            'Following the GC log of {SERVER_NICK} server at {PATH}.'.format(
+                SERVER_NICK=self.SERVER_NICK,
+                PATH=self.path
+            )
+        )
+
+        try:
+            while not self._stopping.is_set():
+                try:
+                    self._poll()
+
+                except IOError as e:
+                    logging.warning(
+                        'Could not read the GC log of {SERVER_NICK} server: {ERROR}'.format(
+                            SERVER_NICK=self.SERVER_NICK,
+                            ERROR=e
+                        )
+                    )
+
+                self._stopping.wait(GCLogTailer.POLL_INTERVAL)
+
+        finally:
+            if self._gcLog is not None:
+                self._gcLog.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Answers for a hibernating server on its port, until a player tries to join it.
+
+A hibernating server has been stopped because no players were online, and Pycraft listens on
+its PORT in its place. Status pings, from both the server list of 1.7 and later clients and the
+legacy ping of 1.6 clients and Pycraft's own responsiveness check, are answered with the
+HIBERNATE_MOTD and no players. A login is answered by disconnecting the player with a message
+asking them to reconnect shortly, and wakes the server.
+"""
+
+# Library modules
+import json
+import logging
+import socket
+import threading
+
+# Project modules
+import mcprotocol
+
+
+class WakeListener(threading.Thread):
+    """
+    Listens on a hibernating server's port, calling wake once when a player tries to log in.
+
+    Public methods:
+        listen()
+        start()
+        stop()
+    """
+
+    # Seconds a client has to send its handshake.
+    CLIENT_TIMEOUT = 5
+
+    # Seconds between checks for stop().
+    POLL_INTERVAL = 1
+
+    # Shown to a player whose login woke the server.
+    WAKING_MESSAGE = u'The server is starting up, please reconnect in a minute.'
+
+    # Protocol version and name given in legacy ping responses.
+    LEGACY_PROTOCOL = 78
+    LEGACY_VERSION = u'1.6.4'
+
+
+    def __init__(self, SERVER_NICK, PORT, HIBERNATE_MOTD, wake):
+        super(WakeListener, self).__init__(
+            name='Thread-PycraftWakeListener-{SERVER_NICK}'.format(SERVER_NICK=SERVER_NICK)
+        )
+
+        self.daemon = True
+
+        self.SERVER_NICK = SERVER_NICK
+        self.PORT = PORT
+
+        # ServerConfig stores strings UTF-8 encoded, and the MOTD is formatted into unicode.
+        if isinstance(HIBERNATE_MOTD, str):
+            HIBERNATE_MOTD = HIBERNATE_MOTD.decode('utf-8')
+
+        self.HIBERNATE_MOTD = HIBERNATE_MOTD
+
+        # Called once, from this thread, when a player tries to log in.
+        self._wake = wake
+
+        self._socket = None
+        self._stopping = threading.Event()
+
+
+    def listen(self):
+        """
+        Bind the server's port. Raises socket.error if the port is still in use.
+        """
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        try:
+            s.bind(('', self.PORT))
+            s.listen(16)
+
+        except socket.error:
+            s.close()
+            raise
+
+        s.settimeout(WakeListener.POLL_INTERVAL)
+        self._socket = s
+
+
+    def stop(self):
+        """
+        Stop listening, and release the port at once so that the server can bind it.
+        """
+
+        self._stopping.set()
+
+        if self._socket is not None:
+            self._socket.close()
+
+
+    def _status(self, protocol):
+        return json.dumps({
+            'version': {'name': u'Sleeping', 'protocol': protocol},
+            'players': {'max': 0, 'online': 0},
+            'description': {'text': self.HIBERNATE_MOTD}
+        })
+
+
+    def _handle(self, client):
+        """
+        Answer one client. Returns True if the client tried to log in.
+        """
+
+        connection = mcprotocol.Connection(client)
+        first = connection.read(1)
+
+        if first == '\xfe':
+            # Legacy server list ping.
+            client.sendall(mcprotocol.legacyKick(u'\xa71\x00{PROTOCOL}\x00{VERSION}\x00{MOTD}\x000\x000'.format(
+                PROTOCOL=WakeListener.LEGACY_PROTOCOL,
+                VERSION=WakeListener.LEGACY_VERSION,
+                MOTD=self.HIBERNATE_MOTD
+            )))
+
+            return False
+
+        if first == '\x02':
+            # Legacy handshake, which begins a login.
+            client.sendall(mcprotocol.legacyKick(WakeListener.WAKING_MESSAGE))
+
+            return True
+
+        packetID, handshake = connection.packet(first)
+
+        if packetID != 0:
+            raise mcprotocol.ProtocolError('Expected a handshake, not packet {ID}.'.format(ID=packetID))
+
+        protocol = handshake.varint()
+        handshake.string()
+        handshake.read(2)
+        nextState = handshake.varint()
+
+        if nextState == 1:
+            packetID, request = connection.packet()
+            client.sendall(
+                mcprotocol.encodePacket(0, mcprotocol.encodeString(self._status(protocol).decode('utf-8')))
+            )
+
+            # The client measures the latency with a ping, which is echoed back.
+            packetID, ping = connection.packet()
+
+            if packetID == 1:
+                client.sendall(mcprotocol.encodePacket(1, ping.read(8)))
+
+            return False
+
+        if nextState == 2:
+            client.sendall(
+                mcprotocol.encodePacket(
+                    0,
+                    mcprotocol.encodeString(json.dumps({'text': WakeListener.WAKING_MESSAGE}).decode('utf-8'))
+                )
+            )
+
+            return True
+
+        raise mcprotocol.ProtocolError('Unknown handshake state {STATE}.'.format(STATE=nextState))
+
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                client, address = self._socket.accept()
+
+            except socket.timeout:
+                continue
+
+            except socket.error:
+                # The socket was closed by stop().
+                break
+
+            try:
+                client.settimeout(WakeListener.CLIENT_TIMEOUT)
+                login = self._handle(client)
+
+            except (socket.error, mcprotocol.ProtocolError) as e:
+                logging.debug(
+                    'Ignoring client {ADDRESS} of hibernating {SERVER_NICK} server: {ERROR}'.format(
+                        ADDRESS=address[0],
+                        SERVER_NICK=self.SERVER_NICK,
+                        ERROR=e
+                    )
+                )
+
+                login = False
+
+            except Exception:
+                # One bad client must not stop the listener, or the server would be started
+                # by its next check.
+                logging.exception(
+                    'Error while answering client {ADDRESS} of hibernating {SERVER_NICK} server.'.format(
+                        ADDRESS=address[0],
+                        SERVER_NICK=self.SERVER_NICK
+                    )
+                )
+
+                login = False
+
+            finally:
+                client.close()
+
+            if login:
+                logging.info(
+                    'Player at {ADDRESS} is waking {SERVER_NICK} server.'.format(
+                        ADDRESS=address[0],
+                        SERVER_NICK=self.SERVER_NICK
+                    )
+                )
+
+                self.stop()
+                self._wake()
+                break
+
+        if self._socket is not None:
+            self._socket.close()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pycraft's own log, written by a background thread so that a slow or stalled disk never blocks
+the thread which logs, such as a server's scheduler while it holds the server's lock.
+
+Logging calls only put their record on a queue. If the writer falls so far behind that the
+queue holds its capacity, records below WARNING are dropped rather than waited for, and the
+number dropped is logged once the writer catches up. Warnings and errors are always queued. The
+writer formats each record, as plain text or as one JSON object per line, and rotates the log by
+size, compressing each rotated log with gzip.
+
+Messages which are expensive to build, or logged on every server check at a level which is
+usually disabled, can be given as a LazyMessage, which is only formatted if the record is logged,
+and then by the writer rather than the thread which logged it.
+"""
+
+# Library modules
+import Queue
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import threading
+import time
+
+
+# Seconds stop() waits for the writer to write the records which are still queued.
+STOP_TIMEOUT = 10
+
+
+class LazyMessage(object):
+    """
+    A message in the '{KEY}'.format(KEY=...) style used throughout Pycraft, which is only
+    formatted if its record is logged. It may be formatted later by another thread, so its fields
+    should be values which do not change, such as strings and numbers.
+    """
+
+    __slots__ = ('template', 'fields')
+
+
+    def __init__(self, template, **fields):
+        self.template = template
+        self.fields = fields
+
+
+    def __str__(self):
+        return self.template.format(**self.fields)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object per line, with its time, level, thread, message and
+    any exception's traceback.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': '{TIME}.{MILLISECONDS:03d}Z'.format(
+                TIME=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                MILLISECONDS=int(record.msecs)
+            ),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates the log once it reaches maxBytes, compressing each rotated log, so that the log
+    rotates through <path>.1.gz to <path>.<backupCount>.gz.
+    """
+
+    def _backupPath(self, index):
+        return '{PATH}.{INDEX}.gz'.format(PATH=self.baseFilename, INDEX=index)
+
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        if self.backupCount > 0:
+            for index in range(self.backupCount - 1, 0, -1):
+                if os.path.exists(self._backupPath(index)):
+                    os.rename(self._backupPath(index), self._backupPath(index + 1))
+
+            # Compressed from a renamed copy, so a crash part way through never loses the log.
+            rotated = self.baseFilename + '.1'
+            os.rename(self.baseFilename, rotated)
+
+            with open(rotated, 'rb') as source:
+                with gzip.open(self._backupPath(1) + '.tmp', 'wb') as destination:
+                    shutil.copyfileobj(source, destination)
+
+            os.rename(self._backupPath(1) + '.tmp', self._backupPath(1))
+            os.remove(rotated)
+
+        self.stream = self._open()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts each record on a queue for a LogWriter, without waiting for room on the queue. Once
+    capacity records are queued, records below WARNING are dropped.
+    """
+
+    def __init__(self, queue, capacity):
+        logging.Handler.__init__(self)
+
+        self.queue = queue
+        self.capacity = capacity
+
+        # Number of records dropped because the queue was full, until the writer reports them.
+        self._dropped = 0
+        self._droppedTotal = 0
+        self._droppedLock = threading.Lock()
+
+        # Formats tracebacks in the thread which logged them, while they still exist.
+        self._formatter = logging.Formatter()
+
+
+    def _prepare(self, record):
+        """
+        Fix the record's message and traceback as strings, so that the writer does not format
+        them from objects which may have changed, or keep the objects alive. A LazyMessage is
+        left for the writer to format.
+        """
+
+        if not (isinstance(record.msg, LazyMessage) and not record.args):
+            record.msg = record.getMessage()
+            record.args = None
+
+        if record.exc_info:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+    def emit(self, record):
+        try:
+            if record.levelno < logging.WARNING and self.queue.qsize() >= self.capacity:
+                with self._droppedLock:
+                    self._dropped += 1
+                    self._droppedTotal += 1
+
+                return
+
+            self.queue.put_nowait(self._prepare(record))
+
+        except Exception:
+            self.handleError(record)
+
+
+    def takeDropped(self):
+        """
+        Returns the number of records dropped since the last call.
+        """
+
+        with self._droppedLock:
+            dropped = self._dropped
+            self._dropped = 0
+
+        return dropped
+
+
+    def metrics(self):
+        with self._droppedLock:
+            return {
+                'queued': self.queue.qsize(),
+                'dropped': self._droppedTotal
+            }
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes the records queued by a QueueHandler to a handler, until it is stopped.
+    """
+
+    def __init__(self, queueHandler, handler):
+        super(LogWriter, self).__init__(name='Thread-PycraftLogWriter')
+
+        self.daemon = True
+
+        self.queueHandler = queueHandler
+        self.handler = handler
+
+
+    def stop(self):
+        """
+        Write the records which are already queued, then stop.
+        """
+
+        self.queueHandler.queue.put(None)
+
+
+    def _write(self, record):
+        if record.levelno >= self.handler.level:
+            self.handler.handle(record)
+
+
+    def run(self):
+        while True:
+            record = self.queueHandler.queue.get()
+
+            if record is None:
+                break
+
+            self._write(record)
+
+            dropped = self.queueHandler.takeDropped()
+
+            if dropped:
+                self._write(
+                    logging.LogRecord(
+                        'root',
+                        logging.WARNING,
+                        __file__,
+                        0,
+                        '{DROPPED} log records were dropped, as the log could not be written quickly enough.'.format(
+                            DROPPED=dropped
+                        ),
+                        None,
+                        None
+                    )
+                )
+
+        self.handler.close()
+
+
+# The handler and writer installed by configure().
+_queueHandler = None
+_writer = None
+
+
+def configure(path, level='INFO', maxBytes=10 * 1024 * 1024, backups=5, structured=False,
+              queueSize=10000):
+    """
+    Send every record logged at level or above to the log at path, through a queue and a
+    LogWriter thread. Records below WARNING are dropped while queueSize records are queued. The
+    log is rotated once it reaches maxBytes, keeping backups compressed logs, and is written as
+    JSON lines if structured is True.
+    """
+
+    global _queueHandler, _writer
+
+    handler = CompressingRotatingFileHandler(path, maxBytes=maxBytes, backupCount=backups)
+
+    if structured:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+
+    # Unbounded, as warnings and errors are queued beyond queueSize.
+    _queueHandler = QueueHandler(Queue.Queue(), queueSize)
+    _writer = LogWriter(_queueHandler, handler)
+
+    root = logging.getLogger()
+    root.handlers = [_queueHandler]
+    root.setLevel(level)
+
+    _writer.start()
+
+    # Queued records are written when Pycraft exits.
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Write the queued records and stop the writer.
+    """
+
+    if _writer is None or not _writer.is_alive():
+        return
+
+    _writer.stop()
+    _writer.join(STOP_TIMEOUT)
+
+
+def metrics():
+    """
+    Returns the number of records waiting to be written and the number dropped since Pycraft
+    started, or None if the log has not been configured.
+    """
+
+    if _queueHandler is None:
+        return None
+
+    return _queueHandler.metrics()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reads and writes the parts of the Minecraft protocol which Pycraft speaks itself: the handshake,
+status and login packets answered for hibernating servers, and the handshakes which the front
+proxy routes by.
+"""
+
+# Library modules
+import struct
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a client sends something which is not a Minecraft handshake.
+    """
+
+    pass
+
+
+class Connection:
+    """
+    Reads the fields of Minecraft packets from a client socket.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+
+    def read(self, length):
+        data = ''
+
+        while len(data) < length:
+            chunk = self.client.recv(length - len(data))
+
+            if not chunk:
+                raise ProtocolError('Connection closed.')
+
+            data += chunk
+
+        return data
+
+
+    def varint(self, first=None):
+        """
+        Read a varint, of which first is the first byte if it has already been read.
+        """
+
+        value = 0
+
+        for shift in range(0, 35, 7):
+            byte = ord(first if first is not None and shift == 0 else self.read(1))
+            value |= (byte & 0x7f) << shift
+
+            if byte < 0x80:
+                return value
+
+        raise ProtocolError('Varint is too long.')
+
+
+    def packet(self, first=None):
+        """
+        Read a packet, returning a tuple of its ID and its data.
+        """
+
+        length = self.varint(first)
+
+        if length < 1 or length > 32767:
+            raise ProtocolError('Invalid packet length {LENGTH}.'.format(LENGTH=length))
+
+        data = Buffer(self.read(length))
+
+        return data.varint(), data
+
+
+class Buffer(Connection):
+    """
+    Reads the fields of a packet which has already been received.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+
+    def read(self, length):
+        if self.position + length > len(self.data):
+            raise ProtocolError('Packet is too short.')
+
+        self.position += length
+
+        return self.data[self.position - length:self.position]
+
+
+    def string(self):
+        return self.read(self.varint()).decode('utf-8')
+
+
+def encodeVarint(value):
+    """
+    Returns the bytes of a varint.
+    """
+
+    data = ''
+
+    while value > 0x7f:
+        data += chr((value & 0x7f) | 0x80)
+        value >>= 7
+
+    return data + chr(value)
+
+
+def encodePacket(packetID, data):
+    """
+    Returns a packet with its length and ID.
+    """
+
+    data = encodeVarint(packetID) + data
+
+    return encodeVarint(len(data)) + data
+
+
+def encodeString(text):
+    """
+    Returns a unicode string as a length prefixed UTF-8 string.
+    """
+
+    data = text.encode('utf-8')
+
+    return encodeVarint(len(data)) + data
+
+
+def legacyKick(text):
+    """
+    Returns the 0xFF kick packet of 1.6 and older, which also carries legacy ping responses.
+    """
+
+    return '\xff' + struct.pack('>H', len(text)) + text.encode('utf-16be')
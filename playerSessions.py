@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Library modules
+import array
+import bisect
+import mmap
+import os
+import re
+import threading
+import time
+
+
+# Event types stored in the events column.
+JOIN = 1
+LEAVE = 2
+STARTUP = 3
+
+# The session rules used for ForgeModLoader logs, as (event, pattern, contains) tuples. Each
+# pattern is matched against the start of a log line, and has date and username groups.
+# contains is a string which every line it matches contains, used to skip other lines quickly.
+FML_SESSION_RULES = (
+    (
+        JOIN,
+        r'(?P<date>\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d) \[INFO\] \[Minecraft-Server\] (?P<username>\w+) ?\[/[^\]]*\] logged in with entity id',
+        ' logged in with entity id '
+    ),
+    (
+        LEAVE,
+        r'(?P<date>\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d) \[INFO\] \[Minecraft-Server\] (?P<username>\w+) lost connection: ',
+        ' lost connection: '
+    )
+)
+
+# The session rules used for logs/latest.log of vanilla and Paper servers, whose lines only
+# have the time of day. A player leaving is logged twice, which is harmless as a player who is
+# not online cannot leave.
+VANILLA_SESSION_RULES = (
+    (
+        JOIN,
+        r'\[(?P<time>\d\d:\d\d:\d\d)(?:\] \[[^\]]+/| )INFO\]: (?P<username>\w+) joined the game',
+        ' joined the game'
+    ),
+    (
+        LEAVE,
+        r'\[(?P<time>\d\d:\d\d:\d\d)(?:\] \[[^\]]+/| )INFO\]: (?P<username>\w+) left the game',
+        ' left the game'
+    ),
+    (
+        LEAVE,
+        r'\[(?P<time>\d\d:\d\d:\d\d)(?:\] \[[^\]]+/| )INFO\]: (?P<username>\w+) lost connection: ',
+        ' lost connection: '
+    )
+)
+
+# Matches the date or time at the start of the first line of a log.
+HEADER_REGEX = re.compile(r'(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)|\[(\d\d:\d\d:\d\d)')
+
+
+def _timestamp(date):
+    """
+    Returns the seconds since the epoch of a YYYY-MM-DD HH:MM:SS local time.
+    """
+
+    return int(time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S')))
+
+
+class SessionExtractor:
+    """
+    Extracts players joining and leaving from the lines of a server log, as tuples of
+    (timestamp, username, event).
+
+    The lines are encoded bytes, as the events only need the ASCII usernames and dates. Lines
+    of logs which are only stamped with the time of day are given the day passed to extract.
+    """
+
+    def __init__(self, rules=FML_SESSION_RULES):
+        self.rules = [(event, re.compile(pattern)) for event, pattern, contains in rules]
+        self.contains = sorted(set(contains for event, pattern, contains in rules))
+        self.containsRegEx = re.compile('|'.join(re.escape(contains) for contains in self.contains))
+
+
+    def header(self, fmlLine, day=None):
+        """
+        Returns the startup event for the first line of a log, or None if it has no date.
+        """
+
+        match = HEADER_REGEX.match(fmlLine)
+
+        if match is None:
+            return None
+
+        if match.group(1) is not None:
+            return (_timestamp(match.group(1)), None, STARTUP)
+
+        if day is None:
+            return None
+
+        return (_timestamp(day + ' ' + match.group(2)), None, STARTUP)
+
+
+    def extract(self, fmlLine, day=None):
+        """
+        Returns the event of a log line, or None if it is not a player joining or leaving.
+        """
+
+        for contains in self.contains:
+            if contains in fmlLine:
+                break
+        else:
+            return None
+
+        for event, regEx in self.rules:
+            match = regEx.match(fmlLine)
+
+            if match is None:
+                continue
+
+            fields = match.groupdict()
+
+            if 'date' in fields:
+                date = fields['date']
+            elif day is not None:
+                date = day + ' ' + fields['time']
+            else:
+                return None
+
+            return (_timestamp(date), fields['username'].decode('utf-8'), event)
+
+        return None
+
+
+    def extractMapped(self, fmlLog):
+        """
+        Returns the events of a whole log file, opened in binary mode. The log is memory-mapped,
+        and only the lines containing one of the rules' strings are matched.
+        """
+
+        try:
+            fmlMap = mmap.mmap(fmlLog.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except ValueError:
+            # The log is empty.
+            return []
+
+        try:
+            end = fmlMap.find('\n') + 1 or len(fmlMap)
+            header = self.header(fmlMap[:end])
+
+            if header is None:
+                return []
+
+            events = [header]
+            lastLine = None
+
+            for match in self.containsRegEx.finditer(fmlMap, end):
+                line = fmlMap.rfind('\n', 0, match.start()) + 1
+
+                if line == lastLine:
+                    continue
+
+                lastLine = line
+                event = self.extract(fmlMap[line:fmlMap.find('\n', line) + 1 or len(fmlMap)])
+
+                if event is not None:
+                    events.append(event)
+
+            return events
+
+        finally:
+            fmlMap.close()
+
+
+# Maps the path of each server onto its SessionStore, shared by every extractor and query.
+_sessionStores = {}
+_sessionStoresLock = threading.Lock()
+
+
+def sessionStore(SERVER_PATH):
+    """
+    Returns the SessionStore of the server, shared by every object which uses it.
+    """
+
+    SERVER_PATH = os.path.abspath(SERVER_PATH)
+
+    with _sessionStoresLock:
+        if SERVER_PATH not in _sessionStores:
+            _sessionStores[SERVER_PATH] = SessionStore(SERVER_PATH)
+
+        return _sessionStores[SERVER_PATH]
+
+
+class SessionStore:
+    """
+    An append-only columnar store of the events of players joining and leaving a server, in
+    the sessions directory of the server.
+
+    Each column is a file of fixed size values, which is read into a typed array in one call
+    and appended to with the raw bytes of an array: timestamps.col holds 32 bit seconds since
+    the epoch, players.col 32 bit player IDs, and events.col the 8 bit event types. Usernames
+    are interned in players.txt, one per line, where a player's ID is their line number. If
+    Pycraft stopped part way through an append, the columns are cut back to their shortest
+    length when they are next read.
+
+    Events are stored in the order they happened. Events older than the newest stored event are
+    lines of a log being read again, such as after Pycraft restarts from a chatlog checkpoint,
+    and are dropped, as are events identical to one already stored at the newest time.
+
+    Public methods:
+        append(events)
+        peakConcurrency(start, end, interval)
+        playtime(start, end)
+    """
+
+    # Maps the name of each column onto the type code of its array.
+    COLUMNS = (
+        ('timestamps', 'I'),
+        ('players', 'I'),
+        ('events', 'B')
+    )
+
+
+    def __init__(self, SERVER_PATH):
+        self.SERVER_PATH = SERVER_PATH
+        self.directory = SERVER_PATH + '/sessions'
+        self.namesPath = self.directory + '/players.txt'
+
+        self._lock = threading.Lock()
+
+        # The columns, read on first use.
+        self._columns = None
+
+        # The interned usernames, as first seen, and the ID of each lower case username.
+        self._names = []
+        self._ids = {}
+
+
+    def _columnPath(self, name):
+        return '{DIRECTORY}/{NAME}.col'.format(DIRECTORY=self.directory, NAME=name)
+
+
+    def _load(self):
+        self._columns = {}
+
+        for name, typeCode in SessionStore.COLUMNS:
+            column = array.array(typeCode)
+
+            try:
+                with open(self._columnPath(name), 'rb') as f:
+                    data = f.read()
+
+            except IOError:
+                data = ''
+
+            # Without any value which was only partly written.
+            column.fromstring(data[:len(data) - len(data) % column.itemsize])
+
+            self._columns[name] = column
+
+        rows = min(len(column) for column in self._columns.itervalues())
+
+        for name, typeCode in SessionStore.COLUMNS:
+            column = self._columns[name]
+            del column[rows:]
+
+            # Later appends must begin at a whole row.
+            path = self._columnPath(name)
+
+            if os.path.exists(path) and os.path.getsize(path) != rows * column.itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(rows * column.itemsize)
+
+        try:
+            with open(self.namesPath, 'rb') as f:
+                self._names = [name.decode('utf-8') for name in f.read().splitlines()]
+
+        except IOError:
+            self._names = []
+
+        self._ids = dict((name.lower(), index) for index, name in enumerate(self._names))
+
+
+    def _columnsLoaded(self):
+        if self._columns is None:
+            self._load()
+
+        return self._columns
+
+
+    def append(self, events):
+        """
+        Store a list of (timestamp, username, event) tuples, where username is None for the
+        startup event.
+        """
+
+        with self._lock:
+            columns = self._columnsLoaded()
+            timestamps = columns['timestamps']
+
+            newest = timestamps[-1] if timestamps else 0
+            index = bisect.bisect_left(timestamps, newest)
+
+            # The events already stored at the newest time, which are not stored twice.
+            stored = set(
+                (timestamps[i], columns['players'][i], columns['events'][i])
+                for i in range(index, len(timestamps))
+            )
+
+            names = []
+            added = dict((name, array.array(typeCode)) for name, typeCode in SessionStore.COLUMNS)
+
+            for timestamp, username, event in events:
+                # Usernames are not case sensitive. Startups have no player.
+                if username is None:
+                    player = 0
+                elif username.lower() in self._ids:
+                    player = self._ids[username.lower()]
+                else:
+                    player = self._ids[username.lower()] = len(self._names)
+                    self._names.append(username)
+                    names.append(username)
+
+                if timestamp < newest or (timestamp, player, event) in stored:
+                    continue
+
+                if timestamp > newest:
+                    newest = timestamp
+                    stored = set()
+
+                stored.add((timestamp, player, event))
+
+                added['timestamps'].append(timestamp)
+                added['players'].append(player)
+                added['events'].append(event)
+
+            if not os.path.isdir(self.directory):
+                os.mkdir(self.directory)
+
+            # Usernames are written first, so that every stored ID has its name.
+            if names:
+                with open(self.namesPath, 'ab') as f:
+                    f.write(''.join(name.encode('utf-8') + '\n' for name in names))
+
+            if added['timestamps']:
+                for name, typeCode in SessionStore.COLUMNS:
+                    with open(self._columnPath(name), 'ab') as f:
+                        added[name].tofile(f)
+
+                    columns[name].extend(added[name])
+
+
+    def _sessions(self, start, end):
+        """
+        Yields a tuple of (player ID, join time, leave time) for every session overlapping start
+        to end, clipped to them, in the order the sessions ended. Sessions still open at the
+        last event end at end. A startup ends every session at the last event before it, as the
+        time the server stopped is unknown.
+        """
+
+        columns = self._columnsLoaded()
+        timestamps = columns['timestamps']
+        players = columns['players']
+        events = columns['events']
+
+        # Only the events before end are needed, but the players online at start depend on
+        # every event before it.
+        last = bisect.bisect_right(timestamps, end)
+
+        # Maps each online player onto the time they joined.
+        online = {}
+        previous = start
+
+        for timestamp, player, event in zip(timestamps[:last], players[:last], events[:last]):
+            if event == JOIN:
+                if player not in online:
+                    online[player] = timestamp
+
+            elif event == LEAVE:
+                joined = online.pop(player, None)
+
+                if joined is not None and timestamp > start:
+                    yield player, max(joined, start), timestamp
+
+            else:
+                if previous > start:
+                    for onlinePlayer, joined in online.iteritems():
+                        yield onlinePlayer, max(joined, start), max(joined, previous)
+
+                online = {}
+
+            previous = timestamp
+
+        for player, joined in online.iteritems():
+            yield player, max(joined, start), end
+
+
+    def peakConcurrency(self, start, end, interval=3600):
+        """
+        Returns a list of (interval start, peak number of players online) for every interval
+        from start to end.
+        """
+
+        with self._lock:
+            buckets = (end - start) // interval + 1
+
+            # The change in the number of players online at each boundary of a session, in
+            # time order, so that a leave and a join at the same time are not counted at once.
+            changes = []
+
+            for player, joined, left in self._sessions(start, end):
+                changes.append((joined, 1))
+                changes.append((left, -1))
+
+            changes.sort()
+
+            peaks = []
+            count = 0
+            position = 0
+
+            for bucket in range(buckets):
+                # An interval begins with the players left online by the one before it.
+                peak = count
+                bucketEnd = start + (bucket + 1) * interval
+
+                while position < len(changes) and changes[position][0] < bucketEnd:
+                    count += changes[position][1]
+                    peak = max(peak, count)
+                    position += 1
+
+                peaks.append((start + bucket * interval, peak))
+
+            return peaks
+
+
+    def playtime(self, start, end):
+        """
+        Returns a list of (username, seconds played) from start to end, most played first.
+        """
+
+        with self._lock:
+            totals = {}
+
+            for player, joined, left in self._sessions(start, end):
+                totals[player] = totals.get(player, 0) + left - joined
+
+            return sorted(
+                ((self._names[player], seconds) for player, seconds in totals.iteritems()),
+                key=lambda total: total[1],
+                reverse=True
+            )
@@ -8,13 +8,18 @@ Each server has its own configuration options which are defined in config.py.
 
 # Library modules
 import logging
+import os
 import signal
 import sys
+import threading
+import time
 
 # Project modules
-import chatlog
 import config
+import controlSocket
+import logPipeline
 import server
+import serverConfig
 import stdinListener
 
 # Authorship information
@@ -33,17 +38,44 @@ class Pycraft:
     to be instantiated.
     """
 
+    # Seconds after SHUTDOWN_DEADLINE that servers stopping in parallel have to finish, before
+    # those still held up by another thread are killed.
+    SHUTDOWN_GRACE = 30
+
+
     def __init__(self):
 
         # A list to contain instances of the server.Server class
         self.serverInstances = []
 
-        # A list to contain instances of the chatlog.FMLLogObserver class
+        # Loads per-server configuration files from config.CONF_DIR, or None if the legacy
+        # config.config list is being used.
+        self.configLoader = None
+
+        # A list to contain instances of the chatlog.FMLLogObserver and chatlog.FMLLogTailer
+        # classes
         self.observerInstances = []
 
         # The instance of the stdinListener thread.
         self.stdinListenerThread = None
 
+        # The instance of the controlSocket.ControlServer, if the control API is enabled.
+        self.controlServer = None
+
+        # The instance of the controlSocket.AgentServer, if this host is managed by a controller.
+        self.agentServer = None
+
+        # The instance of the frontProxy.FrontProxy, if players reach the servers through it.
+        self.frontProxy = None
+
+        # The chatlog.FMLLogObserver which extracts the chat of servers whose logs are rotated,
+        # and the chatlog.ChatlogSegmenter shared by servers with CHATLOG_SEGMENTS, once needed.
+        self.fmlLogObserver = None
+        self.chatlogSegmenter = None
+
+        # Set once shutdownAll() has begun, so that a repeated signal does not begin it again.
+        self.shuttingDown = False
+
         # Register Pycraft.stop() as the function to call when the OS sends any of
         # the following signals
         logging.debug('Registering signal handlers.')
@@ -51,26 +83,22 @@ class Pycraft:
         for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
             signal.signal(sig, self.stop)
 
+        # SIGUSR1 stops every server before Pycraft exits. If configured, so does SIGTERM, which
+        # is sent by the init system when the host is shutting down.
+        signal.signal(signal.SIGUSR1, self.shutdownAll)
 
-        # Add new instances of the server.Server class to the serverInstances list, and initialise
-        # them with the corresponding config dictionary.
-
-        for configDict in config.config:
-            self.serverInstances.append(
-                server.Server(configDict)
-            )
+        if config.SHUTDOWN_ALL_ON_SIGTERM:
+            signal.signal(signal.SIGTERM, self.shutdownAll)
 
 
-        # For each server that is configured to have a chatlog, instantiate a FMLLogObserver
-        # class to monitor that server's log file and extract the chat entries to a chatlog.
+        # Add new instances of the server.Server class to the serverInstances list, and initialise
+        # them with the corresponding validated configuration. Every server adopts the same scan
+        # of the host's processes, rather than scanning separately.
 
-        for s in self.serverInstances:
-            if s.getConfig('ENABLE_CHATLOG'):
-                self.observerInstances.append(
-                    chatlog.FMLLogObserver(
-                        s.getConfig('SERVER_NICK'),
-                        s.getConfig('SERVER_PATH')
-                    )
+        with server.ProcessTable.shared():
+            for serverConfig in self.loadConfig():
+                self.serverInstances.append(
+                    server.Server(serverConfig)
                 )
 
 
@@ -78,9 +106,223 @@ class Pycraft:
         
         self.stdinListenerThread = stdinListener.StdinListener(
             self.serverInstances,
-            __version__
+            __version__,
+            self.reloadConfig
+        )
+
+        # The control socket and the agent share one ControlAPI, so that jobs started through
+        # either can be watched through both.
+        controlAPI = controlSocket.ControlAPI(
+            self.serverInstances,
+            config.CONTROL_CONCURRENCY,
+            self.metrics
         )
 
+        if config.CONTROL_SOCKET:
+            logging.debug('Initialising control socket.')
+
+            self.controlServer = controlSocket.ControlServer(config.CONTROL_SOCKET, controlAPI)
+
+        if config.AGENT_ADDRESS:
+            logging.debug('Initialising agent server.')
+
+            try:
+                self.agentServer = controlSocket.AgentServer(
+                    tuple(config.AGENT_ADDRESS),
+                    config.AGENT_TOKEN,
+                    controlAPI
+                )
+
+            except controlSocket.ControlError as e:
+                raise serverConfig.ConfigError(str(e))
+
+        # The frontProxy module is only imported if the proxy is enabled.
+        if config.PROXY_ADDRESS:
+            import frontProxy
+
+            logging.debug('Initialising front proxy.')
+
+            self.frontProxy = frontProxy.FrontProxy(
+                config.PROXY_ADDRESS,
+                self.serverInstances,
+                config.PROXY_DEFAULT_SERVER
+            )
+
+        # The observers are started by run().
+        for s in self.serverInstances:
+            self.setUpServer(s)
+
+
+    def metrics(self):
+        """
+        Returns a dictionary of the metrics of each chatlog writer, by the nick of the server
+        whose chatlog is being tailed, of Pycraft's log writer, and of the front proxy if it is
+        enabled.
+        """
+
+        metrics = {
+            'chatlog': dict(
+                (o.SERVER_NICK, o.metrics()) for o in self.observerInstances
+                if hasattr(o, 'metrics')
+            ),
+            'logging': logPipeline.metrics()
+        }
+
+        if self.frontProxy is not None:
+            metrics['proxy'] = self.frontProxy.metrics()
+
+        return metrics
+
+
+    def loadConfig(self):
+        """
+        Returns a list of validated serverConfig.ServerConfig objects, read from the
+        config.CONF_DIR directory if it exists, or else from the config.config list.
+        """
+
+        if self.configLoader is None and os.path.isdir(config.CONF_DIR):
+            logging.info(
+                'Loading server configuration from {CONF_DIR}.'.format(
+                    CONF_DIR=config.CONF_DIR
+                )
+            )
+
+            self.configLoader = serverConfig.ConfigLoader(config.CONF_DIR)
+
+        if self.configLoader is not None:
+            return self.configLoader.load()
+
+        return serverConfig.fromLegacyConfig(config.config)
+
+
+    def setUpServer(self, s):
+        """
+        Create the observers which follow the logs of a server, for its chatlog, sessions and GC
+        log. Called for each server at startup, and for each server added by reloadConfig().
+        Returns a list of the observers created, which the caller must start.
+        """
+
+        observers = []
+
+        # For a server that is configured to have a chatlog, either watch that server's log
+        # directory with the shared FMLLogObserver, which extracts the chat entries to a chatlog
+        # when the log is rotated, or instantiate a FMLLogTailer or LatestLogTailer class to
+        # follow the live log.
+        # The chatlog module, and the watchdog package it requires, are only imported if at
+        # least one server has a chatlog.
+        # Servers with CHATLOG_SEGMENTS enabled also have their chatlogs rolled into segments by
+        # one shared ChatlogSegmenter.
+        if s.getConfig('ENABLE_CHATLOG'):
+            import chatlog
+
+            if s.getConfig('CHATLOG_SEGMENTS') != 'off':
+                if self.chatlogSegmenter is None:
+                    self.chatlogSegmenter = chatlog.ChatlogSegmenter()
+                    observers.append(self.chatlogSegmenter)
+
+                self.chatlogSegmenter.add(
+                    s.getConfig('SERVER_NICK'),
+                    s.getConfig('SERVER_PATH'),
+                    s.getConfig('CHATLOG_SEGMENTS'),
+                    s.getConfig('CHATLOG_SEGMENT_SIZE')
+                )
+
+            if s.getConfig('CHATLOG_MODE') in ('tail', 'latest'):
+                if s.getConfig('CHATLOG_MODE') == 'tail':
+                    tailerClass = chatlog.FMLLogTailer
+                else:
+                    tailerClass = chatlog.LatestLogTailer
+
+                observers.append(
+                    tailerClass(
+                        s.getConfig('SERVER_NICK'),
+                        s.getConfig('SERVER_PATH'),
+                        s.getConfig('CHAT_RULES'),
+                        s.getConfig('CHATLOG_FSYNC'),
+                        s.getConfig('ENABLE_SESSIONS')
+                    )
+                )
+
+            else:
+                # Directories can only be watched before the observer starts, so servers added
+                # once it is running are watched by another.
+                if self.fmlLogObserver is None or self.fmlLogObserver.ident is not None:
+                    self.fmlLogObserver = chatlog.FMLLogObserver(config.CHATLOG_WORKERS)
+                    observers.append(self.fmlLogObserver)
+
+                self.fmlLogObserver.watch(
+                    s.getConfig('SERVER_NICK'),
+                    s.getConfig('SERVER_PATH'),
+                    s.getConfig('CHAT_RULES'),
+                    s.getConfig('ENABLE_SESSIONS')
+                )
+
+        # Servers with a GC log have it followed by a gcLog.GCLogTailer.
+        if s.getConfig('GCLOG_PATH') is not None:
+            import gcLog
+
+            observers.append(
+                gcLog.GCLogTailer(
+                    s.getConfig('SERVER_NICK'),
+                    os.path.join(s.getConfig('SERVER_PATH'), s.getConfig('GCLOG_PATH'))
+                )
+            )
+
+        # Blue/green restarts switch players to the replacement through the front proxy, which
+        # routes to every server in self.serverInstances, including those added later.
+        if s.getConfig('STANDBY_PATH') is not None and self.frontProxy is None:
+            logging.warning(
+                '{SERVER_NICK} server has a STANDBY_PATH, but players will not follow it'.format(
+                    SERVER_NICK=s.getConfig('SERVER_NICK')
+                )
+                + ' to its standby port unless PROXY_ADDRESS is set.'
+            )
+
+        self.observerInstances.extend(observers)
+
+        return observers
+
+
+    def reloadConfig(self):
+        """
+        Reread the server configuration, passing changed configurations to the corresponding
+        servers and beginning to monitor any servers which have been added. Returns a list of
+        the nicks of servers which were updated or added.
+        """
+
+        if self.configLoader is None:
+            # The legacy config module has already been imported and cannot be reloaded
+            # safely while servers are running.
+            logging.warning('Configuration can only be reloaded when using config.CONF_DIR.')
+            return []
+
+        changed = []
+        servers = dict((s.getConfig('SERVER_NICK'), s) for s in self.serverInstances)
+
+        for newConfig in self.loadConfig():
+            s = servers.pop(newConfig['SERVER_NICK'], None)
+
+            if s is None:
+                s = server.Server(newConfig)
+                self.serverInstances.append(s)
+                changed.append(newConfig['SERVER_NICK'])
+
+                for o in self.setUpServer(s):
+                    o.start()
+
+            elif s.updateConfig(newConfig):
+                changed.append(newConfig['SERVER_NICK'])
+
+        for serverNick in servers:
+            logging.warning(
+                '{SERVER_NICK} server was removed from the configuration, but will continue'.format(
+                    SERVER_NICK=serverNick
+                )
+                + ' to be monitored until Pycraft is restarted.'
+            )
+
+        return changed
+
 
     def run(self):
         """
@@ -89,17 +331,150 @@ class Pycraft:
 
         # Tell any chatlog observers to begin running in their seperate threads.
         for o in self.observerInstances:
-            logging.debug(str.format('Starting FMLLogObserver for {} server.', o.SERVER_NICK))
+            logging.debug(str.format('Starting chatlog observer {}.', o.name))
             o.start()
 
         self.stdinListenerThread.start()
 
+        if self.controlServer is not None:
+            self.controlServer.start()
+
+        if self.agentServer is not None:
+            self.agentServer.start()
+
+        if self.frontProxy is not None:
+            self.frontProxy.start()
+
         # Main thread will now call the run method in server.Server.scheduler, which will
         # perform server check and server restart events as scheduled, and will call time.sleep
         # between events.
         server.Server.run()
 
 
+    @staticmethod
+    def _inParallel(servers, function, deadline):
+        """
+        Call function with each server in its own thread, returning a dictionary which maps
+        each server's nick onto the value returned by function. Servers whose threads have not
+        finished by the deadline, such as those whose lock is held by another thread, are left
+        out of the dictionary.
+        """
+
+        results = {}
+
+        def call(s):
+            try:
+                results[s.getConfig('SERVER_NICK')] = function(s)
+
+            except Exception:
+                logging.exception(
+                    'Error while shutting down {SERVER_NICK} server.'.format(
+                        SERVER_NICK=s.getConfig('SERVER_NICK')
+                    )
+                )
+
+        threads = [threading.Thread(target=call, args=(s,)) for s in servers]
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for t in threads:
+            t.join(max(0, deadline - time.time()))
+
+        return dict(results)
+
+
+    def shutdownAll(self, signum=None, frame=None):
+        """
+        Handles the signals which stop every server before Pycraft exits, see _shutdownAll().
+        """
+
+        if self.shuttingDown:
+            return
+
+        self.shuttingDown = True
+
+        # Signals are handled by the main thread, which runs the scheduler and may be holding a
+        # server's lock in the middle of an event, which the threads stopping the servers would
+        # wait for forever. The shutdown is instead the scheduler's next event, which begins
+        # once the current one has released its locks.
+        server.Server.scheduler.enter(0, 0, self._shutdownAll, ())
+
+
+    def _shutdownAll(self):
+        """
+        Stop every running server in parallel, then exit. The players of every server are warned
+        and every world is saved at once, then all servers are stopped concurrently within one
+        global deadline. The time taken by each server is logged and printed. Servers which are
+        held up by another thread past the deadline are killed.
+        """
+
+        logging.info('Pycraft is shutting down all servers.')
+
+        servers = [s for s in self.serverInstances if s.isOnline()]
+
+        warningTime = config.SHUTDOWN_WARNING_TIME
+
+        warned = time.time()
+
+        Pycraft._inParallel(
+            servers,
+            lambda s: s.sendCommand(
+                'say All servers are shutting down for maintenance in {SECONDS} seconds.'.format(
+                    SECONDS=warningTime
+                )
+            ),
+            warned + warningTime
+        )
+
+        Pycraft._inParallel(servers, lambda s: s.sendCommand('save-all'), warned + warningTime)
+
+        time.sleep(max(0, warned + warningTime - time.time()))
+
+        deadline = time.time() + config.SHUTDOWN_DEADLINE
+
+        # Each server kills itself at the deadline, and is given SHUTDOWN_GRACE more seconds to
+        # do so and write back its world.
+        results = Pycraft._inParallel(
+            servers,
+            lambda s: s.shutdown(deadline),
+            deadline + Pycraft.SHUTDOWN_GRACE
+        )
+
+        for s in servers:
+            if s.getConfig('SERVER_NICK') not in results:
+                message = '{SERVER_NICK} server was held up by another operation, and was killed.'.format(
+                    SERVER_NICK=s.getConfig('SERVER_NICK')
+                )
+
+                logging.warning(message)
+                print(message)
+
+                s.kill()
+
+        for serverNick in sorted(results):
+            if results[serverNick] is None:
+                continue
+
+            duration, graceful = results[serverNick]
+
+            message = '{SERVER_NICK} server {RESULT} after {DURATION:.1f} seconds.'.format(
+                SERVER_NICK=serverNick,
+                RESULT='stopped gracefully' if graceful else 'was killed',
+                DURATION=duration
+            )
+
+            if graceful:
+                logging.info(message)
+            else:
+                logging.warning(message)
+
+            print(message)
+
+        self.stop()
+
+
     def stop(self, signum=None, frame=None):
         """
         Handles any signals sent from the OS which indicate that this program
@@ -115,6 +490,15 @@ class Pycraft:
 
         self.stdinListenerThread.stop()
 
+        if self.controlServer is not None:
+            self.controlServer.stop()
+
+        if self.agentServer is not None:
+            self.agentServer.stop()
+
+        if self.frontProxy is not None:
+            self.frontProxy.stop()
+
 
         for o in self.observerInstances:
             o.join()
@@ -128,11 +512,21 @@ class Pycraft:
 # Only execute if this is the main module.
 # Don't configure the logger or begin execution if this module was imported.
 if __name__ == "__main__":
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)s %(message)s',
-        filename='pycraft.log',
-        level=logging.INFO
+    logPipeline.configure(
+        config.LOG_FILE,
+        config.LOG_LEVEL,
+        config.LOG_MAX_BYTES,
+        config.LOG_BACKUPS,
+        config.LOG_FORMAT == 'json',
+        config.LOG_QUEUE_SIZE
     )
 
-    p = Pycraft()
+    try:
+        p = Pycraft()
+
+    except serverConfig.ConfigError as e:
+        logging.error('Invalid configuration: {ERROR}'.format(ERROR=e))
+        sys.stderr.write('Invalid configuration: {ERROR}\n'.format(ERROR=e))
+        sys.exit(1)
+
     p.run()
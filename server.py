@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 
 # Library modules
+import contextlib
+import json
 import logging
+import os
+import pipes
 import sched
 import socket
 import subprocess
@@ -12,6 +16,116 @@ import time
 # Third party modules
 import psutil
 
+# Project modules
+# The modules of optional features, gcLog, hibernation, stallForensics and tmpfsWorld, are only
+# imported by the servers which use them.
+import logPipeline
+import stateJournal
+
+
+class ProcessTable:
+    """
+    A snapshot of the Java processes running on this host, shared by every server. Scanning
+    every process on the host is expensive, so one scan is reused by all servers for up to
+    MAX_AGE seconds, rather than each server scanning separately.
+
+    All methods are static, this class is not meant to be instantiated.
+    """
+
+    # Number of seconds for which a scan is reused.
+    MAX_AGE = 1
+
+    _lock = threading.Lock()
+
+    # List of (PID, create time, command line args) tuples, one for each Java process.
+    _processes = []
+
+    # Time of the most recent scan, or None if the next lookup must scan again.
+    _scanned = None
+
+    # Number of callers currently inside shared(), during which scans are never repeated.
+    _held = 0
+
+
+    @staticmethod
+    @contextlib.contextmanager
+    def shared():
+        """
+        Context manager within which every lookup uses the same scan, however old it becomes.
+        Used while initialising every server at startup, so that the host's processes are only
+        scanned once.
+        """
+
+        with ProcessTable._lock:
+            ProcessTable._held += 1
+
+        try:
+            yield
+
+        finally:
+            with ProcessTable._lock:
+                ProcessTable._held -= 1
+
+
+    @staticmethod
+    def invalidate():
+        """
+        Force the next lookup to scan again. Called whenever a server process has been started
+        or killed.
+        """
+
+        with ProcessTable._lock:
+            ProcessTable._scanned = None
+
+
+    @staticmethod
+    def _scan():
+        processes = []
+
+        # Iterate over all currently running processes.
+        for process in psutil.process_iter():
+            try:
+                # proc.cmdline() returns all command line arguments used to start the
+                # process, as a list.
+                commandLineArgs = process.cmdline()
+
+                # Determine if this is a Java process
+                if len(commandLineArgs) >= 1 and commandLineArgs[0].lower().find("java") != -1:
+                    processes.append((process.pid, process.create_time(), commandLineArgs))
+
+            except psutil.Error:
+                pass
+
+        return processes
+
+
+    @staticmethod
+    def find(jar):
+        """
+        Returns a list of (PID, create time) tuples, one for each Java process whose command
+        line args contain the name of the jar file.
+        """
+
+        with ProcessTable._lock:
+            if ProcessTable._scanned is None or (
+                    ProcessTable._held == 0
+                    and time.time() - ProcessTable._scanned > ProcessTable.MAX_AGE):
+                ProcessTable._processes = ProcessTable._scan()
+                ProcessTable._scanned = time.time()
+
+            processes = ProcessTable._processes
+
+        found = []
+
+        for PID, createTime, commandLineArgs in processes:
+            # Determine if the command line args contain the name of the server jar file.
+            for arg in commandLineArgs:
+                if arg.find(jar) != -1:
+                    found.append((PID, createTime))
+                    break
+
+        return found
+
 
 class Server:
     """
@@ -21,20 +135,38 @@ class Server:
         __init__(config)
 
     Public methods:
+        backup()
+        getAddress()
         getConfig(key)
+        getGCStats()
+        getHistory(count)
         getTargetState()    
         getUptime()
+        hibernate()
+        isHibernating()
+        kill()
         isOnline()
         isResponsive()
         restart()    
         run() [static]
         sendCommand(command)
+        shutdown(deadline)
         start()        
-        stop()
+        stop(record)
+        updateConfig(config)
+        wake()
 
     Methods prefixed with _ are private methods, and should not be called externally.
     """
 
+    # Number of seconds a replacement instance has to become responsive during a blue/green
+    # restart, before the server is restarted in place instead.
+    STANDBY_TIMEOUT = 10*60
+
+    # Number of player counts for each hour of the day after which older counts carry less
+    # weight in its average, so that the averages follow changes in when players are online.
+    PLAYER_HISTORY_SAMPLES = 14*60
+
     # Unbound variable containing an instance of the sched.scheduler
     # class, used to schedule restart and server check events across all servers.
     scheduler = sched.scheduler(
@@ -60,7 +192,7 @@ class Server:
     def _executeInShell(command):
         """
         This will execute 'command' in the system shell, and will pipe stdout and stderr
-        to the logging module.
+        to the logging module. Returns the exit status of the command.
         """
 
         logging.info(
@@ -93,6 +225,8 @@ class Server:
                 )
             )
 
+        return p.returncode
+
 
     def __init__(self, config):
         """
@@ -114,24 +248,92 @@ class Server:
                 )
             )
 
-            # A dictionary containing all configuration options for this server.
+            # A serverConfig.ServerConfig object containing all configuration options for
+            # this server.
             self._config = config
 
+            # With ENABLE_STATE_JOURNAL, the stateJournal.StateJournal recording the server's
+            # state transitions, and the state it last recorded, which is restored in place of
+            # START_SERVER.
+            self._journal = None
+            state = None
+
+            if self._config['ENABLE_STATE_JOURNAL']:
+                self._journal = stateJournal.StateJournal(
+                    self._config['SERVER_NICK'],
+                    self._config['SERVER_PATH'] + '/pycraft.journal'
+                )
+
+                state = self._journal.state()
+
             # The desired state of the server, True | False
             self._online = self._config['START_SERVER']
 
-            # If server is currently online, and START_SERVER set to False, set self._online
-            # to True not False. Prevents unnecessary server shutdown.
-            if not self._config['START_SERVER'] and self.isOnline():
+            if state is not None and state['online'] is not None:
+                self._online = state['online']
+
+            # If server is currently online, and START_SERVER or the journal give False, set
+            # self._online to True not False. Prevents unnecessary server shutdown.
+            if not self._online and self.isOnline():
                 self._online = True
 
             # This list holds all future restart events. Used for event cancellations.
             self._restartEvents = []
 
+            # True once the restart warnings have begun, or are due to begin at once, rather than
+            # a restart merely being scheduled for later.
+            self._restartSequenceStarted = False
+
             # This holds the future server check event, to be cancelled should an immediate check
             # be requested
             self._checkEvent = None
 
+            # True while the server is stopped because nobody was playing on it, and
+            # self._wakeListener is answering on its port in its place.
+            self._hibernating = False
+            self._wakeListener = None
+
+            # The time since which the server has had no players online, or None.
+            self._idleSince = None
+
+            # With blue/green restarts, the server alternates between two instances: the one
+            # in SERVER_PATH listening on PORT, and the one in STANDBY_PATH listening on
+            # STANDBY_PORT. True while the latter is active. Kept in a file, so that the
+            # running instance is found again when Pycraft restarts.
+            self._standbyActive = self._readActiveInstance()
+
+            # With a RESTART_WINDOW, the average number of players online in each hour of the
+            # day, as a list of 24 [average, number of counts] pairs, read on first use.
+            self._playerHistory = None
+
+            # The tmpfsWorld.TmpfsWorld while the server runs from a world in WORLD_TMPFS, and
+            # the scheduled event which next writes it back to disk. Write-backs run in their
+            # own thread, and _worldLock keeps two from running at once.
+            self._tmpfsWorld = None
+            self._writeBackEvent = None
+            self._worldLock = threading.Lock()
+
+            # The time thread dumps of the server were last captured, or None.
+            self._stallCaptured = None
+
+            # A server which was already running from tmpfs carries on being written back.
+            if self._config['WORLD_TMPFS'] is not None and self.isOnline():
+                import tmpfsWorld
+
+                world = tmpfsWorld.TmpfsWorld(
+                    self._config['SERVER_NICK'],
+                    self._config['SERVER_PATH'],
+                    self._config['WORLD_TMPFS'],
+                    self._config['WORLD_TMPFS_BWLIMIT']
+                )
+
+                if world.isLoaded():
+                    self._tmpfsWorld = world
+                    self._scheduleWriteBack()
+
+            if state is not None:
+                self._restoreState(state)
+
             # Schedule initial restart and server check events.
             self._scheduleCheck(immediate=True)
             self._scheduleRestarts()
@@ -145,6 +347,181 @@ class Server:
         return self._config.get(key)
 
 
+    def updateConfig(self, config):
+        """
+        Replace this server's configuration following a configuration reload. Returns True if the
+        configuration has changed. The new configuration takes effect from the next server
+        check, and restarts are rescheduled in case RESTART_TIME has changed.
+        """
+
+        with self._lock:
+            if config == self._config:
+                return False
+
+            logging.info(
+                'Updating configuration of {SERVER_NICK} server.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK']
+                )
+            )
+
+            self._config = config
+
+            self._cancelRestartEvents()
+            self._scheduleRestarts()
+
+            return True
+
+
+    def getAddress(self):
+        """
+        Returns the (hostname, port) tuple of the server's active instance.
+        """
+
+        return self._config['HOSTNAME'], self._activeInstance()[1]
+
+
+    def _instanceFile(self):
+        return self._config['SERVER_PATH'] + '/pycraft.instance'
+
+
+    def _readActiveInstance(self):
+        if self._config['STANDBY_PATH'] is None:
+            return False
+
+        try:
+            with open(self._instanceFile()) as f:
+                return f.read().strip() == 'standby'
+
+        except IOError:
+            return False
+
+
+    def _setActiveInstance(self, standby):
+        self._standbyActive = standby
+
+        with open(self._instanceFile(), 'w') as f:
+            f.write('standby\n' if standby else 'primary\n')
+
+
+    def _instance(self, standby):
+        """
+        Returns a tuple of the (path, port) of the standby instance if standby is True, or else
+        of the primary instance.
+        """
+
+        if standby and self._config['STANDBY_PATH'] is not None:
+            return self._config['STANDBY_PATH'], self._config['STANDBY_PORT']
+
+        return self._config['SERVER_PATH'], self._config['PORT']
+
+
+    def _activeInstance(self):
+        return self._instance(self._standbyActive)
+
+
+    def _gcLogPath(self):
+        return os.path.join(self._config['SERVER_PATH'], self._config['GCLOG_PATH'])
+
+
+    def getGCStats(self):
+        """
+        Returns a summary of the server's recent GC pauses, see gcLog.GCSeries.summary(), or
+        None if it has no GCLOG_PATH or no pauses have been logged.
+        """
+
+        if self._config['GCLOG_PATH'] is None:
+            return None
+
+        import gcLog
+
+        return gcLog.gcSeries(self._gcLogPath()).summary()
+
+
+    def _checkGC(self):
+        """
+        Begin the restart sequence if the GC log shows sustained long pauses, or a heap which
+        collections no longer empty, over the last GC_RESTART_WINDOW seconds.
+        """
+
+        import gcLog
+
+        trouble = gcLog.gcSeries(self._gcLogPath()).sustained(
+            self._config['GC_RESTART_WINDOW'],
+            self._config['GC_RESTART_PAUSE'],
+            self._config['GC_RESTART_HEAP']
+        )
+
+        if trouble is None:
+            return
+
+        logging.warning(
+            '{SERVER_NICK} server will be restarted, as {TROUBLE}.'.format(
+                SERVER_NICK=self._config['SERVER_NICK'],
+                TROUBLE=trouble
+            )
+        )
+
+        # The restart which was scheduled for later gives way to this one.
+        self._cancelRestartEvents()
+        self._scheduleRestartSequence(0)
+
+
+    def _record(self, event, **fields):
+        """
+        Record the event in the server's journal, if it has one.
+        """
+
+        if self._journal is not None:
+            self._journal.record(event, **fields)
+
+
+    def _restoreState(self, state):
+        """
+        Resume the hibernation or the scheduled restart which the journal recorded before
+        Pycraft was last stopped.
+        """
+
+        if state['hibernating'] and self._online and self._config['HIBERNATE_TIME'] is not None \
+                and not self.isOnline():
+            logging.info(
+                'Resuming the hibernation of {SERVER_NICK} server.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK']
+                )
+            )
+
+            self._listenForWake()
+
+        # The restart is only resumed for the process it was scheduled for, and while the last
+        # warning is still to come. Otherwise _scheduleRestarts() schedules it again.
+        elif state['restartAt'] is not None and self._online \
+                and self._config['ENABLE_AUTOMATED_RESTARTS'] \
+                and state['process'] is not None \
+                and self._processStarted() is not None \
+                and abs(self._processStarted() - state['process']) < 1 \
+                and state['restartAt'] - time.time() >= 60:
+
+            logging.info(
+                'Resuming the restart of {SERVER_NICK} server scheduled for {TIME}.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    TIME=time.ctime(state['restartAt'])
+                )
+            )
+
+            self._scheduleRestartAt(state['restartAt'])
+
+
+    def getHistory(self, count=None):
+        """
+        Returns a list of the newest count entries of the server's journal, or of all of them,
+        oldest first, or None if the server has no journal.
+        """
+
+        if self._journal is None:
+            return None
+
+        return self._journal.history(count)
+
+
     def getTargetState(self):
         """
         Allow external modules to see if the server is meant to be online
@@ -154,6 +531,14 @@ class Server:
         return self._online
 
 
+    def isHibernating(self):
+        """
+        Returns True if the server is stopped until a player tries to join it.
+        """
+
+        return self._hibernating
+
+
     def sendCommand(self, command):
         """
         Execute a server command by calling the stuff command on the screen session
@@ -188,33 +573,7 @@ class Server:
         executing the server jar-file
         """
 
-        PIDs = []
-
-        # Iterate over all currently running processes.
-        for process in psutil.process_iter():
-            try:
-                # proc.cmdline() returns all command line arguments used to start the
-                # process, as a list.
-                commandLineArgs = process.cmdline()
-
-                # Determine if this is a Java process
-                if len(commandLineArgs) >= 1 and commandLineArgs[0].lower().find("java") != -1:
-
-                    # Determine if the command line args contain the name of the server
-                    # jar file.
-                    for arg in commandLineArgs:
-                        if arg.find(self._config['SERVER_JAR']) != -1:
-
-                            # This is indeed an instance of the Minecraft server that we are
-                            # currently monitoring.
-                            PIDs.append(process.pid)
-                            break
-
-            except psutil.Error:
-                pass
-
-
-        return PIDs
+        return [PID for PID, createTime in ProcessTable.find(self._config['SERVER_JAR'])]
 
 
     def isOnline(self):
@@ -225,25 +584,33 @@ class Server:
         return len(self._getPIDs()) > 0
 
 
-    def getUptime(self):
+    def _processStarted(self):
         """
-        Returns the number of seconds for which this server has been running
+        Returns the time the server process was started, or None if it is not running.
         """
 
-        PIDs = self._getPIDs()
+        processes = ProcessTable.find(self._config['SERVER_JAR'])
 
-        if len(PIDs) == 0:
+        if len(processes) == 0:
             return None
 
         else:
-            try:
-                process = psutil.Process(PIDs[0])
+            PID, createTime = processes[0]
+            return createTime
 
-            except psutil.NoSuchProcess:
-                return None
 
-            else:
-                return time.time() - process.create_time()
+    def getUptime(self):
+        """
+        Returns the number of seconds for which this server has been running
+        """
+
+        createTime = self._processStarted()
+
+        if createTime is None:
+            return None
+
+        else:
+            return time.time() - createTime
 
 
     def _scheduleCheck(self, immediate=False):
@@ -267,7 +634,8 @@ class Server:
 
         with self._lock:
             logging.debug(
-                'Scheduling a server check for {SERVER_NICK}. Immediate: {IMMEDIATE}.'.format(
+                logPipeline.LazyMessage(
+                    'Scheduling a server check for {SERVER_NICK}. Immediate: {IMMEDIATE}.',
                     SERVER_NICK=self._config['SERVER_NICK'],
                     IMMEDIATE=immediate
                 )
@@ -312,91 +680,73 @@ class Server:
                     and self._online:
 
                 logging.debug(
-                    'Scheduling restart and restart warnings for {SERVER_NICK} server.'.format(
+                    logPipeline.LazyMessage(
+                        'Scheduling restart and restart warnings for {SERVER_NICK} server.',
                         SERVER_NICK=self._config['SERVER_NICK']
                     )
                 )
 
                 upTime = self.getUptime()
 
-                if upTime is not None:
+                if upTime is not None and self._config['RESTART_WINDOW'] is None:
                     # If restart or restart warnings are already overdue during
                     # scheduling, don't restart immediately, warn the users then
-                    # restart after 10 minutes.
-                    if upTime >= self._config['RESTART_TIME'] - 10*60:
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                0*60,                     # Execute task in 0 seconds
-                                1,                        # Task has priority of 1
-                                self._restartWarning,      # Call self.restartWarning(10)
-                                (10,)
-                            )
-                        )
-                        
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                5*60,
-                                1,
-                                self._restartWarning,
-                                (5,)
-                            )
-                        )
-                        
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                9*60,
-                                1,
-                                self._restartWarning,
-                                (1,)
-                            )
-                        )
+                    # restart after 10 minutes. Otherwise schedule the restart events as
+                    # planned in the configuration.
+                    self._scheduleRestartSequence(
+                        max(0, self._config['RESTART_TIME'] - upTime - 10*60)
+                    )
 
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                10*60,
-                                1,
-                                self.restart,
-                                ()
-                            )
-                        )
+                # With a RESTART_WINDOW, server checks choose when the sequence begins, see
+                # _checkRestartWindow().
 
-                    else:
-                        # Schedule the restart events as planned in the configuration.
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                self._config['RESTART_TIME'] - upTime - 10*60,
-                                1,
-                                self._restartWarning,
-                                (10,)
-                            )
-                        )
 
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                self._config['RESTART_TIME'] - upTime - 5*60,
-                                1,
-                                self._restartWarning,
-                                (5,)
-                            )
-                        )
+    def _scheduleRestartSequence(self, delay):
+        """
+        Enter the restart warnings and the restart itself in the server scheduler, beginning
+        with the 10 minute warning in delay seconds.
+        """
 
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                self._config['RESTART_TIME'] - upTime - 1*60,
-                                1,
-                                self._restartWarning,
-                                (1,)
-                            )
-                        )
+        now = time.time()
+
+        self._scheduleRestartAt(now + delay + 10*60, now)
+
+
+    def _scheduleRestartAt(self, restartAt, now=None):
+        """
+        Enter the restart warnings which are still to come at the time now, by default the
+        current time, and the restart itself, in the server scheduler for a restart at the time
+        restartAt, and record it in the journal.
+        """
 
-                        self._restartEvents.append(
-                            Server.scheduler.enter(
-                                self._config['RESTART_TIME'] - upTime,
-                                1,
-                                self.restart,
-                                ()
-                            )
+        with self._lock:
+            if now is None:
+                now = time.time()
+
+            if restartAt - 10*60 <= now:
+                self._restartSequenceStarted = True
+
+            for minutes in (10, 5, 1):
+                if restartAt - minutes*60 >= now:
+                    self._restartEvents.append(
+                        Server.scheduler.enterabs(
+                            restartAt - minutes*60,
+                            1,                        # Task has priority of 1
+                            self._restartWarning,      # Call self.restartWarning(minutes)
+                            (minutes,)
                         )
+                    )
+
+            self._restartEvents.append(
+                Server.scheduler.enterabs(
+                    max(now, restartAt),
+                    1,
+                    self.restart,
+                    ()
+                )
+            )
+
+            self._record('restartScheduled', at=restartAt, process=self._processStarted())
 
 
     def _cancelRestartEvents(self):
@@ -406,11 +756,15 @@ class Server:
 
         with self._lock:
             logging.debug(
-                'Cancelling restart events for {SERVER_NICK} server.'.format(
+                logPipeline.LazyMessage(
+                    'Cancelling restart events for {SERVER_NICK} server.',
                     SERVER_NICK=self._config['SERVER_NICK']
                 )
             )
 
+            if self._restartEvents:
+                self._record('restartsCancelled')
+
             for event in self._restartEvents:
                 try:
                     Server.scheduler.cancel(event)
@@ -419,9 +773,12 @@ class Server:
                     pass
                 
             self._restartEvents = []
+            self._restartSequenceStarted = False
 
 
     def _restartWarning(self, minutes):
+        self._restartSequenceStarted = True
+
         if minutes == 1:
             self.sendCommand('say An automated restart will occur in 1 minute.')
             self.sendCommand('save-all')
@@ -430,75 +787,184 @@ class Server:
             self.sendCommand('say An automated restart will occur in ' + str(minutes) + ' minutes.')
 
 
-    def _killServer(self):
+    def _killServer(self, PIDs=None):
         """
         Sends a SIGKILL signal to any process that was started with a command
-        containing the server jar name.
+        containing the server jar name, or only to those in the list PIDs.
 
         External calls should use stop() instead.
         """
 
         with self._lock:
-            logging.warning(
-                'Sending SIGKILL signal to {SERVER_NICK} server.'.format(
-                    SERVER_NICK=self._config['SERVER_NICK']
-                )
+            self._killProcesses(PIDs)
+
+
+    def kill(self):
+        """
+        Send a SIGKILL signal to the server's processes without waiting for the server's lock,
+        for when stopping every server cannot wait any longer for whatever is holding it.
+        """
+
+        self._killProcesses()
+
+
+    def _killProcesses(self, PIDs=None):
+        logging.warning(
+            'Sending SIGKILL signal to {SERVER_NICK} server.'.format(
+                SERVER_NICK=self._config['SERVER_NICK']
             )
+        )
 
-            for PID in self._getPIDs():
-                try:
-                    proc = psutil.Process(PID)
-                    proc.kill()
+        for PID in (self._getPIDs() if PIDs is None else PIDs):
+            try:
+                proc = psutil.Process(PID)
+                proc.kill()
 
-                except psutil.NoSuchProcess:
-                    logging.warning(
-                        'Tried to kill process {PID}, when there was no such process running.'.format(
-                            PID=PID)
-                    )
+            except psutil.NoSuchProcess:
+                logging.warning(
+                    'Tried to kill process {PID}, when there was no such process running.'.format(
+                        PID=PID)
+                )
 
-                except psutil.AccessDenied:
-                    logging.warning(
-                        'Tried to kill process {PID}, but this user does not have the necessary'.format(
-                            PID=PID
-                        )
-                        + ' permissions.'
+            except psutil.AccessDenied:
+                logging.warning(
+                    'Tried to kill process {PID}, but this user does not have the necessary'.format(
+                        PID=PID
                     )
+                    + ' permissions.'
+                )
 
-                else:
-                    logging.info(
-                        'Killed process {PID} successfully.'.format(
-                            PID=PID
-                        )
+            else:
+                logging.info(
+                    'Killed process {PID} successfully.'.format(
+                        PID=PID
                     )
+                )
+
+        ProcessTable.invalidate()
 
 
-    def _quitScreenSession(self):
+    def _captureStall(self):
         """
-        Forces the screen session to quit, necessary tidyup in case user has opened new window
-        inside the session causing screen not to close with the server process. This would
-        otherwise interfere with the sendCommand method.
+        Capture thread dumps of an unresponsive server before it is restarted or killed, unless
+        they were captured in the last ten minutes, as when a restart of an unresponsive server
+        ends with it being killed.
+
+        The capture runs in a new thread, as it takes at least ten seconds, and longer if jstack
+        hangs. This waits at most stallForensics.CAPTURE_WAIT seconds for it, so that the
+        scheduler, and the other servers' checks, are only held up that long.
         """
 
-        with self._lock:        
-            Server._executeInShell(
-                'screen -S '
-                + self._config['SERVER_NICK']
-                + ' -X quit',
-            )
+        if not self._config['ENABLE_STALL_FORENSICS']:
+            return
 
+        if self._stallCaptured is not None and time.time() - self._stallCaptured < 10*60:
+            return
+
+        PIDs = self._getPIDs()
+
+        if not PIDs:
+            return
+
+        self._stallCaptured = time.time()
+
+        import stallForensics
+
+        thread = threading.Thread(
+            target=self._writeStallReport,
+            args=(PIDs,),
+            name='Thread-PycraftStall-{SERVER_NICK}'.format(
+                SERVER_NICK=self._config['SERVER_NICK']
+            )
+        )
+
+        thread.daemon = True
+        thread.start()
+        thread.join(stallForensics.CAPTURE_WAIT)
+
+
+    def _writeStallReport(self, PIDs):
+        import stallForensics
+
+        try:
+            stallForensics.capture(self._config['SERVER_NICK'], self._config['SERVER_PATH'], PIDs)
+
+        except (IOError, OSError) as e:
+            logging.error(
+                'Could not capture thread dumps of {SERVER_NICK} server: {ERROR}'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    ERROR=e
+                )
+            )
+
+
+    def _quitScreenSession(self, session=None):
+        """
+        Forces the screen session to quit, necessary tidyup in case user has opened new window
+        inside the session causing screen not to close with the server process. This would
+        otherwise interfere with the sendCommand method.
+        """
+
+        with self._lock:        
+            Server._executeInShell(
+                'screen -S '
+                + (session or self._config['SERVER_NICK'])
+                + ' -X quit',
+            )
+
+
+    def _startScreenSession(self, path, session):
+        """
+        Create a new screen session which executes the start script in path.
+        """
+
+        Server._executeInShell(
+            'screen -d -m -S '
+            + session
+            + ' '
+            + path
+            + '/'
+            + self._config['START_SCRIPT'],
+        )
+
+        if self._config['MULTIUSER_ENABLED']:
+            Server._executeInShell(
+                'screen -S '
+                + session
+                + ' -X multiuser on',
+            )
+
+            for user in self._config['AUTHORISED_ACCOUNTS']:
+                Server._executeInShell(
+                    'screen -S '
+                    + session
+                    + ' -X acladd '
+                    + user,
+                )
 
-    def stop(self):
-        """
-        Attempt to stop server gracefully, else stop forcefully.
-        """
+
+    def stop(self, record=True):
+        """
+        Attempt to stop server gracefully, else stop forcefully. The stop is recorded in the
+        journal unless record is False, as when the server is stopped to be started again.
+        """
 
         # TODO: throw exceptions on error
 
         with self._lock:
+            if self._online and record:
+                self._record('stop')
+
+            if self._hibernating:
+                # The server is already stopped, it only needs to stay that way.
+                self._stopWakeListener()
+                self._online = False
+
             if self._online:
 
                 logging.debug(
-                    'Stopping {SERVER_NICK} server.'.format(
+                    logPipeline.LazyMessage(
+                        'Stopping {SERVER_NICK} server.',
                         SERVER_NICK=self._config['SERVER_NICK']
                     )
                 )
@@ -506,28 +972,95 @@ class Server:
                 # Prevent any restart events from being executed on the stopped server
                 self._cancelRestartEvents()
 
+                # A server stopped while its world is being written back would not save.
+                if self._tmpfsWorld is not None:
+                    self.sendCommand('save-on')
+
                 self.sendCommand('stop')
 
                 # Update state variable to indicate that the server should now be offline
                 self._online = False
 
-                # Wait 60 seconds for process to terminate
-                for index in range(12):
-                    time.sleep(5)
+                # Wait 60 seconds for process to terminate, and if process did not terminate,
+                # then stop forcefully.
+                if not self._waitForExit(time.time() + 60, 5):
+                    self._captureStall()
+                    self._killServer()
 
-                    if not self.isOnline():
+                self._unloadWorld()
 
-                        logging.debug(
-                            '{SERVER_NICK} server was closed gracefully.'.format(
-                                SERVER_NICK=self._config['SERVER_NICK']
-                            )
-                        )
 
-                        return
+    def _waitForExit(self, deadline, interval, PIDs=None):
+        """
+        Poll every interval seconds until no server processes are running, or only those not in
+        the list PIDs, or until the deadline has passed. Returns True if the server closed
+        gracefully.
+        """
+
+        while time.time() < deadline:
+            time.sleep(min(interval, max(0, deadline - time.time())))
+
+            running = self._getPIDs()
+
+            if PIDs is not None:
+                running = [PID for PID in running if PID in PIDs]
+
+            if not running:
+
+                logging.debug(
+                    logPipeline.LazyMessage(
+                        '{SERVER_NICK} server was closed gracefully.',
+                        SERVER_NICK=self._config['SERVER_NICK']
+                    )
+                )
+
+                return True
+
+        return False
+
+
+    def shutdown(self, deadline):
+        """
+        Stop the server as part of stopping every server at once, whatever its target state.
+        The server is killed if it has not closed gracefully by the deadline, which is shared by
+        all servers. Returns a tuple of (seconds taken to stop, True if closed gracefully), or
+        None if the server was not running.
+        """
+
+        started = time.time()
+
+        with self._lock:
+            # The target state is not recorded, so that the server is started again with Pycraft.
+            self._record('shutdown')
+
+            # Prevent any restart events or server checks from starting the server again.
+            self._cancelRestartEvents()
+            self._stopWakeListener()
+            self._online = False
 
-                # If process did not terminate, then stop forcefully.
+            if not self.isOnline():
+                return None
+
+            logging.info(
+                'Shutting down {SERVER_NICK} server.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK']
+                )
+            )
+
+            if self._tmpfsWorld is not None:
+                self.sendCommand('save-on')
+
+            self.sendCommand('stop')
+
+            graceful = self._waitForExit(deadline, 1)
+
+            if not graceful:
                 self._killServer()
 
+            self._unloadWorld()
+
+            return time.time() - started, graceful
+
     
     def start(self):
         """
@@ -537,6 +1070,10 @@ class Server:
         # TODO: throw exception on error
 
         with self._lock:
+            # Release the port of a hibernating server before starting it.
+            self._stopWakeListener()
+            self._idleSince = None
+
             # Only proceed if server is currently offline
             if not self.isOnline():
 
@@ -550,36 +1087,26 @@ class Server:
                 # instance.
                 self._quitScreenSession()
 
-                Server._executeInShell(
-                    'screen -d -m -S '
-                    + self._config['SERVER_NICK']
-                    + ' '
-                    + self._config['SERVER_PATH']
-                    + '/'
-                    + self._config['START_SCRIPT'],
-                )
-
-                if self._config['MULTIUSER_ENABLED']:
-                    Server._executeInShell(
-                        'screen -S '
-                        + self._config['SERVER_NICK']
-                        + ' -X multiuser on',
-                    )
+                # A server which stopped by itself has not written its world back yet.
+                self._unloadWorld()
 
-                    for user in self._config['AUTHORISED_ACCOUNTS']:
-                        Server._executeInShell(
-                            'screen -S '
-                            + self._config['SERVER_NICK']
-                            + ' -X acladd '
-                            + user,
-                        )
+                if self._config['WORLD_TMPFS'] is not None:
+                    self._loadWorld()
+
+                self._startScreenSession(
+                    self._activeInstance()[0],
+                    self._config['SERVER_NICK']
+                )
 
                 # Update state variable to indicate that the server should now be online
                 self._online = True
+                self._restartSequenceStarted = False
+                self._record('start')
 
                 # Give OS a chance to launch the process, as scheduleRestarts requires
                 # the process to be running in order to calculate the restart times.
                 time.sleep(5)
+                ProcessTable.invalidate()
                 self._scheduleRestarts()
 
 
@@ -591,26 +1118,375 @@ class Server:
                 )
 
 
+    def _loadWorld(self):
+        """
+        Load the world into WORLD_TMPFS before the server starts, unless there is not enough
+        memory, in which case the server runs from disk.
+        """
+
+        if self._config['STANDBY_PATH'] is not None:
+            logging.warning(
+                'The world of {SERVER_NICK} server is not loaded into tmpfs, as it has a'.format(
+                    SERVER_NICK=self._config['SERVER_NICK']
+                )
+                + ' STANDBY_PATH.'
+            )
+
+            return
+
+        import tmpfsWorld
+
+        world = tmpfsWorld.TmpfsWorld(
+            self._config['SERVER_NICK'],
+            self._config['SERVER_PATH'],
+            self._config['WORLD_TMPFS'],
+            self._config['WORLD_TMPFS_BWLIMIT']
+        )
+
+        with self._worldLock:
+            try:
+                loaded = world.load()
+
+            except (IOError, OSError) as e:
+                logging.error(
+                    'Could not prepare the world of {SERVER_NICK} server for tmpfs: {ERROR}'.format(
+                        SERVER_NICK=self._config['SERVER_NICK'],
+                        ERROR=e
+                    )
+                )
+
+                loaded = False
+
+        if loaded:
+            self._tmpfsWorld = world
+            self._scheduleWriteBack()
+
+
+    def _unloadWorld(self):
+        """
+        Write the tmpfs world back to disk once the server has stopped, waiting for any write-back
+        in progress to finish first.
+        """
+
+        if self._writeBackEvent is not None:
+            try:
+                Server.scheduler.cancel(self._writeBackEvent)
+            except ValueError:
+                # Event was no longer on the queue
+                pass
+
+            self._writeBackEvent = None
+
+        if self._tmpfsWorld is None:
+            return
+
+        with self._worldLock:
+            try:
+                self._tmpfsWorld.unload()
+
+            except (IOError, OSError) as e:
+                # The journal still records the world as being in tmpfs, so it is written back
+                # before the server next starts.
+                logging.error(
+                    'Could not write back the world of {SERVER_NICK} server: {ERROR}'.format(
+                        SERVER_NICK=self._config['SERVER_NICK'],
+                        ERROR=e
+                    )
+                )
+
+            self._tmpfsWorld = None
+
+
+    def _scheduleWriteBack(self):
+        self._writeBackEvent = Server.scheduler.enter(
+            self._config['WORLD_TMPFS_INTERVAL'],
+            1,
+            self._beginWriteBack,
+            ()
+        )
+
+
+    def _beginWriteBack(self):
+        """
+        Write the tmpfs world back in a new thread, so that the scheduler is not held up while
+        a throttled write-back runs.
+        """
+
+        thread = threading.Thread(
+            target=self._writeBack,
+            args=(self._tmpfsWorld,),
+            name='Thread-PycraftWriteBack-{SERVER_NICK}'.format(
+                SERVER_NICK=self._config['SERVER_NICK']
+            )
+        )
+
+        thread.daemon = True
+        thread.start()
+
+        self._scheduleWriteBack()
+
+
+    def _writeBack(self, world):
+        """
+        Write the tmpfs world back to disk while saving is suspended, as for a backup.
+        """
+
+        with self._lock:
+            if world is None or world is not self._tmpfsWorld or not self.isOnline():
+                return
+
+            self.sendCommand('save-off')
+            self.sendCommand('save-all')
+
+        # Give the server a chance to finish writing the world to tmpfs. Only the write-back
+        # itself, and not the server lock, is held meanwhile, so that server checks carry on.
+        time.sleep(10)
+
+        try:
+            with self._worldLock:
+                if world is self._tmpfsWorld:
+                    world.writeBack()
+
+        except (IOError, OSError) as e:
+            logging.error(
+                'Could not write back the world of {SERVER_NICK} server: {ERROR}'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    ERROR=e
+                )
+            )
+
+        finally:
+            with self._lock:
+                if world is self._tmpfsWorld:
+                    self.sendCommand('save-on')
+
+
+    def backup(self):
+        """
+        Execute the server's backup script, if one is configured. Saving is suspended while the
+        script runs if the server is online, so that the world files are consistent. Returns
+        True if the backup script succeeded.
+        """
+
+        with self._lock:
+            if self._config['BACKUP_SCRIPT'] is None:
+                logging.warning(
+                    'Attempted to back up {SERVER_NICK} server, which has no BACKUP_SCRIPT.'.format(
+                        SERVER_NICK=self._config['SERVER_NICK']
+                    )
+                )
+
+                return False
+
+            logging.info(
+                'Backing up {SERVER_NICK} server.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK']
+                )
+            )
+
+            online = self.isOnline()
+
+            if online:
+                self.sendCommand('save-off')
+                self.sendCommand('save-all')
+
+                # Give the server a chance to finish writing the world to disk.
+                time.sleep(10)
+
+            try:
+                returnCode = Server._executeInShell(
+                    'cd '
+                    + self._activeInstance()[0]
+                    + ' && ./'
+                    + self._config['BACKUP_SCRIPT']
+                )
+
+            finally:
+                if online:
+                    self.sendCommand('save-on')
+
+            return returnCode == 0
+
+
     def restart(self):
         if self._online:
             with self._lock:
+                self._record('restart')
+
+                # An unresponsive server cannot save its world for the replacement, so it is
+                # restarted in place.
+                if self._config['STANDBY_PATH'] is not None and not self._hibernating \
+                        and self.isResponsive() and self._blueGreenRestart():
+                    return
+
                 self.sendCommand('say Server is restarting, see you soon!')
-                self.stop()
+
+                # If Pycraft is stopped before the server starts again, the journal still
+                # records it as online, so that it is started when Pycraft next runs.
+                self.stop(record=False)
                 self.start()
 
 
+    def _syncInstance(self, source, destination):
+        """
+        Copy each of STANDBY_SYNC from one instance's directory to the other's. Returns True if
+        every copy succeeded. rsync replaces each changed file rather than rewriting it in place,
+        so an instance which is running in destination keeps reading the files it has open.
+        """
+
+        for name in self._config['STANDBY_SYNC']:
+            returnCode = Server._executeInShell(
+                'rsync -a --delete '
+                + pipes.quote(source + '/' + name)
+                + ' '
+                + pipes.quote(destination + '/')
+            )
+
+            if returnCode != 0:
+                return False
+
+        return True
+
+
+    def _blueGreenRestart(self):
+        """
+        Replace the active instance of the server with the other one. Returns False, leaving the
+        active instance running, if the replacement could not be started.
+
+        The replacement is booted from a copy of the world on its own port, while the players
+        carry on. Once it responds to pings, the active instance saves and stops, the changes
+        saved since the copy are synced to the replacement, and the server's address switches
+        to the replacement's port. Players are only without a server during the final save and
+        sync.
+        """
+
+        with self._lock:
+            activePath, activePort = self._activeInstance()
+            standbyPath, standbyPort = self._instance(not self._standbyActive)
+            standbySession = self._config['SERVER_NICK'] + '-standby'
+
+            logging.info(
+                'Starting a replacement instance of {SERVER_NICK} server in {PATH}.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    PATH=standbyPath
+                )
+            )
+
+            # Saving is suspended while the world is copied, as for a backup.
+            self.sendCommand('save-off')
+            self.sendCommand('save-all')
+            time.sleep(10)
+
+            try:
+                synced = self._syncInstance(activePath, standbyPath)
+
+            finally:
+                self.sendCommand('save-on')
+
+            if not synced:
+                logging.error(
+                    'Could not copy the world of {SERVER_NICK} server to {PATH}.'.format(
+                        SERVER_NICK=self._config['SERVER_NICK'],
+                        PATH=standbyPath
+                    )
+                )
+
+                return False
+
+            activePIDs = self._getPIDs()
+
+            self._quitScreenSession(standbySession)
+            self._startScreenSession(standbyPath, standbySession)
+
+            deadline = time.time() + Server.STANDBY_TIMEOUT
+
+            while self._ping(standbyPort) is None:
+                if time.time() >= deadline:
+                    logging.error(
+                        'Replacement instance of {SERVER_NICK} server did not respond on port {PORT}'.format(
+                            SERVER_NICK=self._config['SERVER_NICK'],
+                            PORT=standbyPort
+                        )
+                        + ' within {SECONDS} seconds, and will be restarted in place.'.format(
+                            SECONDS=Server.STANDBY_TIMEOUT
+                        )
+                    )
+
+                    ProcessTable.invalidate()
+                    self._killServer([PID for PID in self._getPIDs() if PID not in activePIDs])
+                    self._quitScreenSession(standbySession)
+
+                    return False
+
+                time.sleep(5)
+
+            # The players are disconnected from here until they reconnect to the replacement.
+            downtimeStarted = time.time()
+
+            self.sendCommand('say Server is restarting, please reconnect in a few seconds!')
+            self.sendCommand('stop')
+
+            if not self._waitForExit(time.time() + 60, 1, activePIDs):
+                self._killServer(activePIDs)
+
+            self._quitScreenSession()
+
+            if not self._syncInstance(activePath, standbyPath):
+                # The replacement is already running, so it is kept with the world as it was
+                # when first copied.
+                logging.error(
+                    'Could not copy the final world changes of {SERVER_NICK} server to {PATH}.'.format(
+                        SERVER_NICK=self._config['SERVER_NICK'],
+                        PATH=standbyPath
+                    )
+                )
+
+            self._setActiveInstance(not self._standbyActive)
+
+            # The replacement's console takes the usual screen session name.
+            Server._executeInShell(
+                'screen -S '
+                + standbySession
+                + ' -X sessionname '
+                + self._config['SERVER_NICK']
+            )
+
+            logging.info(
+                '{SERVER_NICK} server switched to port {PORT} after {SECONDS:.1f} seconds of downtime.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    PORT=standbyPort,
+                    SECONDS=time.time() - downtimeStarted
+                )
+            )
+
+            ProcessTable.invalidate()
+            self._cancelRestartEvents()
+            self._scheduleRestarts()
+
+            return True
+
+
     def isResponsive(self):
         """
         Test the server responsiveness by opening a network socket and asking the server
         for its player count and message of the day.
         """
 
+        return self._ping() is not None
+
+
+    def _ping(self, port=None):
+        """
+        Ping the server, returning the number of players online, or None if the server did not
+        respond. The active instance is pinged, unless another port is given.
+        """
+
         with self._lock:
             try:
                 # Set up our socket
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 s.settimeout(10)
-                s.connect((self._config['HOSTNAME'], self._config['PORT']))
+                s.connect((self._config['HOSTNAME'], port or self._activeInstance()[1]))
 
                 # Send 0xFE: Server list ping
                 s.send('\xfe\x01')
@@ -629,37 +1505,267 @@ class Server:
                 #Check the first 3 characters of the string are what we expect
                 assert d[:3] == u'\xa7\x31\x00'
 
-                """
-                Commented in case the returned information becomes useful:
+                # The fields are the protocol version, server version, message of the day, number
+                # of players online and maximum number of players.
+                players = int(d[3:].split(u'\x00')[3])
 
-                # Split
-                d = d[3:].split('\x00')
-                
-                # Return a dict of values
-                return {'protocol_version': int(d[0]),
-                        'server_version':       d[1],
-                        'motd':                 d[2],
-                        'players':          int(d[3]),
-                        'max_players':      int(d[4])}
-                """
-
-            except (socket.error, socket.timeout, AssertionError, IndexError):
+            except (socket.error, socket.timeout, AssertionError, IndexError, ValueError):
                 logging.debug(
-                    'Network responsiveness test for {SERVER_NICK} returning False.'.format(
+                    logPipeline.LazyMessage(
+                        'Network responsiveness test for {SERVER_NICK} returning False.',
                         SERVER_NICK=self._config['SERVER_NICK']
                     )
                 )
 
-                return False
+                return None
 
             else:
                 logging.debug(
-                    'Network responsiveness test for {SERVER_NICK} returning True.'.format(
+                    logPipeline.LazyMessage(
+                        'Network responsiveness test for {SERVER_NICK} returning True.',
                         SERVER_NICK=self._config['SERVER_NICK']
                     )
                 )
 
-                return True
+                return players
+
+
+    def hibernate(self):
+        """
+        Stop the server gracefully while it has no players, and listen on its port in its place
+        until a player tries to join, when the server is woken. The server's target state stays
+        online.
+        """
+
+        with self._lock:
+            if not self._online or self._hibernating:
+                return
+
+            logging.info(
+                '{SERVER_NICK} server has had no players for {SECONDS} seconds, and will now hibernate.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    SECONDS=self._config['HIBERNATE_TIME']
+                )
+            )
+
+            self._cancelRestartEvents()
+
+            if self._tmpfsWorld is not None:
+                self.sendCommand('save-on')
+
+            self.sendCommand('stop')
+
+            if not self._waitForExit(time.time() + 60, 5):
+                self._killServer()
+
+            self._unloadWorld()
+            self._idleSince = None
+
+            if self._listenForWake():
+                self._record('hibernate')
+
+
+    def _listenForWake(self):
+        """
+        Listen on the server's port in its place, starting it when a player tries to join.
+        Returns True if the server is now hibernating.
+        """
+
+        import hibernation
+
+        with self._lock:
+            listener = hibernation.WakeListener(
+                self._config['SERVER_NICK'],
+                self._activeInstance()[1],
+                self._config['HIBERNATE_MOTD'],
+                self.wake
+            )
+
+            try:
+                listener.listen()
+
+            except socket.error as e:
+                # The next server check starts the server again, as it is meant to be online.
+                logging.error(
+                    'Could not listen on port {PORT} for hibernating {SERVER_NICK} server: {ERROR}'.format(
+                        PORT=self._activeInstance()[1],
+                        SERVER_NICK=self._config['SERVER_NICK'],
+                        ERROR=e
+                    )
+                )
+
+                return False
+
+            self._hibernating = True
+            self._wakeListener = listener
+            listener.start()
+
+            return True
+
+
+    def wake(self):
+        """
+        Start a hibernating server. Called by its wake listener when a player tries to join.
+        """
+
+        with self._lock:
+            if self._hibernating:
+                logging.info(
+                    'Waking {SERVER_NICK} server.'.format(
+                        SERVER_NICK=self._config['SERVER_NICK']
+                    )
+                )
+
+                self.start()
+
+
+    def _stopWakeListener(self):
+        """
+        Stop listening on the port of a hibernating server, which is then no longer hibernating.
+        """
+
+        if self._wakeListener is not None:
+            self._wakeListener.stop()
+            self._wakeListener = None
+
+        self._hibernating = False
+
+
+    def _checkIdle(self):
+        """
+        Hibernate the server once it has had no players for HIBERNATE_TIME seconds.
+        """
+
+        players = self._ping()
+
+        if players is None:
+            # An unresponsive server is not known to be idle.
+            return
+
+        if players > 0:
+            self._idleSince = None
+
+        elif self._idleSince is None:
+            self._idleSince = time.time()
+
+        elif time.time() - self._idleSince >= self._config['HIBERNATE_TIME']:
+            self.hibernate()
+
+
+    def _playerHistoryFile(self):
+        return self._config['SERVER_PATH'] + '/pycraft.players.json'
+
+
+    def _recordPlayers(self, players):
+        """
+        Add a count of the players online now to the average of the current hour of the day.
+        """
+
+        if self._playerHistory is None:
+            try:
+                with open(self._playerHistoryFile()) as f:
+                    self._playerHistory = json.load(f)
+
+            except (IOError, ValueError):
+                self._playerHistory = [[0.0, 0] for hour in range(24)]
+
+        average = self._playerHistory[time.localtime().tm_hour]
+        average[1] = min(average[1] + 1, Server.PLAYER_HISTORY_SAMPLES)
+        average[0] += (players - average[0]) / average[1]
+
+        try:
+            with open(self._playerHistoryFile() + '.tmp', 'w') as f:
+                json.dump(self._playerHistory, f)
+
+            os.rename(self._playerHistoryFile() + '.tmp', self._playerHistoryFile())
+
+        except (IOError, OSError) as e:
+            logging.warning(
+                'Could not save the player history of {SERVER_NICK} server: {ERROR}'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    ERROR=e
+                )
+            )
+
+
+    def _forecastPlayers(self, start, end):
+        """
+        Returns the lowest average number of players online in any hour of the day from start to
+        end, or None if none of those hours have been recorded.
+        """
+
+        averages = []
+
+        for hourStart in range(int(start) - int(start) % 3600, int(end), 3600):
+            average, samples = self._playerHistory[time.localtime(hourStart).tm_hour]
+
+            if samples > 0:
+                averages.append(average)
+
+        return min(averages) if averages else None
+
+
+    def _checkRestartWindow(self):
+        """
+        Within RESTART_WINDOW seconds either side of RESTART_TIME, begin the restart sequence
+        when there are fewer players online than are expected at any later time it could begin.
+        Begins at once if nobody is online, and in time to restart by the end of the window
+        however busy the server is. Outside the window, only records the players online.
+        """
+
+        players = self._ping()
+
+        if players is None:
+            return
+
+        self._recordPlayers(players)
+
+        upTime = self.getUptime()
+
+        if not self._config['ENABLE_AUTOMATED_RESTARTS'] or self._restartEvents \
+                or upTime is None or upTime < self._config['RESTART_TIME'] - self._config['RESTART_WINDOW']:
+            return
+
+        # The time by which the 10 minute warning must be given.
+        latest = time.time() + self._config['RESTART_TIME'] + self._config['RESTART_WINDOW'] \
+            - upTime - 10*60
+
+        if players == 0:
+            logging.info(
+                '{SERVER_NICK} server is empty, and will be restarted now.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK']
+                )
+            )
+
+            self.restart()
+            return
+
+        # Without any history, the restart is only moved to when the server is empty.
+        forecast = self._forecastPlayers(time.time() + 3600, latest)
+
+        if forecast is None:
+            begin = upTime >= self._config['RESTART_TIME'] - 10*60
+        else:
+            begin = players <= forecast
+
+        if begin or time.time() >= latest:
+            logging.info(
+                'Beginning the restart of {SERVER_NICK} server with {PLAYERS} players online.'.format(
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    PLAYERS=players
+                )
+            )
+
+            self._scheduleRestartSequence(0)
+
+        else:
+            logging.debug(
+                logPipeline.LazyMessage(
+                    'Deferring the restart of {SERVER_NICK} server, as {PLAYERS} players are online.',
+                    SERVER_NICK=self._config['SERVER_NICK'],
+                    PLAYERS=players
+                )
+            )
 
 
     def _check(self):
@@ -672,7 +1778,8 @@ class Server:
 
         with self._lock:
             logging.debug(
-                'Beginning server check of {SERVER_NICK} server.'.format(
+                logPipeline.LazyMessage(
+                    'Beginning server check of {SERVER_NICK} server.',
                     SERVER_NICK=self._config['SERVER_NICK']
                 )
             )
@@ -728,18 +1835,37 @@ class Server:
                     newestProcess.kill()
 
                 time.sleep(5)
+                ProcessTable.invalidate()
                 PIDs = self._getPIDs()
 
 
+            if self._hibernating:
+                if len(PIDs) == 0 and self._wakeListener.is_alive():
+                    logging.debug(
+                        logPipeline.LazyMessage(
+                            '{SERVER_NICK} server is hibernating.',
+                            SERVER_NICK=self._config['SERVER_NICK']
+                        )
+                    )
+
+                    self._scheduleCheck()
+                    return
+
+                # The server was started by something other than its wake listener, or the
+                # listener has failed, so the server is checked as usual.
+                self._stopWakeListener()
+
+
             if self._online:
                 # Minecraft server should currently be online and responsive
 
                 if len(PIDs) == 0:
                     logging.debug(
-                        '{SERVER_NICK} server is desired to be online, but no process was found.'.format(
+                        logPipeline.LazyMessage(
+                            '{SERVER_NICK} server is desired to be online, but no process was found.'
+                            ' Server will now be started.',
                             SERVER_NICK=self._config['SERVER_NICK']
                         )
-                        + ' Server will now be started.'
                     )
 
                     # Remove restart events from any previous processes
@@ -749,7 +1875,8 @@ class Server:
 
                 elif len(PIDs) == 1:
                     logging.debug(
-                        '{SERVER_NICK} server is desired to be online, and is currently running.'.format(
+                        logPipeline.LazyMessage(
+                            '{SERVER_NICK} server is desired to be online, and is currently running.',
                             SERVER_NICK=self._config['SERVER_NICK']
                         )
                     )
@@ -779,27 +1906,47 @@ class Server:
                                             + ' responsiveness tests, and will now be restarted.'
                                         )
 
+                                        self._captureStall()
                                         self.restart()
                                         break
 
+                    if self._config['RESTART_WINDOW'] is not None and self._online \
+                            and self.getUptime() > self._config['STARTUP_TIME']:
+                        self._checkRestartWindow()
+
+                    # Pauses from before a restart are not held against the new process. A restart
+                    # scheduled for later, as RESTART_TIME always is, does not hold the check off.
+                    if self._config['GCLOG_PATH'] is not None and self._online \
+                            and not self._restartSequenceStarted \
+                            and (self._config['GC_RESTART_PAUSE'] is not None
+                                 or self._config['GC_RESTART_HEAP'] is not None) \
+                            and self.getUptime() > self._config['GC_RESTART_WINDOW']:
+                        self._checkGC()
+
+                    if self._config['HIBERNATE_TIME'] is not None and self._online \
+                            and self.getUptime() > self._config['STARTUP_TIME']:
+                        self._checkIdle()
+
             else:
                 # Minecraft server should be offline
                 if len(PIDs) > 0:
                     logging.debug(
-                        '{SERVER_NICK} server is desired to be offline, but instances of this'.format(
+                        logPipeline.LazyMessage(
+                            '{SERVER_NICK} server is desired to be offline, but instances of this'
+                            ' server are currently running. Server will now be stopped.',
                             SERVER_NICK=self._config['SERVER_NICK']
                         )
-                        + ' server are currently running. Server will now be stopped.'
                     )
 
                     self.stop()
 
                 else:
                     logging.debug(
-                        '{SERVER_NICK} server is desired to be offline, and no instances of the'.format(
+                        logPipeline.LazyMessage(
+                            '{SERVER_NICK} server is desired to be offline, and no instances of the'
+                            ' server are currently running.',
                             SERVER_NICK=self._config['SERVER_NICK']
                         )
-                        + ' server are currently running.'
                     )
 
 
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loads and validates the per-server configuration.
+
+Servers may be configured either with the legacy config.config list, or with a conf.d style
+directory containing one JSON file per server. Files in the directory whose names begin with an
+underscore are templates rather than servers. The _defaults.json template, if present, is
+inherited by every server, and any file may name another template or server to inherit from
+using the INHERITS key.
+
+Every server's configuration is validated against SCHEMA once, and stored in a compact
+ServerConfig object. Parsed files are cached by modification time, so reloading the directory
+will only reparse the files which have changed.
+"""
+
+# Library modules
+import json
+import logging
+import os
+import re
+import string
+import threading
+
+
+class ConfigError(Exception):
+    """
+    Raised when a configuration file cannot be parsed, or a server's configuration does not
+    satisfy the schema.
+    """
+
+    pass
+
+
+# Marks a configuration option which has no default value, and must be given for every server.
+REQUIRED = object()
+
+# Name of the template which is implicitly inherited by every server in a conf.d directory.
+DEFAULTS_TEMPLATE = '_defaults'
+
+# Key used within a conf.d file to name the template or server that it inherits from.
+INHERITS_KEY = 'INHERITS'
+
+_STRING = (basestring,)
+_INTEGER = (int, long)
+_NUMBER = (int, long, float)
+_OPTIONAL_STRING = (basestring, type(None))
+_OPTIONAL_LIST = (list, tuple, type(None))
+_OPTIONAL_NUMBER = (int, long, float, type(None))
+
+# Maps each configuration option onto a tuple of (accepted types, default value). Every other
+# list option, such as AUTHORISED_ACCOUNTS, must contain only strings.
+# CHAT_RULES is a list of rule dictionaries, validated by ServerConfig._validateChatRules().
+SCHEMA = {
+    # General
+    'SERVER_NICK':                  (_STRING, REQUIRED),
+    'SERVER_PATH':                  (_STRING, REQUIRED),
+    'SERVER_JAR':                   (_STRING, REQUIRED),
+    'START_SCRIPT':                 (_STRING, REQUIRED),
+    'BACKUP_SCRIPT':                (_OPTIONAL_STRING, None),
+
+    # Modules
+    'ENABLE_CHATLOG':               ((bool,), False),
+    'CHATLOG_MODE':                 (_STRING, 'rotation'),
+    'CHAT_RULES':                   (_OPTIONAL_LIST, None),
+    'CHATLOG_SEGMENTS':             (_STRING, 'off'),
+    'CHATLOG_SEGMENT_SIZE':         (_INTEGER, 64 * 1024 * 1024),
+    'CHATLOG_FSYNC':                (_STRING, 'none'),
+    'ENABLE_SESSIONS':              ((bool,), False),
+    'ENABLE_RESPONSIVENESS_CHECK':  ((bool,), True),
+    'ENABLE_STALL_FORENSICS':       ((bool,), True),
+    'ENABLE_AUTOMATED_RESTARTS':    ((bool,), True),
+
+    # Wrapper
+    'START_SERVER':                 ((bool,), True),
+    'ENABLE_STATE_JOURNAL':         ((bool,), True),
+    'MULTIUSER_ENABLED':            ((bool,), False),
+    'AUTHORISED_ACCOUNTS':          ((list, tuple), ()),
+
+    # GC log module
+    'GCLOG_PATH':                   (_OPTIONAL_STRING, None),
+    'GC_RESTART_PAUSE':             (_OPTIONAL_NUMBER, None),
+    'GC_RESTART_HEAP':              (_OPTIONAL_NUMBER, None),
+    'GC_RESTART_WINDOW':            (_NUMBER, 10 * 60),
+
+    # Responsiveness module
+    'HOSTNAME':                     (_STRING, 'localhost'),
+    'PORT':                         (_INTEGER, 25565),
+    'STARTUP_TIME':                 (_NUMBER, 120),
+
+    # Restart module
+    'RESTART_TIME':                 (_NUMBER, 12 * 60 * 60),
+    'RESTART_WINDOW':               (_OPTIONAL_NUMBER, None),
+
+    # Hibernation module
+    'HIBERNATE_TIME':               (_OPTIONAL_NUMBER, None),
+    'HIBERNATE_MOTD':               (_STRING, u'Sleeping, join to wake the server up'),
+
+    # Blue/green restart module
+    'STANDBY_PATH':                 (_OPTIONAL_STRING, None),
+    'STANDBY_PORT':                 (_INTEGER, 25566),
+    'STANDBY_SYNC':                 ((list, tuple), ('world',)),
+
+    # tmpfs world module
+    'WORLD_TMPFS':                  (_OPTIONAL_STRING, None),
+    'WORLD_TMPFS_INTERVAL':         (_NUMBER, 15 * 60),
+    'WORLD_TMPFS_BWLIMIT':          (_OPTIONAL_NUMBER, None),
+
+    # Front proxy module
+    'PROXY_HOSTNAMES':              ((list, tuple), ())
+}
+
+# Maps configuration options which only accept certain values onto a tuple of those values.
+CHOICES = {
+    'CHATLOG_MODE':                 ('rotation', 'tail', 'latest'),
+    'CHATLOG_SEGMENTS':             ('off', 'daily', 'size'),
+    'CHATLOG_FSYNC':                ('none', 'interval', 'batch')
+}
+
+# Maps each key of a CHAT_RULES rule onto whether it is required.
+CHAT_RULE_KEYS = {
+    'name':                         True,
+    'pattern':                      True,
+    'template':                     True,
+    'contains':                     False
+}
+
+
+class ServerConfig(object):
+    """
+    A validated, read-only set of configuration options for one server.
+
+    Supports the same read access as the dictionaries in config.config, so that
+    config['SERVER_NICK'] and config.get('SERVER_NICK') both work.
+    """
+
+    __slots__ = tuple(sorted(SCHEMA)) + ('source',)
+
+
+    def __init__(self, options, source):
+        """
+        Validate the options dictionary against SCHEMA. source describes where the options came
+        from, and is included in any error messages.
+        """
+
+        object.__setattr__(self, 'source', source)
+
+        unknownKeys = sorted(set(options) - set(SCHEMA))
+
+        if unknownKeys:
+            raise ConfigError(
+                'Unknown configuration option(s) {KEYS} in {SOURCE}.'.format(
+                    KEYS=', '.join(unknownKeys),
+                    SOURCE=source
+                )
+            )
+
+        for key, (types, default) in SCHEMA.iteritems():
+            if key in options:
+                value = options[key]
+
+            elif default is REQUIRED:
+                raise ConfigError(
+                    'Required configuration option {KEY} is missing from {SOURCE}.'.format(
+                        KEY=key,
+                        SOURCE=source
+                    )
+                )
+
+            else:
+                value = default
+
+            object.__setattr__(self, key, ServerConfig._validate(key, value, types, source))
+
+
+    @staticmethod
+    def _validate(key, value, types, source):
+        """
+        Returns value converted to its stored form, or raises ConfigError if it is not of one of
+        the accepted types. Strings are stored as UTF-8 encoded str objects, and lists as tuples.
+        """
+
+        # bool is a subclass of int, but True is never a sensible port number.
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ConfigError(
+                'Configuration option {KEY} in {SOURCE} has the wrong type, expected {TYPES}'.format(
+                    KEY=key,
+                    SOURCE=source,
+                    TYPES='/'.join(t.__name__ for t in types)
+                )
+                + ' but found {TYPE}.'.format(
+                    TYPE=type(value).__name__
+                )
+            )
+
+        if key in CHOICES and value not in CHOICES[key]:
+            raise ConfigError(
+                'Configuration option {KEY} in {SOURCE} must be one of {CHOICES}.'.format(
+                    KEY=key,
+                    SOURCE=source,
+                    CHOICES=', '.join(CHOICES[key])
+                )
+            )
+
+        if key == 'CHAT_RULES' and value is not None:
+            return ServerConfig._validateChatRules(value, source)
+
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                if not isinstance(item, basestring):
+                    raise ConfigError(
+                        'Configuration option {KEY} in {SOURCE} must be a list of strings.'.format(
+                            KEY=key,
+                            SOURCE=source
+                        )
+                    )
+
+            return tuple(
+                item.encode('utf-8') if isinstance(item, unicode) else item for item in value
+            )
+
+        return value
+
+
+    @staticmethod
+    def _validateChatRules(rules, source):
+        """
+        Returns the CHAT_RULES list as a tuple of (name, pattern, template, contains) tuples of
+        unicode strings, which can be shared by every server with the same rules. Raises
+        ConfigError if a rule is malformed, its pattern does not compile, or its template uses
+        a field which is not a named group of its pattern.
+        """
+
+        validated = []
+
+        for index, rule in enumerate(rules):
+            where = 'Chat rule {INDEX} in {SOURCE}'.format(INDEX=index, SOURCE=source)
+
+            if not isinstance(rule, dict):
+                raise ConfigError(where + ' must be a dictionary.')
+
+            unknownKeys = sorted(set(rule) - set(CHAT_RULE_KEYS))
+
+            if unknownKeys:
+                raise ConfigError(
+                    where + ' has unknown key(s) {KEYS}.'.format(KEYS=', '.join(unknownKeys))
+                )
+
+            values = {}
+
+            for ruleKey, required in CHAT_RULE_KEYS.iteritems():
+                value = rule.get(ruleKey)
+
+                if value is None and not required:
+                    values[ruleKey] = None
+                    continue
+
+                if not isinstance(value, basestring) or not value:
+                    raise ConfigError(
+                        where + ' must have a non-empty string {KEY}.'.format(KEY=ruleKey)
+                    )
+
+                values[ruleKey] = value.decode('utf-8') if isinstance(value, str) else value
+
+            try:
+                pattern = re.compile(values['pattern'])
+
+            except re.error as e:
+                raise ConfigError(
+                    where + ' has an invalid pattern: {ERROR}'.format(ERROR=e)
+                )
+
+            try:
+                fields = set(
+                    field for text, field, spec, conversion
+                    in string.Formatter().parse(values['template'])
+                    if field is not None
+                )
+
+            except ValueError as e:
+                raise ConfigError(
+                    where + ' has an invalid template: {ERROR}'.format(ERROR=e)
+                )
+
+            # The day field is supplied for logs whose lines have no date.
+            unknownFields = sorted(fields - set(pattern.groupindex) - set(['day']))
+
+            if unknownFields:
+                raise ConfigError(
+                    where + ' has template field(s) {FIELDS} which are not named groups of its pattern.'.format(
+                        FIELDS=', '.join(unknownFields)
+                    )
+                )
+
+            validated.append(
+                (values['name'], values['pattern'], values['template'], values['contains'])
+            )
+
+        return tuple(validated)
+
+
+    def __setattr__(self, key, value):
+        raise AttributeError('ServerConfig objects are read-only.')
+
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+
+        except AttributeError:
+            raise KeyError(key)
+
+
+    def __contains__(self, key):
+        return key in SCHEMA
+
+
+    def get(self, key, default=None):
+        if key in SCHEMA:
+            return getattr(self, key)
+
+        return default
+
+
+    def asDict(self):
+        """
+        Returns the configuration options as a new dictionary.
+        """
+
+        return dict((key, getattr(self, key)) for key in SCHEMA)
+
+
+    def __eq__(self, other):
+        return isinstance(other, ServerConfig) and self.asDict() == other.asDict()
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __repr__(self):
+        return '<ServerConfig {SERVER_NICK} from {SOURCE}>'.format(
+            SERVER_NICK=self.SERVER_NICK,
+            SOURCE=self.source
+        )
+
+
+def fromLegacyConfig(configList):
+    """
+    Validate each dictionary in the legacy config.config list, returning a list of ServerConfig
+    objects.
+    """
+
+    configs = [
+        ServerConfig(configDict, 'config.py entry {INDEX}'.format(INDEX=index))
+        for index, configDict in enumerate(configList)
+    ]
+
+    _checkUnique(configs)
+
+    return configs
+
+
+def _checkUnique(configs):
+    """
+    Each server must have a unique nick and a unique jar name, as these are used to identify its
+    screen session and its process.
+    """
+
+    for key in ('SERVER_NICK', 'SERVER_JAR'):
+        seen = {}
+
+        for c in configs:
+            if c[key] in seen:
+                raise ConfigError(
+                    '{KEY} {VALUE} is used by both {FIRST} and {SECOND}.'.format(
+                        KEY=key,
+                        VALUE=c[key],
+                        FIRST=seen[c[key]].source,
+                        SECOND=c.source
+                    )
+                )
+
+            seen[c[key]] = c
+
+
+class ConfigLoader:
+    """
+    Loads server configurations from a conf.d style directory, caching parsed files by their
+    modification time.
+
+    Public methods:
+        load()
+    """
+
+    def __init__(self, confDir):
+        self.confDir = confDir
+
+        # Maps the path of each JSON file onto a tuple of (mtime, parsed dictionary).
+        self._fileCache = {}
+
+        # Maps the name of each server file onto a tuple of (signature, ServerConfig), where the
+        # signature holds the mtimes of every file in its inheritance chain.
+        self._serverCache = {}
+
+        self._lock = threading.Lock()
+
+
+    def _path(self, name):
+        return os.path.join(self.confDir, name + '.json')
+
+
+    def _readFile(self, name):
+        """
+        Returns a tuple of (mtime, dictionary) for the named file, only parsing the file if it
+        has changed since it was last read.
+        """
+
+        path = self._path(name)
+
+        try:
+            mtime = os.stat(path).st_mtime
+
+        except OSError:
+            raise ConfigError(
+                'Configuration file {PATH} does not exist.'.format(
+                    PATH=path
+                )
+            )
+
+        cached = self._fileCache.get(path)
+
+        if cached is not None and cached[0] == mtime:
+            return cached
+
+        logging.debug(
+            'Parsing configuration file {PATH}.'.format(
+                PATH=path
+            )
+        )
+
+        try:
+            with open(path) as f:
+                options = json.load(f)
+
+        except (IOError, ValueError) as e:
+            raise ConfigError(
+                'Could not parse configuration file {PATH}: {ERROR}'.format(
+                    PATH=path,
+                    ERROR=e
+                )
+            )
+
+        if not isinstance(options, dict):
+            raise ConfigError(
+                'Configuration file {PATH} must contain a JSON object.'.format(
+                    PATH=path
+                )
+            )
+
+        self._fileCache[path] = (mtime, options)
+
+        return self._fileCache[path]
+
+
+    def _resolve(self, name):
+        """
+        Returns a tuple of (signature, options) for the named file, with the options of every
+        file that it inherits from merged in beneath its own.
+        """
+
+        chain = []
+        seen = set()
+        current = name
+
+        while current is not None:
+            if current in seen:
+                raise ConfigError(
+                    'Configuration file {PATH} has circular inheritance.'.format(
+                        PATH=self._path(name)
+                    )
+                )
+
+            seen.add(current)
+            mtime, options = self._readFile(current)
+            chain.append((current, mtime, options))
+
+            current = options.get(INHERITS_KEY)
+
+            if current is None and DEFAULTS_TEMPLATE not in seen \
+                    and os.path.exists(self._path(DEFAULTS_TEMPLATE)):
+                current = DEFAULTS_TEMPLATE
+
+        merged = {}
+
+        for fileName, mtime, options in reversed(chain):
+            merged.update(options)
+
+        merged.pop(INHERITS_KEY, None)
+
+        signature = tuple((fileName, mtime) for fileName, mtime, options in chain)
+
+        return signature, merged
+
+
+    def load(self):
+        """
+        Returns a list of validated ServerConfig objects, one for each server file in the
+        configuration directory, sorted by file name.
+        """
+
+        with self._lock:
+            try:
+                fileNames = sorted(os.listdir(self.confDir))
+
+            except OSError as e:
+                raise ConfigError(
+                    'Could not read configuration directory {DIR}: {ERROR}'.format(
+                        DIR=self.confDir,
+                        ERROR=e
+                    )
+                )
+
+            names = [
+                f[:-len('.json')] for f in fileNames
+                if f.endswith('.json') and not f.startswith('_')
+            ]
+
+            configs = []
+            serverCache = {}
+
+            for name in names:
+                signature, options = self._resolve(name)
+                cached = self._serverCache.get(name)
+
+                if cached is not None and cached[0] == signature:
+                    serverConfig = cached[1]
+
+                else:
+                    serverConfig = ServerConfig(options, self._path(name))
+
+                serverCache[name] = (signature, serverConfig)
+                configs.append(serverConfig)
+
+            # Forget files which have been removed from the directory.
+            self._serverCache = serverCache
+
+            _checkUnique(configs)
+
+            return configs
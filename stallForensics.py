@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Captures why a server has stalled, before it is restarted or killed.
+
+Several thread dumps are taken a few seconds apart with jstack, while the CPU time of each of
+the JVM's threads is read from /proc/<pid>/task. The threads which used the most CPU are matched
+to their Java threads by the native thread ID in the dumps, and summarised with their stacks at
+the top of a gzipped report in the server's stalls directory, which keeps the newest
+MAX_REPORTS reports.
+
+If jstack is not installed or does not answer, the JVM is sent SIGQUIT instead, which makes it
+print each dump to the server console.
+
+A capture runs in its own thread, see Server._captureStall(). The server waits at most
+CAPTURE_WAIT seconds for it before the restart or kill goes ahead, and the capture stops taking
+dumps once the processes have exited.
+"""
+
+# Library modules
+import glob
+import gzip
+import logging
+import os
+import re
+import signal
+import subprocess
+import time
+
+
+# Number of thread dumps taken, and the seconds between them.
+DUMPS = 3
+DUMP_INTERVAL = 5
+
+# Seconds jstack has to take each dump, as it may hang on a badly stalled JVM.
+JSTACK_TIMEOUT = 30
+
+# Seconds a server waits for a capture before it is restarted or killed regardless.
+CAPTURE_WAIT = DUMPS * DUMP_INTERVAL
+
+# Number of reports kept for each server, the oldest are removed.
+MAX_REPORTS = 10
+
+# Number of threads summarised, and of frames shown from each of their stacks.
+HOTTEST_THREADS = 10
+SUMMARY_FRAMES = 8
+
+# Matches the first line of a thread in a dump, which contains its native thread ID.
+THREAD_REGEX = re.compile(r'^"(?P<name>.*)" .*\bnid=(?P<nid>0x[0-9a-fA-F]+)')
+
+
+def _run(args, timeout):
+    """
+    Returns the output of a command, or None if it failed or did not finish within timeout
+    seconds, in which case it is killed.
+    """
+
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    except OSError:
+        return None
+
+    deadline = time.time() + timeout
+
+    while p.poll() is None:
+        if time.time() >= deadline:
+            p.kill()
+            p.wait()
+
+            return None
+
+        time.sleep(0.1)
+
+    output = p.stdout.read()
+
+    return output if p.returncode == 0 else None
+
+
+def _threadTimes(PID):
+    """
+    Returns a dictionary mapping each thread ID of the process onto a tuple of its name and the
+    clock ticks of CPU time it has used.
+    """
+
+    times = {}
+
+    try:
+        tasks = os.listdir('/proc/{PID}/task'.format(PID=PID))
+
+    except OSError:
+        return times
+
+    for task in tasks:
+        try:
+            with open('/proc/{PID}/task/{TID}/stat'.format(PID=PID, TID=task)) as f:
+                stat = f.read()
+
+        except IOError:
+            # The thread has exited.
+            continue
+
+        # The name is in brackets, and may itself contain spaces and brackets.
+        name = stat[stat.find('(') + 1:stat.rfind(')')]
+        fields = stat[stat.rfind(')') + 2:].split()
+
+        # The user and system times are the 14th and 15th fields of the whole line.
+        times[int(task)] = (name, int(fields[11]) + int(fields[12]))
+
+    return times
+
+
+def _parseDump(dump):
+    """
+    Returns a dictionary mapping the native ID of each thread in a jstack dump onto the lines
+    of the thread.
+    """
+
+    threads = {}
+    current = None
+
+    for line in dump.splitlines():
+        match = THREAD_REGEX.match(line)
+
+        if match is not None:
+            current = threads[int(match.group('nid'), 16)] = [line]
+
+        elif not line.strip():
+            current = None
+
+        elif current is not None:
+            current.append(line)
+
+    return threads
+
+
+def _rotate(directory):
+    reports = sorted(glob.glob(directory + '/stall-*.txt.gz'))
+
+    for report in reports[:max(0, len(reports) - MAX_REPORTS)]:
+        try:
+            os.remove(report)
+        except OSError:
+            pass
+
+
+def capture(SERVER_NICK, SERVER_PATH, PIDs):
+    """
+    Capture thread dumps and per-thread CPU times of each of the server's processes, and
+    write them to a report. Returns the path of the report.
+    """
+
+    directory = SERVER_PATH + '/stalls'
+
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+
+    started = time.time()
+    path = '{DIRECTORY}/stall-{TIME}.txt.gz'.format(
+        DIRECTORY=directory,
+        TIME=time.strftime('%Y%m%d-%H%M%S', time.localtime(started))
+    )
+
+    logging.info(
+        'Capturing thread dumps of {SERVER_NICK} server to {PATH}.'.format(
+            SERVER_NICK=SERVER_NICK,
+            PATH=path
+        )
+    )
+
+    # Maps each PID onto its CPU times when the capture began, and its dumps.
+    firstTimes = dict((PID, _threadTimes(PID)) for PID in PIDs)
+    dumps = dict((PID, []) for PID in PIDs)
+
+    for index in range(DUMPS):
+        if index > 0:
+            time.sleep(DUMP_INTERVAL)
+
+            # The server was restarted or killed without waiting for the rest of the dumps.
+            if not any(os.path.isdir('/proc/{PID}'.format(PID=PID)) for PID in PIDs):
+                break
+
+        for PID in PIDs:
+            dump = _run(['jstack', '-l', str(PID)], JSTACK_TIMEOUT)
+
+            if dump is None:
+                # The JVM prints the dump to the server console.
+                try:
+                    os.kill(PID, signal.SIGQUIT)
+                    dump = 'jstack failed, SIGQUIT was sent and the dump is in the server console.\n'
+
+                except OSError as e:
+                    dump = 'jstack failed, and SIGQUIT could not be sent: {ERROR}\n'.format(ERROR=e)
+
+            dumps[PID].append((time.time(), dump))
+
+    elapsed = time.time() - started
+    ticks = os.sysconf('SC_CLK_TCK')
+
+    with gzip.open(path, 'wb') as report:
+        report.write(
+            'Stall of {SERVER_NICK} server, captured {TIME}.\n'.format(
+                SERVER_NICK=SERVER_NICK,
+                TIME=time.ctime(started)
+            )
+        )
+
+        for PID in PIDs:
+            lastTimes = _threadTimes(PID)
+
+            # The CPU used by each thread while the dumps were taken, as a percentage of one core.
+            usage = sorted(
+                (
+                    (lastTicks - firstTimes[PID].get(TID, (name, 0))[1]) * 100.0 / ticks / elapsed,
+                    TID,
+                    name
+                )
+                for TID, (name, lastTicks) in lastTimes.iteritems()
+            )
+
+            usage.reverse()
+
+            threads = _parseDump(dumps[PID][-1][1])
+
+            report.write(
+                '\nProcess {PID}, hottest threads over {SECONDS:.0f} seconds:\n'.format(
+                    PID=PID,
+                    SECONDS=elapsed
+                )
+            )
+
+            for percent, TID, name in usage[:HOTTEST_THREADS]:
+                report.write('\n{PERCENT:6.1f}% CPU  thread {TID} ({NAME})\n'.format(
+                    PERCENT=percent,
+                    TID=TID,
+                    NAME=name
+                ))
+
+                for line in threads.get(TID, [])[:SUMMARY_FRAMES + 1]:
+                    report.write('    ' + line + '\n')
+
+            for index, (dumped, dump) in enumerate(dumps[PID]):
+                report.write(
+                    '\n=== Thread dump {INDEX} of {COUNT} of process {PID}, at {TIME} ===\n\n'.format(
+                        INDEX=index + 1,
+                        COUNT=len(dumps[PID]),
+                        PID=PID,
+                        TIME=time.ctime(dumped)
+                    )
+                )
+
+                report.write(dump)
+
+    _rotate(directory)
+
+    return path
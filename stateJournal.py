@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Records a server's state transitions in <SERVER_PATH>/pycraft.journal, so that Pycraft resumes
+where it left off when it is restarted, and keeps an audit history of what was done to the server.
+
+The journal is a file of JSON objects, one per line, which are only ever appended to. Each entry
+has the time and the event, which is one of:
+
+    start                   The server was started, and its target state is online.
+    stop                    The server was stopped, and its target state is offline.
+    hibernate               The server was stopped while idle, and waits for a player to join.
+    restart                 The server was restarted.
+    shutdown                The server was stopped by shutdown-all, leaving its target state.
+    restartScheduled        Restart warnings were scheduled, for a restart at "at", of the
+                            process which started at "process".
+    restartsCancelled       The scheduled restart was cancelled.
+    snapshot                The state of the server when the journal was last compacted.
+
+Replaying the entries in order gives the server's state. Once the journal holds MAX_ENTRIES
+entries it is compacted, keeping the newest HISTORY_ENTRIES followed by a snapshot. A line left
+incomplete by a crash is ignored.
+"""
+
+# Library modules
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Number of entries at which the journal is compacted, and the number it then keeps.
+MAX_ENTRIES = 2000
+HISTORY_ENTRIES = 1000
+
+
+class StateJournal:
+    """
+    The journal of one server.
+
+    Public methods:
+        history(count)
+        record(event, **fields)
+        state()
+    """
+
+    def __init__(self, SERVER_NICK, path):
+        self.SERVER_NICK = SERVER_NICK
+        self.path = path
+
+        # Held while the journal is appended to or compacted, as it may be read for its history
+        # by the console and control API threads.
+        self._lock = threading.Lock()
+
+        self._entries = len(self._read())
+
+
+    def _read(self):
+        entries = []
+
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+
+                    except ValueError:
+                        # Written incompletely before a crash.
+                        continue
+
+        except IOError:
+            pass
+
+        return entries
+
+
+    def _write(self, entries):
+        with open(self.path + '.tmp', 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(self.path + '.tmp', self.path)
+
+
+    @staticmethod
+    def _replay(entries):
+        """
+        Returns the state given by the entries, as a dictionary of the target state (True,
+        False, or None if no entry gives it), whether the server is hibernating, and the time
+        of the scheduled restart and the start time of the process it restarts, or None.
+        """
+
+        state = {'online': None, 'hibernating': False, 'restartAt': None, 'process': None}
+
+        for entry in entries:
+            event = entry['event']
+
+            if event == 'snapshot':
+                for key in state:
+                    state[key] = entry[key]
+
+            elif event == 'start':
+                state.update(online=True, hibernating=False, restartAt=None)
+
+            elif event == 'stop':
+                state.update(online=False, hibernating=False, restartAt=None)
+
+            elif event == 'hibernate':
+                state.update(hibernating=True, restartAt=None)
+
+            elif event in ('restart', 'shutdown', 'restartsCancelled'):
+                state['restartAt'] = None
+
+            elif event == 'restartScheduled':
+                state.update(restartAt=entry['at'], process=entry['process'])
+
+        return state
+
+
+    def state(self):
+        """
+        Returns the state of the server as it was last recorded, see _replay().
+        """
+
+        with self._lock:
+            return StateJournal._replay(self._read())
+
+
+    def record(self, event, **fields):
+        """
+        Append an entry for the event, with the given fields, to the journal.
+
+        The entry is synced to disk before returning, on the calling thread, which is usually a
+        server's scheduler. Unlike Pycraft's log, the journal is not written in the background,
+        as a state change must be on disk before Pycraft acts on it. Events are rare, so the
+        sync only delays the starts, stops and restarts which record them.
+        """
+
+        entry = dict(fields, time=time.time(), event=event)
+
+        with self._lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self._entries += 1
+
+                if self._entries >= MAX_ENTRIES:
+                    self._compact()
+
+            except (IOError, OSError) as e:
+                logging.error(
+                    'Could not record {EVENT} in the journal of {SERVER_NICK} server: {ERROR}'.format(
+                        EVENT=event,
+                        SERVER_NICK=self.SERVER_NICK,
+                        ERROR=e
+                    )
+                )
+
+
+    def _compact(self):
+        """
+        Rewrite the journal as its newest HISTORY_ENTRIES entries, followed by a snapshot of the
+        state which all of its entries give.
+        """
+
+        entries = self._read()
+
+        snapshot = StateJournal._replay(entries)
+        snapshot.update(time=time.time(), event='snapshot')
+
+        kept = [entry for entry in entries if entry['event'] != 'snapshot'][-HISTORY_ENTRIES:]
+
+        self._write(kept + [snapshot])
+        self._entries = len(kept) + 1
+
+
+    def history(self, count=None):
+        """
+        Returns a list of the newest count entries, or of every entry, oldest first, leaving out
+        snapshots.
+        """
+
+        with self._lock:
+            entries = [entry for entry in self._read() if entry['event'] != 'snapshot']
+
+        return entries[-count:] if count else entries
@@ -3,18 +3,25 @@
 
 
 # Library modules
+import os
 import threading
 import select
 import signal
 import sys
+import time
 
-# Third-party modules
-import psutil
+# Project modules
+import playerSessions
+import serverConfig
+
+
+# Maximum number of entries of each server printed by the chatsearch command.
+CHATSEARCH_LIMIT = 50
 
 
 class StdinListener(threading.Thread):
 
-    def __init__(self, serverInstances, version):
+    def __init__(self, serverInstances, version, reloadConfig):
         super(StdinListener, self).__init__(name="Thread-PycraftStdinListener")
 
         self.daemon = True
@@ -22,9 +29,50 @@ class StdinListener(threading.Thread):
         self.stopping = False
         self.version = version
 
+        # Callable which rereads the server configuration, and returns a list of the nicks of
+        # servers which were updated or added.
+        self.reloadConfig = reloadConfig
+
 
     def displayHelp(self, command=None):
-        if command == "exit":
+        if command == "chatlog":
+            print("chatlog backfill <serverNick>:")
+            print("Extracts the chat entries of the specified server's historical logs, which")
+            print("are the ForgeModLoader-server-2.log and older logs, and any gzipped vanilla")
+            print("logs in its logs directory. The entries are merged into the server's")
+            print("chatlog.txt in chronological order. Logs are parsed in parallel in the")
+            print("background, and logs which have already been backfilled are skipped.")
+            print("")
+            print("chatlog <serverNick> <from> <to>:")
+            print("Prints the chat entries of the specified server from one time to another,")
+            print("each given as YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS]. A date alone as <to>")
+            print("includes the whole of that day. Only the segments of the chatlog which")
+            print("cover the range are read.")
+
+        elif command == "chatsearch":
+            print("chatsearch <serverNick|*> [user:<name>] [terms...]:")
+            print("Prints the newest chat entries of the specified server, or of every server")
+            print("with a chatlog, which were written by the given player and contain every")
+            print("one of the terms. The search uses each chatlog's index, so it takes")
+            print("milliseconds however large the chatlogs are.")
+
+        elif command == "sessions":
+            print("sessions <serverNick> peak [hours]:")
+            print("Prints the peak number of players online in each hour of the last 24, or the")
+            print("given number of, hours.")
+            print("")
+            print("sessions <serverNick> top [count] [days]:")
+            print("Prints the 10, or count, players who have played the longest over all time,")
+            print("or over the last number of days. The server must have ENABLE_SESSIONS set.")
+
+        elif command == "history":
+            print("history <serverNick> [count]:")
+            print("Prints the newest 20, or count, entries of the specified server's journal,")
+            print("which records when it was started, stopped, restarted and hibernated, and")
+            print("when its restarts were scheduled or cancelled. The server must have")
+            print("ENABLE_STATE_JOURNAL set.")
+
+        elif command == "exit":
             print("exit:")
             print("Closes the Pycraft server wrapper. Any servers that are currently being")
             print("monitored by Pycraft will remain running inside their respective screen")
@@ -43,11 +91,26 @@ class StdinListener(threading.Thread):
             print("which are unique server identifiers to be used when issuing a Pycraft")
             print("command.")
 
+        elif command == "reload":
+            print("reload:")
+            print("Rereads the per-server configuration files in the configuration directory.")
+            print("Only files which have changed are parsed again. Servers which were added")
+            print("to the configuration will begin to be monitored, and changes to existing")
+            print("servers will take effect from their next server check.")
+
         elif command == "restart":
             print("restart <serverNick>:")
             print("If the specified server is currently in the online state, this command")
             print("will stop and then start the specified Minecraft server.")
 
+        elif command == "shutdown-all":
+            print("shutdown-all:")
+            print("Stops every running server, then closes the Pycraft server wrapper. The")
+            print("players of every server are warned, every world is saved, and all servers")
+            print("are stopped at the same time. Any server which has not stopped gracefully")
+            print("by the shutdown deadline is sent a SIGKILL signal. The time taken to stop")
+            print("each server is displayed. Sending SIGUSR1 to Pycraft has the same effect.")
+
         elif command == "start":
             print("start <serverNick>:")
             print("If the specified server is currently in the offline state, this command")
@@ -71,10 +134,17 @@ class StdinListener(threading.Thread):
 
         else:
             print("Welcome to Pycraft version " + self.version + ". Available pycraft commands:")
+            print("\tchatlog\tbackfill <serverNick>")
+            print("\tchatlog\t<serverNick> <from> <to>")
+            print("\tchatsearch\t<serverNick|*> [user:<name>] [terms...]")
             print("\texit")
             print("\thelp\t[command]")
+            print("\thistory\t<serverNick> [count]")
             print("\tlist")
+            print("\treload")
             print("\trestart\t<serverNick>")
+            print("\tsessions\t<serverNick> peak [hours] | top [count] [days]")
+            print("\tshutdown-all")
             print("\tstart\t<serverNick>")
             print("\tstatus\t<serverNick>")
             print("\tstop\t<serverNick>")        
@@ -92,6 +162,199 @@ class StdinListener(threading.Thread):
         return None            
 
 
+    def backfillChatlog(self, s):
+        """
+        Backfill the server's chatlog in a new thread, as it may take several minutes.
+        """
+
+        # The chatlog module requires the watchdog package.
+        try:
+            import chatlog
+
+        except ImportError as e:
+            print("Chatlogs are unavailable: {}".format(e))
+            return
+
+        backfill = chatlog.ChatlogBackfill(
+            s.getConfig("SERVER_NICK"),
+            s.getConfig("SERVER_PATH"),
+            s.getConfig("CHAT_RULES")
+        )
+
+        def run():
+            try:
+                result = backfill.run()
+
+            except (IOError, OSError) as e:
+                print("\nChatlog backfill of {} failed: {}".format(s.getConfig("SERVER_NICK"), e))
+
+            else:
+                print("\nChatlog backfill of {} complete: {} of {} logs parsed, {} bytes added.".format(
+                    s.getConfig("SERVER_NICK"),
+                    result["logs"] - result["skipped"],
+                    result["logs"],
+                    result["added"]
+                ))
+
+        thread = threading.Thread(target=run, name="Thread-PycraftChatlogBackfill")
+        thread.daemon = True
+        thread.start()
+
+        print("Backfilling chatlog of {} in the background.".format(s.getConfig("SERVER_NICK")))
+
+
+    def parseChatlogTime(self, value, end):
+        """
+        Returns a YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS] time in the form of a chatlog timestamp, or
+        None if it is invalid. A date alone is the start of that day, or its end if end is True.
+        """
+
+        for timeFormat in ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                parsed = time.strptime(value, timeFormat)
+
+            except ValueError:
+                continue
+
+            if timeFormat == "%Y-%m-%d" and end:
+                return time.strftime("%Y-%m-%d 23:59:59", parsed)
+
+            return time.strftime("%Y-%m-%d %H:%M:%S", parsed)
+
+        return None
+
+
+    def queryChatlog(self, s, start, end):
+        """
+        Print the server's chat entries from start to end.
+        """
+
+        try:
+            import chatlog
+
+        except ImportError as e:
+            print("Chatlogs are unavailable: {}".format(e))
+            return
+
+        store = chatlog.ChatlogStore(s.getConfig("SERVER_NICK"), s.getConfig("SERVER_PATH"))
+        count = 0
+
+        try:
+            for line in store.query(start, end):
+                sys.stdout.write(line)
+                count += 1
+
+        except (IOError, OSError) as e:
+            print("Chatlog of {} could not be read: {}".format(s.getConfig("SERVER_NICK"), e))
+            return
+
+        print("{} chatlog lines from {} to {}.".format(count, start, end))
+
+
+    def searchChatlogs(self, servers, arguments):
+        """
+        Print the newest entries of each server's chatlog which match the search arguments.
+        """
+
+        try:
+            import chatlog
+
+        except ImportError as e:
+            print("Chatlogs are unavailable: {}".format(e))
+            return
+
+        username = None
+        words = []
+
+        for argument in arguments:
+            if argument.lower().startswith("user:"):
+                username = argument[len("user:"):]
+            else:
+                words.append(argument)
+
+        for s in servers:
+            started = time.time()
+
+            try:
+                result = chatlog.chatIndex(s.getConfig("SERVER_PATH")).search(
+                    username,
+                    words,
+                    CHATSEARCH_LIMIT
+                )
+
+            except (IOError, OSError) as e:
+                print("Chatlog of {} could not be searched: {}".format(s.getConfig("SERVER_NICK"), e))
+                continue
+
+            for line in result["lines"]:
+                sys.stdout.write("{}: {}".format(s.getConfig("SERVER_NICK"), line))
+
+            print("{}: {} matching entries, newest {} shown, in {:.1f} ms.".format(
+                s.getConfig("SERVER_NICK"),
+                result["total"],
+                len(result["lines"]),
+                (time.time() - started) * 1000
+            ))
+
+            if result["indexing"]:
+                print("{}: chatlog.txt is still being indexed, only its older entries were searched.".format(
+                    s.getConfig("SERVER_NICK")
+                ))
+
+            if result["unindexed"]:
+                print("{}: {} chatlog segments are not indexed yet and were not searched.".format(
+                    s.getConfig("SERVER_NICK"),
+                    result["unindexed"]
+                ))
+
+
+    def printHistory(self, s, count):
+        """
+        Print the newest count entries of the server's journal.
+        """
+
+        history = s.getHistory(count)
+
+        if history is None:
+            print("Server {} does not have ENABLE_STATE_JOURNAL set.".format(s.getConfig("SERVER_NICK")))
+            return
+
+        for entry in history:
+            details = ""
+
+            if entry["event"] == "restartScheduled":
+                details = "for " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["at"]))
+
+            print("{}  {:<18} {}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])),
+                entry["event"],
+                details
+            ))
+
+
+    def printSessions(self, s, query, arguments):
+        """
+        Print the peak players online per hour, or the players with the most playtime.
+        """
+
+        store = playerSessions.sessionStore(s.getConfig("SERVER_PATH"))
+        now = int(time.time())
+
+        if query == "peak":
+            hours = arguments[0] if arguments else 24
+            start = (now - (hours - 1) * 3600) // 3600 * 3600
+
+            for hour, peak in store.peakConcurrency(start, now):
+                print("{}  {:>4}".format(time.strftime("%Y-%m-%d %H:00", time.localtime(hour)), peak))
+
+        else:
+            count = arguments[0] if arguments else 10
+            start = now - arguments[1] * 86400 if len(arguments) > 1 else 0
+
+            for username, seconds in store.playtime(start, now)[:count]:
+                print("{:>30}  {:>6}h {:02}m".format(username, seconds // 3600, seconds // 60 % 60))
+
+
     def run(self):
         self.displayHelp()
         sys.stdout.write("\npycraft> ")
@@ -119,10 +382,88 @@ class StdinListener(threading.Thread):
                     commandList[0] = commandList[0].lower()
 
 
-                    if commandList[0] == "exit":
-                        # Send SIGTERM to this process, terminating the main thread.
-                        process = psutil.Process()
-                        process.send_signal(signal.SIGTERM)
+                    if commandList[0] == "chatlog":
+                        if len(commandList) == 3 and commandList[1].lower() == "backfill":
+                            s = self.getServerInstance(commandList[2])
+
+                            if s is not None:
+                                self.backfillChatlog(s)
+
+                        elif len(commandList) == 4:
+                            start = self.parseChatlogTime(commandList[2], False)
+                            end = self.parseChatlogTime(commandList[3], True)
+
+                            if start is None or end is None:
+                                self.displayHelp("chatlog")
+
+                            else:
+                                s = self.getServerInstance(commandList[1])
+
+                                if s is not None:
+                                    self.queryChatlog(s, start, end)
+
+                        else:
+                            self.displayHelp("chatlog")
+
+
+                    elif commandList[0] == "chatsearch":
+                        if len(commandList) < 3:
+                            self.displayHelp("chatsearch")
+
+                        elif commandList[1] == "*":
+                            self.searchChatlogs(
+                                [s for s in self.serverInstances if s.getConfig("ENABLE_CHATLOG")],
+                                commandList[2:]
+                            )
+
+                        else:
+                            s = self.getServerInstance(commandList[1])
+
+                            if s is not None:
+                                self.searchChatlogs([s], commandList[2:])
+
+
+                    elif commandList[0] == "sessions":
+                        if len(commandList) < 3 or commandList[2].lower() not in ("peak", "top") \
+                                or not all(a.isdigit() and int(a) > 0 for a in commandList[3:]) \
+                                or len(commandList) > (4 if commandList[2].lower() == "peak" else 5):
+                            self.displayHelp("sessions")
+
+                        else:
+                            s = self.getServerInstance(commandList[1])
+
+                            if s is not None:
+                                self.printSessions(
+                                    s,
+                                    commandList[2].lower(),
+                                    [int(a) for a in commandList[3:]]
+                                )
+
+
+                    elif commandList[0] == "history":
+                        if len(commandList) not in (2, 3) \
+                                or not all(a.isdigit() and int(a) > 0 for a in commandList[2:]):
+                            self.displayHelp("history")
+
+                        else:
+                            s = self.getServerInstance(commandList[1])
+
+                            if s is not None:
+                                self.printHistory(s, int(commandList[2]) if len(commandList) == 3 else 20)
+
+
+                    elif commandList[0] == "exit":
+                        # Send SIGINT to this process, terminating the main thread. SIGTERM
+                        # may be set to stop every server, with SHUTDOWN_ALL_ON_SIGTERM.
+                        os.kill(os.getpid(), signal.SIGINT)
+                        self.stopping = True
+                        continue
+
+
+                    elif commandList[0] == "shutdown-all":
+                        # Send SIGUSR1 to this process, so that the main thread stops every
+                        # server and then exits.
+                        os.kill(os.getpid(), signal.SIGUSR1)
                         self.stopping = True
                         continue
 
@@ -143,6 +484,19 @@ class StdinListener(threading.Thread):
                             print("\t" + s.getConfig('SERVER_NICK'))
 
 
+                    elif commandList[0] == "reload":
+                        try:
+                            changed = self.reloadConfig()
+
+                        except serverConfig.ConfigError as e:
+                            print("Configuration was not reloaded: {}".format(e))
+
+                        else:
+                            print("Configuration reloaded. Servers updated: {}".format(
+                                ", ".join(changed) or "none"
+                            ))
+
+
                     elif commandList[0] == "restart":
                         if len(commandList) != 2:
                             self.displayHelp("restart")
@@ -183,6 +537,27 @@ class StdinListener(threading.Thread):
                                     print("Target state:\toffline")
 
                                 print("Is online:\t{}".format(s.isOnline()))
+                                print("Hibernating:\t{}".format(s.isHibernating()))
+                                print("Port:\t\t{}".format(s.getAddress()[1]))
+
+                                gcStats = s.getGCStats()
+
+                                if gcStats is not None:
+                                    print("GC pauses:\tp50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms over the last {} pauses".format(
+                                        gcStats['p50'],
+                                        gcStats['p99'],
+                                        gcStats['max'],
+                                        gcStats['pauses']
+                                    ))
+
+                                    if gcStats['heapAfter'] is not None:
+                                        print("GC heap:\t{:.0f} of {:.0f} MB after the last GC".format(
+                                            gcStats['heapAfter'],
+                                            gcStats['heapSize']
+                                        ))
+
+                                    if gcStats['allocationRate'] is not None:
+                                        print("Allocation:\t{:.1f} MB/s".format(gcStats['allocationRate']))
                                 print("Is responsive:\t{}".format(s.isResponsive()))
 
 
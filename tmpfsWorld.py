@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Serves a server's world from a tmpfs directory, writing it back to the server's disk.
+
+The world directory named by level-name in server.properties becomes a symbolic link. While the
+server runs from tmpfs it points at the copy in WORLD_TMPFS, and otherwise at the newest of two
+snapshots of the world on disk, <world>.disk.a and <world>.disk.b. Each write-back copies the
+tmpfs world over the older snapshot, syncs it to disk, and only then records it as the newest in
+<world>.journal, so the journal always names a whole snapshot however a write-back is cut short.
+
+The journal also records whether the server is running from tmpfs. If it is when the world is
+next loaded, Pycraft or the server stopped without a final write-back: the tmpfs copy is written
+back first if it survived, or else the changes since the last write-back were lost with the
+host's memory, and the newest snapshot is used.
+"""
+
+# Library modules
+import json
+import logging
+import os
+import subprocess
+import time
+
+# Third party modules
+import psutil
+
+
+# The world may grow while it is in tmpfs, so this many times its size must be free to load it.
+GROWTH = 1.25
+
+# Bytes of memory which must be left available after loading a world, for the servers
+# themselves.
+RESERVED_MEMORY = 1024 * 1024 * 1024
+
+
+def levelName(SERVER_PATH):
+    """
+    Returns the name of the server's world directory, read from its server.properties.
+    """
+
+    try:
+        with open(SERVER_PATH + '/server.properties') as f:
+            for line in f:
+                if line.startswith('level-name='):
+                    return line.split('=', 1)[1].strip() or 'world'
+
+    except IOError:
+        pass
+
+    return 'world'
+
+
+def _size(path):
+    """
+    Returns the number of bytes in the files below path.
+    """
+
+    size = 0
+
+    for directory, directories, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+class TmpfsWorld:
+    """
+    The world of one server, which is either loaded into tmpfs or served from disk.
+
+    Public methods:
+        isLoaded()
+        load()
+        writeBack()
+        unload()
+    """
+
+    def __init__(self, SERVER_NICK, SERVER_PATH, WORLD_TMPFS, WORLD_TMPFS_BWLIMIT=None):
+        self.SERVER_NICK = SERVER_NICK
+        self.SERVER_PATH = SERVER_PATH
+        self.WORLD_TMPFS = WORLD_TMPFS
+
+        # Kilobytes per second which write-backs may write, or None for no limit.
+        self.WORLD_TMPFS_BWLIMIT = WORLD_TMPFS_BWLIMIT
+
+        self.world = levelName(SERVER_PATH)
+        self.worldPath = '{SERVER_PATH}/{WORLD}'.format(SERVER_PATH=SERVER_PATH, WORLD=self.world)
+        self.tmpfsPath = '{WORLD_TMPFS}/{WORLD}'.format(WORLD_TMPFS=WORLD_TMPFS, WORLD=self.world)
+        self.journalPath = self.worldPath + '.journal'
+
+        self.journal = None
+
+
+    def _snapshotPath(self, snapshot):
+        return '{WORLD_PATH}.disk.{SNAPSHOT}'.format(WORLD_PATH=self.worldPath, SNAPSHOT=snapshot)
+
+
+    def _readJournal(self):
+        try:
+            with open(self.journalPath) as f:
+                self.journal = json.load(f)
+
+        except (IOError, ValueError):
+            self.journal = None
+
+        return self.journal
+
+
+    def _writeJournal(self):
+        with open(self.journalPath + '.tmp', 'w') as f:
+            json.dump(self.journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(self.journalPath + '.tmp', self.journalPath)
+
+
+    def _link(self, target):
+        """
+        Point the world directory at target, replacing the link in one step.
+        """
+
+        if os.path.lexists(self.worldPath + '.tmp'):
+            os.remove(self.worldPath + '.tmp')
+
+        os.symlink(target, self.worldPath + '.tmp')
+        os.rename(self.worldPath + '.tmp', self.worldPath)
+
+
+    def _rsync(self, source, destination, throttle=False):
+        command = ['rsync', '-a', '--delete']
+
+        if throttle and self.WORLD_TMPFS_BWLIMIT is not None:
+            command.append('--bwlimit={BWLIMIT}'.format(BWLIMIT=int(self.WORLD_TMPFS_BWLIMIT)))
+
+        returnCode = subprocess.call(command + [source + '/', destination + '/'])
+
+        if returnCode != 0:
+            raise OSError('rsync exited with status {STATUS}.'.format(STATUS=returnCode))
+
+
+    def isLoaded(self):
+        """
+        Returns True if the journal records that the server runs from tmpfs.
+        """
+
+        journal = self._readJournal()
+
+        return journal is not None and journal['tmpfs'] and os.path.isdir(self.tmpfsPath)
+
+
+    def _fits(self):
+        """
+        Returns True if the tmpfs and the host's memory have room for the world.
+        """
+
+        snapshotSize = _size(self._snapshotPath(self.journal['snapshot']))
+        loadedSize = _size(self.tmpfsPath) if os.path.isdir(self.tmpfsPath) else 0
+
+        # Only what is not already loaded takes more space.
+        needed = max(0, snapshotSize * GROWTH - loadedSize)
+
+        statistics = os.statvfs(self.WORLD_TMPFS)
+        tmpfsFree = statistics.f_bavail * statistics.f_frsize
+        memoryFree = psutil.virtual_memory().available - RESERVED_MEMORY
+
+        if needed <= min(tmpfsFree, memoryFree):
+            return True
+
+        logging.warning(
+            'The {SIZE} MB world of {SERVER_NICK} server will be served from disk, as only'.format(
+                SIZE=snapshotSize // (1024 * 1024),
+                SERVER_NICK=self.SERVER_NICK
+            )
+            + ' {TMPFS} MB of tmpfs and {MEMORY} MB of memory are free.'.format(
+                TMPFS=tmpfsFree // (1024 * 1024),
+                MEMORY=max(0, memoryFree) // (1024 * 1024)
+            )
+        )
+
+        return False
+
+
+    def load(self):
+        """
+        Load the world into tmpfs before the server starts, only copying the files which have
+        changed if it was loaded before. Returns True if the server will run from tmpfs, or
+        False if the world is served from disk.
+        """
+
+        if not os.path.isdir(self.WORLD_TMPFS):
+            os.makedirs(self.WORLD_TMPFS)
+
+        if self._readJournal() is None:
+            # The first load moves the world into the first snapshot.
+            if os.path.isdir(self.worldPath) and not os.path.islink(self.worldPath):
+                os.rename(self.worldPath, self._snapshotPath('a'))
+            elif not os.path.isdir(self._snapshotPath('a')):
+                os.mkdir(self._snapshotPath('a'))
+
+            self.journal = {'snapshot': 'a', 'tmpfs': False, 'writtenBack': None}
+            self._writeJournal()
+
+        if self.journal['tmpfs']:
+            if os.path.isdir(self.tmpfsPath):
+                logging.warning(
+                    '{SERVER_NICK} server stopped without writing its world back to disk,'.format(
+                        SERVER_NICK=self.SERVER_NICK
+                    )
+                    + ' which will be written back now.'
+                )
+
+                # The tmpfs world is newer than every snapshot, so the server runs from it
+                # even if it could not be written back.
+                try:
+                    self.writeBack(throttle=False)
+
+                except OSError as e:
+                    logging.error(
+                        'Could not write back the world of {SERVER_NICK} server: {ERROR}'.format(
+                            SERVER_NICK=self.SERVER_NICK,
+                            ERROR=e
+                        )
+                    )
+
+                self._link(self.tmpfsPath)
+
+                return True
+
+            else:
+                logging.error(
+                    'The tmpfs world of {SERVER_NICK} server has been lost, and changes since'.format(
+                        SERVER_NICK=self.SERVER_NICK
+                    )
+                    + ' it was written back at {TIME} will be missing.'.format(
+                        TIME=time.ctime(self.journal['writtenBack']) if self.journal['writtenBack'] else 'startup'
+                    )
+                )
+
+        snapshot = self._snapshotPath(self.journal['snapshot'])
+
+        started = time.time()
+
+        try:
+            loaded = self._fits()
+
+            if loaded:
+                self._rsync(snapshot, self.tmpfsPath)
+
+        except OSError as e:
+            logging.error(
+                'Could not load the world of {SERVER_NICK} server into tmpfs: {ERROR}'.format(
+                    SERVER_NICK=self.SERVER_NICK,
+                    ERROR=e
+                )
+            )
+
+            loaded = False
+
+        if not loaded:
+            self.journal['tmpfs'] = False
+            self._writeJournal()
+            self._link(os.path.basename(snapshot))
+
+            return False
+
+        # Recorded before the server can write to it.
+        self.journal['tmpfs'] = True
+        self._writeJournal()
+        self._link(self.tmpfsPath)
+
+        logging.info(
+            'Loaded the world of {SERVER_NICK} server into {PATH} in {SECONDS:.1f} seconds.'.format(
+                SERVER_NICK=self.SERVER_NICK,
+                PATH=self.tmpfsPath,
+                SECONDS=time.time() - started
+            )
+        )
+
+        return True
+
+
+    def writeBack(self, throttle=True):
+        """
+        Copy the tmpfs world over the older snapshot on disk, which then becomes the newest.
+        Saving must be suspended, or the server stopped, while it is written back. A stopped
+        server is written back without throttling, as nobody is playing on it.
+        """
+
+        older = 'b' if self.journal['snapshot'] == 'a' else 'a'
+        started = time.time()
+
+        self._rsync(self.tmpfsPath, self._snapshotPath(older), throttle)
+
+        # The snapshot must be on disk before the journal names it.
+        subprocess.call(['sync'])
+
+        self.journal['snapshot'] = older
+        self.journal['writtenBack'] = time.time()
+        self._writeJournal()
+
+        logging.info(
+            'Wrote the world of {SERVER_NICK} server back to disk in {SECONDS:.1f} seconds.'.format(
+                SERVER_NICK=self.SERVER_NICK,
+                SECONDS=time.time() - started
+            )
+        )
+
+
+    def unload(self):
+        """
+        Write the world back after the server has stopped, and serve it from disk again. The
+        tmpfs copy is kept, so that loading it again only copies what has changed since.
+        """
+
+        self.writeBack(throttle=False)
+
+        self.journal['tmpfs'] = False
+        self._writeJournal()
+        self._link(os.path.basename(self._snapshotPath(self.journal['snapshot'])))